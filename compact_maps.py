@@ -0,0 +1,335 @@
+"""
+Author: Tomas Dal Farra
+Date: 01/19/2023
+Description: Compact dictionaries for big homogeneous key spaces (int to int and str to bytes). Entries are kept in
+sorted arrays instead of Python objects, recent changes in a small dictionary merged into the arrays when it grows
+https://github.com/Kloke93/database_sync
+"""
+from collections.abc import MutableMapping
+from array import array
+import bisect
+import abc
+import sys
+
+try:
+    import numpy
+except ImportError:                         # bulk lookups without numpy are one binary search per key
+    numpy = None
+
+
+_DELETED = object()                         # overlay mark of a key deleted from the arrays
+_MISSING = object()
+
+
+class SortedArrayMap(MutableMapping, abc.ABC):
+    """
+    Dictionary of sorted arrays plus an overlay of changes (key: value or _DELETED). The overlay is merged into new
+    arrays when it has more than MERGE_FRACTION of the entries (at least MERGE_MIN), so each change costs a few
+    copies of an entry on average
+    """
+    MERGE_MIN = 1024
+    MERGE_FRACTION = 0.125
+
+    def __init__(self, items=()):
+        self.overlay = {}
+        self.length = 0
+        self._build(())
+        self.bulk_update(items)
+
+    # implemented by the subclasses
+    @abc.abstractmethod
+    def _check(self, key, val):
+        """ Raises TypeError if the key or the value can't be kept in the arrays """
+
+    @abc.abstractmethod
+    def _find(self, key) -> int:
+        """ Gets the position of a key in the arrays (-1 if it isn't there) """
+
+    @abc.abstractmethod
+    def _key_at(self, pos):
+        """ Gets the key at a position of the arrays """
+
+    @abc.abstractmethod
+    def _value_at(self, pos):
+        """ Gets the value at a position of the arrays """
+
+    @abc.abstractmethod
+    def _count(self) -> int:
+        """ Gets the amount of entries in the arrays """
+
+    @abc.abstractmethod
+    def _build(self, items):
+        """ Replaces the arrays with sorted (key, value) pairs """
+
+    @abc.abstractmethod
+    def _array_bytes(self) -> int:
+        """ Gets the bytes used by the arrays """
+
+    def _base_items(self):
+        """ Yields (key, value) of the arrays in order """
+        for pos in range(self._count()):
+            yield self._key_at(pos), self._value_at(pos)
+
+    def _merged_items(self):
+        """ Yields (key, value) of the arrays with the overlay applied, in order """
+        changes = sorted(self.overlay.items(), key=lambda item: item[0])
+        i = 0
+        for key, val in self._base_items():
+            while i < len(changes) and changes[i][0] < key:
+                if changes[i][1] is not _DELETED:
+                    yield changes[i]
+                i += 1
+            if i < len(changes) and changes[i][0] == key:
+                if changes[i][1] is not _DELETED:
+                    yield changes[i]
+                i += 1
+            else:
+                yield key, val
+        for change in changes[i:]:
+            if change[1] is not _DELETED:
+                yield change
+
+    def merge(self):
+        """ Writes the overlay into new arrays """
+        if self.overlay:
+            self._build(self._merged_items())
+            self.overlay = {}
+
+    def _maybe_merge(self):
+        """ Merges the overlay if it got too big """
+        if len(self.overlay) > max(SortedArrayMap.MERGE_MIN, self._count() * SortedArrayMap.MERGE_FRACTION):
+            self.merge()
+
+    def bulk_update(self, items):
+        """
+        Sets many entries merging them into the arrays at once
+        :param items: dictionary or iterable of (key, value)
+        """
+        items = items.items() if isinstance(items, dict) else items
+        self.merge()
+        for key, val in items:
+            self._check(key, val)
+            self.overlay[key] = val
+            if len(self.overlay) > max(SortedArrayMap.MERGE_MIN * 64, self._count()):
+                self.merge()
+        self.merge()
+        self.length = self._count()                     # without overlay every entry is in the arrays
+
+    def __getitem__(self, key):
+        val = self.overlay.get(key, _MISSING)
+        if val is _DELETED:
+            raise KeyError(key)
+        if val is not _MISSING:
+            return val
+        pos = self._find(key)
+        if pos < 0:
+            raise KeyError(key)
+        return self._value_at(pos)
+
+    def __contains__(self, key):
+        val = self.overlay.get(key, _MISSING)
+        if val is not _MISSING:
+            return val is not _DELETED
+        return self._find(key) >= 0
+
+    def __setitem__(self, key, val):
+        self._check(key, val)
+        if key not in self:
+            self.length += 1
+        self.overlay[key] = val
+        self._maybe_merge()
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.length -= 1
+        if self._find(key) >= 0:
+            self.overlay[key] = _DELETED
+            self._maybe_merge()
+        else:
+            del self.overlay[key]
+
+    def __iter__(self):
+        for key, _ in self._merged_items():
+            yield key
+
+    def __len__(self):
+        return self.length
+
+    def get_many(self, keys, default=None) -> list:
+        """
+        Gets the values of many keys
+        :param keys: iterable of keys
+        :param default: value of the keys that don't exist
+        :return: list of values in the same order as the keys
+        """
+        return [self.get(key, default) for key in keys]
+
+    def memory_usage(self) -> dict:
+        """
+        Gets the memory used by the dictionary
+        :return: {"entries", "array_bytes", "overlay_bytes", "bytes", "bytes_per_entry"}
+        """
+        overlay_bytes = sys.getsizeof(self.overlay) + sum(sys.getsizeof(key) + sys.getsizeof(val)
+                                                          for key, val in self.overlay.items() if val is not _DELETED)
+        array_bytes = self._array_bytes()
+        total = array_bytes + overlay_bytes
+        return {"entries": self.length, "array_bytes": array_bytes, "overlay_bytes": overlay_bytes, "bytes": total,
+                "bytes_per_entry": total / self.length if self.length else 0.0}
+
+    def __repr__(self):
+        return repr(dict(self._merged_items()))
+
+
+class IntMap(SortedArrayMap):
+    """ int to int dictionary (signed 64 bits) of two sorted arrays: 16 bytes per entry """
+    MIN, MAX = -(1 << 63), (1 << 63) - 1
+
+    def _check(self, key, val):
+        if type(key) is not int or type(val) is not int:
+            raise TypeError(f"IntMap keeps int keys and values, not {type(key).__name__}: {type(val).__name__}")
+        if not (IntMap.MIN <= key <= IntMap.MAX and IntMap.MIN <= val <= IntMap.MAX):
+            raise TypeError(f"{key}: {val} doesn't fit in 64 bits")
+
+    def _find(self, key) -> int:
+        if type(key) is not int:
+            return -1
+        pos = bisect.bisect_left(self.keys, key)
+        if pos < len(self.keys) and self.keys[pos] == key:
+            return pos
+        return -1
+
+    def _key_at(self, pos):
+        return self.keys[pos]
+
+    def _value_at(self, pos):
+        return self.values[pos]
+
+    def _count(self) -> int:
+        return len(self.keys)
+
+    def _base_items(self):
+        return zip(self.keys, self.values)
+
+    def merge(self):
+        """ Writes the overlay into new arrays, copying the unchanged runs between changed keys at once """
+        if not self.overlay:
+            return
+        old_keys, old_values = self.keys, self.values
+        keys, values = array("q"), array("q")
+        start = 0
+        for key, val in sorted(self.overlay.items(), key=lambda item: item[0]):
+            pos = bisect.bisect_left(old_keys, key, start)
+            keys += old_keys[start:pos]
+            values += old_values[start:pos]
+            if val is not _DELETED:
+                keys.append(key)
+                values.append(val)
+            start = pos + 1 if pos < len(old_keys) and old_keys[pos] == key else pos
+        keys += old_keys[start:]
+        values += old_values[start:]
+        self.keys, self.values = keys, values
+        self.overlay = {}
+
+    def _build(self, items):
+        keys, values = array("q"), array("q")
+        for key, val in items:
+            keys.append(key)
+            values.append(val)
+        self.keys, self.values = keys, values
+
+    def _array_bytes(self) -> int:
+        return sys.getsizeof(self.keys) + sys.getsizeof(self.values)
+
+    def get_many(self, keys, default=None) -> list:
+        """
+        Gets the values of many keys, with one vectorized binary search of all of them when numpy is installed
+        :param keys: iterable of keys
+        :param default: value of the keys that don't exist
+        :return: list of values in the same order as the keys
+        """
+        keys = list(keys)
+        if numpy is None or not keys or not self.keys:
+            return super().get_many(keys, default)
+        try:
+            wanted = numpy.array(keys)
+        except OverflowError:
+            return super().get_many(keys, default)
+        if wanted.dtype.kind != "i" or wanted.ndim != 1:   # not only ints (bools, floats, big ints...)
+            return super().get_many(keys, default)
+        base_keys = numpy.frombuffer(self.keys, dtype=numpy.int64)
+        pos = numpy.minimum(numpy.searchsorted(base_keys, wanted), len(self.keys) - 1)
+        found = (base_keys[pos] == wanted).tolist()
+        vals = numpy.frombuffer(self.values, dtype=numpy.int64)[pos].tolist()
+        result = [val if is_found else default for val, is_found in zip(vals, found)]
+        if self.overlay:
+            for i, key in enumerate(keys):
+                val = self.overlay.get(key, _MISSING)
+                if val is not _MISSING:
+                    result[i] = default if val is _DELETED else val
+        return result
+
+
+class BytesMap(SortedArrayMap):
+    """
+    str to bytes dictionary: keys (utf-8) and values concatenated in two buffers with arrays of offsets, 16 bytes
+    per entry plus the bytes of key and value. utf-8 keeps the order of the code points so keys are searched as bytes
+    """
+    def _check(self, key, val):
+        if type(key) is not str or type(val) is not bytes:
+            raise TypeError(f"BytesMap keeps str keys and bytes values, not {type(key).__name__}: "
+                            f"{type(val).__name__}")
+
+    def _find_bytes(self, kbytes) -> int:
+        """ Gets the position of the utf-8 bytes of a key (-1 if it isn't there) """
+        offsets, data = self.key_offsets, self.key_data
+        lo, hi = 0, len(offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if data[offsets[mid]:offsets[mid + 1]] < kbytes:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(offsets) - 1 and data[offsets[lo]:offsets[lo + 1]] == kbytes:
+            return lo
+        return -1
+
+    def _find(self, key) -> int:
+        if type(key) is not str:
+            return -1
+        return self._find_bytes(key.encode())
+
+    def _key_at(self, pos):
+        return self.key_data[self.key_offsets[pos]:self.key_offsets[pos + 1]].decode()
+
+    def _value_at(self, pos):
+        return self.value_data[self.value_offsets[pos]:self.value_offsets[pos + 1]]
+
+    def _count(self) -> int:
+        return len(self.key_offsets) - 1
+
+    def _build(self, items):
+        key_data, value_data = bytearray(), bytearray()
+        key_offsets, value_offsets = array("Q", [0]), array("Q", [0])
+        for key, val in items:
+            key_data += key.encode()
+            value_data += val
+            key_offsets.append(len(key_data))
+            value_offsets.append(len(value_data))
+        self.key_data, self.value_data = bytes(key_data), bytes(value_data)
+        self.key_offsets, self.value_offsets = key_offsets, value_offsets
+
+    def _array_bytes(self) -> int:
+        return (sys.getsizeof(self.key_data) + sys.getsizeof(self.value_data) + sys.getsizeof(self.key_offsets)
+                + sys.getsizeof(self.value_offsets))
+
+
+if __name__ == "__main__":
+    ints = IntMap({n: n * 100 for n in range(1, 51)})
+    assert ints[40] == 4000 and len(ints) == 50
+    ints[60] = 1
+    del ints[40]
+    assert 40 not in ints and ints.get_many([60, 40, 1]) == [1, None, 100]
+    strs = BytesMap({"b": b"2", "a": b"1"})
+    strs["é"] = b"3"
+    assert list(strs) == ["a", "b", "é"] and strs["é"] == b"3"
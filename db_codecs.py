@@ -0,0 +1,181 @@
+"""
+Author: Tomas Dal Farra
+Date: 01/19/2023
+Description: Serializers (codecs) for the dictionary written in the database file. The codec id is kept in the file
+so readers decode it with the codec it was written with
+https://github.com/Kloke93/database_sync
+"""
+import itertools
+import marshal
+import pickle
+import struct
+import array
+import zlib
+import sys
+
+
+class PickleCodec:
+    """ pickle with the highest protocol, any picklable keys and values """
+    id = 0
+    name = "pickle"
+
+    @staticmethod
+    def encode(db) -> bytes:
+        return pickle.dumps(db, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def decode(data) -> dict:
+        return pickle.loads(data)
+
+
+class MarshalCodec:
+    """ marshal, only builtin types (int, float, str, bytes, tuple, list, dict, set...) but faster than pickle """
+    id = 1
+    name = "marshal"
+
+    @staticmethod
+    def encode(db) -> bytes:
+        return marshal.dumps(db)
+
+    @staticmethod
+    def decode(data) -> dict:
+        return marshal.loads(data)
+
+
+class BinaryCodec:
+    """
+    Compact length-prefixed format for str, bytes, int and None keys and values: the amount of keys and values, a
+    type tag for each of them, the length of each of their data and then their data (utf-8 for str, little endian
+    two's complement for int). Tags and lengths go in their own arrays so that they are packed and unpacked at once
+    """
+    id = 2
+    name = "binary"
+    COUNT = struct.Struct("<Q")             # amount of keys and values
+    INT, STR, BYTES, NONE = 0, 1, 2, 3
+
+    @staticmethod
+    def pack(objs) -> bytes:
+        """
+        Encodes a sequence of str, bytes, int and None
+        :param objs: iterable of objects
+        :return: encoded objects
+        """
+        tags, lengths, parts = bytearray(), array.array("I"), []
+        for obj in objs:
+            kind = type(obj)
+            if kind is str:
+                data = obj.encode()
+                tags.append(BinaryCodec.STR)
+            elif kind is bytes:
+                data = obj
+                tags.append(BinaryCodec.BYTES)
+            elif kind is int:
+                data = obj.to_bytes((obj.bit_length() + 8) // 8, "little", signed=True)
+                tags.append(BinaryCodec.INT)
+            elif obj is None:
+                data = b''
+                tags.append(BinaryCodec.NONE)
+            else:
+                raise TypeError(f"binary codec can't encode {kind.__name__}")
+            lengths.append(len(data))
+            parts.append(data)
+        if sys.byteorder == "big":
+            lengths.byteswap()
+        return b"".join([BinaryCodec.COUNT.pack(len(tags)), tags, lengths.tobytes(), *parts])
+
+    @staticmethod
+    def unpack(data) -> list:
+        """
+        Decodes what pack encoded (checking it, so it can come from other machines)
+        :param data: encoded objects (bytes-like)
+        :return: list of objects
+        """
+        count = BinaryCodec.COUNT.unpack_from(data)[0]
+        pos = BinaryCodec.COUNT.size
+        if pos + count * 5 > len(data):
+            raise ValueError("binary codec data is cut")
+        tags = data[pos:pos + count]
+        pos += count
+        lengths = array.array("I", data[pos:pos + count * 4])
+        if sys.byteorder == "big":
+            lengths.byteswap()
+        pos += count * 4
+        ends = list(itertools.accumulate(lengths, initial=pos))
+        if ends[-1] != len(data):
+            raise ValueError("binary codec data doesn't match its lengths")
+        objs = [data[begin:end] for begin, end in zip(ends, ends[1:])]
+        for i, kind in enumerate(tags):
+            if kind == BinaryCodec.STR:
+                objs[i] = str(objs[i], "utf-8")
+            elif kind == BinaryCodec.INT:
+                objs[i] = int.from_bytes(objs[i], "little", signed=True)
+            elif kind == BinaryCodec.NONE:
+                objs[i] = None
+            elif kind != BinaryCodec.BYTES:
+                raise ValueError(f"Unknown binary codec tag {kind}")
+            elif type(objs[i]) is not bytes:                    # slices of the bytearray read from file
+                objs[i] = bytes(objs[i])
+        return objs
+
+    @staticmethod
+    def encode(db) -> bytes:
+        return BinaryCodec.pack(itertools.chain.from_iterable(db.items()))
+
+    @staticmethod
+    def decode(data) -> dict:
+        objs = BinaryCodec.unpack(data)
+        return dict(zip(objs[::2], objs[1::2]))
+
+
+class CompressedCodec:
+    """ Other codec compressed with zlib """
+    FLAG = 0x80                             # set in the id of compressed codecs
+
+    def __init__(self, codec, level=6):
+        self.codec = codec
+        self.level = level
+        self.id = codec.id | CompressedCodec.FLAG
+        self.name = f"{codec.name}+zlib"
+
+    def encode(self, db) -> bytes:
+        return zlib.compress(self.codec.encode(db), self.level)
+
+    def decode(self, data) -> dict:
+        return self.codec.decode(zlib.decompress(data))
+
+
+BASE_CODECS = {codec.name: codec for codec in (PickleCodec, MarshalCodec, BinaryCodec)}
+
+
+def get_codec(name):
+    """
+    Gets a codec by name, "+zlib" at the end compresses it (like "marshal+zlib")
+    :param name: codec name
+    :return: codec
+    """
+    base, _, compression = name.partition("+")
+    if base not in BASE_CODECS or compression not in ("", "zlib"):
+        raise ValueError(f"Unknown codec {name}")
+    if compression:
+        return CompressedCodec(BASE_CODECS[base])
+    return BASE_CODECS[base]
+
+
+def codec_by_id(codec_id):
+    """
+    Gets the codec a file was written with
+    :param codec_id: id kept in the file
+    :return: codec
+    """
+    for codec in BASE_CODECS.values():
+        if codec.id == codec_id & ~CompressedCodec.FLAG:
+            return CompressedCodec(codec) if codec_id & CompressedCodec.FLAG else codec
+    raise ValueError(f"Unknown codec id {codec_id}")
+
+
+if __name__ == "__main__":
+    sample = {1: 100, -5: "a", "b": b"\x00", 2 ** 70: "", "c": None}
+    for codec_name in ("pickle", "marshal", "binary", "pickle+zlib", "marshal+zlib", "binary+zlib"):
+        sample_codec = get_codec(codec_name)
+        assert sample_codec.decode(sample_codec.encode(sample)) == sample
+        assert codec_by_id(sample_codec.id).name == codec_name
@@ -0,0 +1,299 @@
+"""
+Author: Tomas Dal Farra
+Date: 01/19/2023
+Description: Change feed of a database: every write appends (key, old value, new value) with a sequence number to
+file_name + ".feed", watchers tail it (no lock, no read of the database) and can resume from the last version seen
+https://github.com/Kloke93/database_sync
+"""
+from sync_backend import files
+from collections import namedtuple
+import threading
+import asyncio
+import logging
+import pickle
+import struct
+import time
+import zlib
+
+
+ChangeEvent = namedtuple("ChangeEvent", ["key", "old", "new", "version"])     # None for a key that didn't exist
+
+
+class ChangeFeed:
+    """
+    Append-only file of change records (sequence number, length, crc32 and the pickled (key, old, new)). Only
+    writers with the write lock of the database append. When the file gets bigger than FEED_BYTES it is rewritten
+    with its newest half (temporary file and rename), watchers that were behind that part get an error
+    """
+    RECORD = struct.Struct("<QII")          # sequence number (version), length and crc32 of the pickled change
+    FEED_BYTES = 4 << 20                    # size that makes the feed drop its oldest half
+
+    def __init__(self, file_name):
+        """
+        Initializer for the change feed of a database file
+        :param file_name: Name of file for the database (the feed is file_name + ".feed")
+        """
+        self.feed_name = file_name + ".feed"
+        self.version = 0                    # sequence number of the last change appended
+        self.size = 0                       # size of the feed after it
+        self.stamp = None                   # version stamp of the feed after it (a rewrite may keep the size)
+        self.appends = 0                    # appends of this process, wakes its watchers
+        self.changed = threading.Condition()
+        self.lock = threading.Lock()        # version, size and stamp (appends and new watches)
+
+    @staticmethod
+    def parse(data) -> tuple:
+        """
+        Decodes change records, stopping at an incomplete one (a write in progress)
+        :param data: feed content starting at a record
+        :return: (list of ChangeEvent, end of the last complete record, if a complete record was corrupted)
+        """
+        events = []
+        pos = 0
+        while pos + ChangeFeed.RECORD.size <= len(data):
+            version, length, crc = ChangeFeed.RECORD.unpack_from(data, pos)
+            start = pos + ChangeFeed.RECORD.size
+            record = data[start:start + length]
+            if len(record) < length:
+                break
+            if zlib.crc32(record) != crc:
+                return events, pos, True
+            events.append(ChangeEvent(*pickle.loads(record), version))
+            pos = start + length
+        return events, pos, False
+
+    def _file_stamp(self) -> tuple:
+        """ Gets the version stamp of the feed: size, last write time and last bytes (zeros if it doesn't exist) """
+        try:
+            return files.stamp(self.feed_name, ChangeFeed.RECORD.size)
+        except OSError:
+            return 0, 0, b''
+
+    def _read(self, offset=0) -> bytearray:
+        """ Reads the feed from an offset (nothing if it doesn't exist) """
+        try:
+            return files.read_from(self.feed_name, offset)
+        except OSError:
+            return bytearray()
+
+    def _follows(self, data, version) -> bool:
+        """
+        Checks if feed content read from an offset starts with the change after a version (and not in the middle of
+        a record of a rewritten feed)
+        :param data: feed content from the offset
+        :param version: version of the last change before the offset
+        :return: if the content follows it (True while the first record is not complete)
+        """
+        if len(data) < ChangeFeed.RECORD.size:
+            return True
+        return ChangeFeed.RECORD.unpack_from(data)[0] == version + 1
+
+    def _catch_up(self, repair=True):
+        """
+        Finds the last version and the size of the feed after appends (or a rewrite) of other processes
+        :param repair: cuts an incomplete record at the end, of a writer that crashed (only writers can tell it
+        from an append in progress)
+        """
+        stamp = self._file_stamp()
+        if stamp == self.stamp:
+            return
+        size = stamp[0]
+        if self.size and size > self.size:
+            data = self._read(self.size)
+            if self._follows(data, self.version):
+                events, end, corrupted = ChangeFeed.parse(data)
+                if not corrupted and (self.size + end == size or not repair):
+                    if events:
+                        self.version = events[-1].version
+                    self.stamp = stamp if self.size + end == size else None     # None: checked again next time
+                    self.size += end
+                    return
+        events, end, _ = ChangeFeed.parse(self._read())     # first append or rewritten feed: read it whole
+        if events:
+            self.version = events[-1].version
+        self.size = end
+        if end != size:                                     # incomplete record of a writer that crashed
+            if not repair:
+                self.stamp = None
+                return
+            files.truncate(self.feed_name, end)
+            stamp = self._file_stamp()
+        self.stamp = stamp
+
+    def append(self, changes) -> int:
+        """
+        Appends changes (the caller has the write lock of the database)
+        :param changes: list of (key, old value, new value)
+        :return: version of the last change
+        """
+        if not changes:
+            return self.version
+        with self.lock:
+            self._catch_up()
+            data = bytearray()
+            for change in changes:
+                record = pickle.dumps(tuple(change), pickle.HIGHEST_PROTOCOL)
+                self.version += 1
+                data += ChangeFeed.RECORD.pack(self.version, len(record), zlib.crc32(record))
+                data += record
+            self.size = files.append(self.feed_name, data)
+            if self.size > ChangeFeed.FEED_BYTES:
+                self._trim()
+            self.stamp = self._file_stamp()
+        with self.changed:
+            self.appends += 1
+            self.changed.notify_all()
+        return self.version
+
+    def _trim(self):
+        """ Rewrites the feed with its newest half """
+        data = self._read()
+        pos = 0
+        while pos < len(data) // 2:                         # first record of the newest half
+            _, length, _ = ChangeFeed.RECORD.unpack_from(data, pos)
+            pos += ChangeFeed.RECORD.size + length
+        files.write(self.feed_name + ".tmp", data[pos:], durable=True)
+        files.replace(self.feed_name + ".tmp", self.feed_name, durable=True)
+        self.size = len(data) - pos
+        logging.debug("Change feed trimmed to %s bytes", self.size)
+
+    def watch(self, keys=None, prefix=None, since=None):
+        """
+        Watches changes of keys
+        :param keys: iterable of keys (None for every key)
+        :param prefix: str or bytes that the keys start with (None for every key)
+        :param since: version of the last change seen (None from now on)
+        :return: Watch
+        """
+        return Watch(self, keys, prefix, since)
+
+
+class Watch:
+    """
+    Iterator (and async iterator) of the changes of some keys in order. Changes of other processes are seen when
+    the feed is checked again (every POLL_INTERVAL while waiting), the ones of this process at once
+    """
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, feed, keys=None, prefix=None, since=None):
+        """
+        Initializer for a watch of the feed
+        :param feed: ChangeFeed
+        :param keys: iterable of keys (None for every key)
+        :param prefix: str or bytes that the keys start with (None for every key)
+        :param since: version of the last change seen (None from now on)
+        """
+        self.feed = feed
+        self.keys = None if keys is None else set(keys)
+        self.prefix = prefix
+        self.version = since                # last change given (or skipped)
+        self.offset = None                  # end of that change in the feed (None until it is found)
+        self.stamp = None                   # version stamp of the feed when it was read
+        self.events = []                    # changes read but not given yet
+        self.closed = False
+        if since is None:                   # starts after the last change in the feed (read only since the last append)
+            with feed.lock:
+                feed._catch_up(repair=False)
+                self.version, self.offset, self.stamp = feed.version, feed.size, feed.stamp
+
+    def _wanted(self, key) -> bool:
+        """ Checks if a key is watched """
+        if self.keys is not None and key not in self.keys:
+            return False
+        if self.prefix is not None:
+            return type(key) is type(self.prefix) and key.startswith(self.prefix)
+        return True
+
+    def _poll(self):
+        """ Reads the changes appended since the last one given, raises ValueError if they were trimmed """
+        stamp = self.feed._file_stamp()
+        if self.offset is not None:
+            if stamp == self.stamp:                         # nothing appended or rewritten
+                return
+            if stamp[0] > self.offset:
+                data = self.feed._read(self.offset)
+                if self.feed._follows(data, self.version):
+                    events, end, corrupted = ChangeFeed.parse(data)
+                    if not corrupted:
+                        self._take(events, self.offset + end)
+                        self.stamp = stamp
+                        return
+        data = self.feed._read()                            # first poll or feed trimmed: find the version in it
+        events, end, _ = ChangeFeed.parse(data)
+        if events and events[0].version > self.version + 1:
+            raise ValueError(f"Changes after version {self.version} were trimmed from the feed")
+        self._take([event for event in events if event.version > self.version], end)
+        self.stamp = stamp
+
+    def _take(self, events, end):
+        """ Keeps the watched changes read up to an offset """
+        if events:
+            self.version = events[-1].version
+        self.offset = end
+        self.events.extend(event for event in events if self._wanted(event.key))
+
+    def next_event(self, timeout=None):
+        """
+        Gets the next change, waiting for it
+        :param timeout: seconds to wait (None without limit)
+        :return: ChangeEvent or None if there wasn't one in time or the watch was closed
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.closed:
+            appends = self.feed.appends
+            self._poll()
+            if self.events:
+                return self.events.pop(0)
+            wait = Watch.POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    return None
+            with self.feed.changed:
+                self.feed.changed.wait_for(lambda: self.feed.appends != appends or self.closed, wait)
+        return None
+
+    def close(self):
+        """ Stops the watch (iterations end) """
+        self.closed = True
+        with self.feed.changed:
+            self.feed.changed.notify_all()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> ChangeEvent:
+        event = self.next_event()
+        if event is None:
+            raise StopIteration
+        return event
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> ChangeEvent:
+        loop = asyncio.get_running_loop()
+        while not self.closed:
+            await loop.run_in_executor(None, self._poll)            # file reads don't block the event loop
+            if self.events:
+                return self.events.pop(0)
+            await asyncio.sleep(Watch.POLL_INTERVAL)
+        raise StopAsyncIteration
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == "__main__":
+    feed = ChangeFeed("testfile.bin")
+    try:
+        watch = feed.watch(prefix="a")
+        assert feed.append([("a1", None, 1), ("b", None, 2), ("a1", 1, 3)]) == 3
+        assert [tuple(watch.next_event(0)) for _ in range(2)] == [("a1", None, 1, 1), ("a1", 1, 3, 3)]
+        assert watch.next_event(0) is None
+        assert list(tuple(event) for event in [feed.watch(since=1).next_event(0)]) == [("b", None, 2, 2)]
+    finally:
+        files.delete(feed.feed_name)
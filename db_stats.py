@@ -0,0 +1,140 @@
+"""
+Author: Tomas Dal Farra
+Date: 01/19/2023
+Description: Counters and latency histograms of a database (lock waits, file I/O, encoding and decoding). Recording
+is a few additions, reports are made only when they are asked for
+https://github.com/Kloke93/database_sync
+"""
+import collections
+import threading
+
+
+class Histogram:
+    """ Latency histogram with power of two buckets in microseconds (bucket n has latencies below 2^n us) """
+    BUCKETS = 40
+
+    def __init__(self):
+        self.buckets = [0] * Histogram.BUCKETS
+        self.count = 0
+        self.total = 0.0                    # seconds
+        self.max = 0.0
+
+    def record(self, seconds):
+        """
+        Adds a latency
+        :param seconds: latency
+        """
+        self.buckets[min(int(seconds * 1e6).bit_length(), Histogram.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction) -> float:
+        """
+        Gets an upper bound of a percentile
+        :param fraction: percentile between 0 and 1 (0.99 for p99)
+        :return: seconds
+        """
+        target = fraction * self.count
+        seen = 0
+        for n, amount in enumerate(self.buckets):
+            seen += amount
+            if amount and seen >= target:
+                return min((1 << n) / 1e6, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        """
+        Gets the histogram as a dictionary
+        :return: count, total, mean, max, p50, p99 and p999 (seconds) and the buckets
+        """
+        return {"count": self.count, "total": self.total, "mean": self.total / self.count if self.count else 0.0,
+                "max": self.max, "p50": self.percentile(0.5), "p99": self.percentile(0.99),
+                "p999": self.percentile(0.999), "buckets_us": {1 << n: amount
+                                                              for n, amount in enumerate(self.buckets) if amount}}
+
+
+class Stats:
+    """
+    Counters and histograms of a database. Names used by the database:
+    histograms lock_read_wait, lock_write_wait, file_read, file_write, encode, decode
+    counters file_read_bytes, file_write_bytes, lock_timeouts, lock_abandoned
+    """
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram)
+        self.exporter = None                # thread that calls the export hook
+        self.stop = threading.Event()
+
+    def count(self, name, amount=1):
+        """
+        Adds to a counter
+        :param name: counter name
+        :param amount: what to add
+        """
+        self.counters[name] += amount
+
+    def time(self, name, seconds):
+        """
+        Adds a latency to a histogram
+        :param name: histogram name
+        :param seconds: latency
+        """
+        self.histograms[name].record(seconds)
+
+    def io(self, name, seconds, size):
+        """
+        Adds a file operation: its latency to a histogram and its bytes to the counter name_bytes
+        :param name: histogram name (file_read or file_write)
+        :param seconds: latency
+        :param size: bytes read or written
+        """
+        self.histograms[name].record(seconds)
+        self.counters[name + "_bytes"] += size
+
+    def snapshot(self) -> dict:
+        """
+        Gets every counter and histogram
+        :return: {"counters": {name: value}, "histograms": {name: summary}}
+        """
+        return {"counters": dict(self.counters),
+                "histograms": {name: histogram.summary() for name, histogram in list(self.histograms.items())}}
+
+    def reset(self):
+        """ Starts counting again """
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram)
+
+    def export(self, hook, interval=10.0):
+        """
+        Calls a hook with the snapshot every interval in a background thread (replaces the previous hook)
+        :param hook: function that gets the snapshot (like a metrics client)
+        :param interval: seconds between calls
+        """
+        self.stop_export()
+        self.stop = threading.Event()
+
+        def run(stop):
+            while not stop.wait(interval):
+                hook(self.snapshot())
+
+        self.exporter = threading.Thread(target=run, args=(self.stop,), name="stats_export", daemon=True)
+        self.exporter.start()
+
+    def stop_export(self):
+        """ Stops calling the export hook """
+        if self.exporter is not None:
+            self.stop.set()
+            self.exporter = None
+
+
+if __name__ == "__main__":
+    stats = Stats()
+    for latency in (0.000001, 0.00001, 0.0001, 0.001):
+        stats.time("test", latency)
+    stats.io("file_read", 0.001, 100)
+    report = stats.snapshot()
+    assert report["counters"]["file_read_bytes"] == 100
+    assert report["histograms"]["test"]["count"] == 4
+    assert report["histograms"]["test"]["p50"] <= 0.0001
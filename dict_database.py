@@ -2,14 +2,21 @@
 Copy from (same file name in repository):
 https://github.com/Kloke93/database_sync
 """
+from compact_maps import IntMap, BytesMap
+import bisect
+import sys
 
 
 class DataBase:
     """
     Simple dictionary database
     """
+    SCAN_PAGE = 256                         # entries read at once by scan and prefix
+    KEEP = object()                         # returned by the function of update to leave the value as it is
+
     def __init__(self):
         self.db = {}
+        self.index = None                   # keys sorted by key_order, built by the first scan
 
     def set_value(self, key, val):
         """
@@ -18,7 +25,10 @@ class DataBase:
         :param val: Value of the key
         """
         try:
+            new_key = self.index is not None and key not in self.db
             self.db[key] = val
+            if new_key:
+                bisect.insort(self.index, key, key=DataBase.key_order)
             return True
         except KeyError:
             return False
@@ -38,8 +48,174 @@ class DataBase:
         :param key: Key for a database value
         :return: Deleted value if existed
         """
+        if self.index is not None and key in self.db:
+            del self.index[bisect.bisect_left(self.index, DataBase.key_order(key), key=DataBase.key_order)]
         return self.db.pop(key, None)
 
+    def set_many(self, items) -> bool:
+        """
+        Sets many key:value to database
+        :param items: dictionary or iterable of (key, value)
+        :return: If the operation was successful
+        """
+        return all([self.set_value(key, val) for key, val in dict(items).items()])
+
+    def get_many(self, keys) -> list:
+        """
+        Gets the values of many keys (None for keys that don't exist)
+        :param keys: iterable of keys
+        :return: list of values in the same order as the keys
+        """
+        return [self.get_value(key) for key in keys]
+
+    def delete_many(self, keys) -> list:
+        """
+        Deletes many values from database
+        :param keys: iterable of keys
+        :return: list of deleted values (None for keys that didn't exist)
+        """
+        return [self.delete_value(key) for key in keys]
+
+    def update(self, key, func):
+        """
+        Sets the value of a key from its previous value
+        :param key: Key for the database
+        :param func: function that gets the previous value (None if it didn't exist) and returns the new one (or
+        KEEP to write nothing). Synchronized databases may call it again if the key changed meanwhile
+        :return: New value of the key
+        """
+        old = self.get_value(key)
+        val = func(old)
+        if val is DataBase.KEEP:
+            return old
+        self.set_value(key, val)
+        return val
+
+    def incr(self, key, delta=1):
+        """
+        Adds to the value of a key atomically (a key that doesn't exist counts as 0)
+        :param key: Key for the database
+        :param delta: amount to add
+        :return: New value of the key
+        """
+        return self.update(key, lambda val: (0 if val is None else val) + delta)
+
+    def compare_and_set(self, key, expected, new) -> bool:
+        """
+        Sets the value of a key atomically only if it is still the expected one
+        :param key: Key for the database
+        :param expected: value the key must have (None for a key that doesn't exist)
+        :param new: new value of the key
+        :return: If the value was set
+        """
+        swapped = [False]
+
+        def swap(val):
+            swapped[0] = val == expected                # the last call decides (update may call it again)
+            return new if swapped[0] else DataBase.KEEP
+        self.update(key, swap)
+        return swapped[0]
+
+    def setdefault(self, key, default):
+        """
+        Sets the value of a key atomically only if it doesn't exist
+        :param key: Key for the database
+        :param default: value for the key if it doesn't exist
+        :return: value of the key (default if it was set)
+        """
+        return self.update(key, lambda val: default if val is None else DataBase.KEEP)
+
+    @staticmethod
+    def key_order(key) -> tuple:
+        """
+        Gets the sort key of a database key: numbers first, then str, then bytes, then other types by name and repr
+        :param key: Key for the database
+        :return: sort key
+        """
+        if isinstance(key, (int, float)):
+            return 0, key
+        if isinstance(key, str):
+            return 1, key
+        if isinstance(key, bytes):
+            return 2, key
+        return 3, type(key).__name__, repr(key)
+
+    def _index_valid(self) -> bool:
+        """ Checks if the key index still has the keys of the dictionary """
+        return self.index is not None
+
+    def _scan_page(self, low, inclusive, high, limit) -> list:
+        """
+        Gets the entries of the next page of a scan
+        :param low: sort key where the page starts (None from the first key)
+        :param inclusive: if a key with sort key low is in the page
+        :param high: sort key where the scan ends, not included (None until the last key)
+        :param limit: maximum entries
+        :return: list of (key, value) in order
+        """
+        if not self._index_valid():
+            self.index = sorted(self.db, key=DataBase.key_order)
+        index = self.index
+        if low is None:
+            pos = 0
+        elif inclusive:
+            pos = bisect.bisect_left(index, low, key=DataBase.key_order)
+        else:
+            pos = bisect.bisect_right(index, low, key=DataBase.key_order)
+        page = []
+        for key in index[pos:pos + limit]:
+            if high is not None and DataBase.key_order(key) >= high:
+                break
+            page.append((key, self.db[key]))
+        return page
+
+    def _scan(self, low, high):
+        """ Yields (key, value) from sort key low (included) to high (not included), a page at a time """
+        inclusive = True
+        while True:
+            page = self._scan_page(low, inclusive, high, self.SCAN_PAGE)
+            yield from page
+            if len(page) < self.SCAN_PAGE:
+                return
+            low, inclusive = DataBase.key_order(page[-1][0]), False
+
+    def scan(self, start=None, end=None):
+        """
+        Iterates the entries with start <= key < end in key order (see key_order). Entries are read lazily a page
+        at a time, changes between pages are seen by the next pages
+        :param start: first key (None from the first key)
+        :param end: key where the scan stops, not included (None until the last key)
+        :return: iterator of (key, value)
+        """
+        return self._scan(None if start is None else DataBase.key_order(start),
+                          None if end is None else DataBase.key_order(end))
+
+    def prefix(self, prefix):
+        """
+        Iterates the entries whose key starts with a prefix in key order, lazily a page at a time
+        :param prefix: str or bytes (only keys of the same type)
+        :return: iterator of (key, value)
+        """
+        low = DataBase.key_order(prefix)
+        if low[0] not in (1, 2):
+            raise TypeError(f"prefix of {type(prefix).__name__} keys")
+        top = 0x10ffff if isinstance(prefix, str) else 0xff
+        end = prefix
+        while end and ord(end[-1:]) == top:
+            end = end[:-1]
+        if not end:                                             # every key of the type
+            return self._scan(low, (low[0] + 1,))
+        last = chr(ord(end[-1]) + 1) if isinstance(end, str) else bytes([end[-1] + 1])
+        return self._scan(low, DataBase.key_order(end[:-1] + last))
+
+    def memory_usage(self) -> dict:
+        """
+        Gets an estimate of the memory used by the dictionary and its keys and values (walks every entry)
+        :return: {"entries", "bytes", "bytes_per_entry"}
+        """
+        total = sys.getsizeof(self.db) + sum(sys.getsizeof(key) + sys.getsizeof(val) for key, val in self.db.items())
+        return {"entries": len(self.db), "bytes": total, "bytes_per_entry": total / len(self.db) if self.db else 0.0}
+
     def __repr__(self):
         """
         Prints dictionary database
@@ -48,6 +224,47 @@ class DataBase:
         return str(self.db)
 
 
+class CompactDataBase(DataBase):
+    """
+    Dictionary database for big homogeneous key spaces kept in sorted arrays: "int" (int to int) or "bytes"
+    (str to bytes). Setting other types raises TypeError
+    """
+    MAPS = {"int": IntMap, "bytes": BytesMap}
+
+    def __init__(self, kind="int"):
+        """
+        Initializer for the compact database
+        :param kind: "int" for int keys and values or "bytes" for str keys and bytes values
+        """
+        super().__init__()
+        self.db = CompactDataBase.MAPS[kind]()
+
+    def set_many(self, items) -> bool:
+        """
+        Sets many key:value to database, merged into the arrays at once
+        :param items: dictionary or iterable of (key, value)
+        :return: If the operation was successful
+        """
+        self.db.bulk_update(items)
+        self.index = None                   # the next scan sorts the keys again
+        return True
+
+    def get_many(self, keys) -> list:
+        """
+        Gets the values of many keys (None for keys that don't exist), a single vectorized search with numpy
+        :param keys: iterable of keys
+        :return: list of values in the same order as the keys
+        """
+        return self.db.get_many(keys)
+
+    def memory_usage(self) -> dict:
+        """
+        Gets the memory used by the arrays and the changes not merged yet
+        :return: {"entries", "array_bytes", "overlay_bytes", "bytes", "bytes_per_entry"}
+        """
+        return self.db.memory_usage()
+
+
 if __name__ == "__main__":
     dbase = DataBase()
     assert dbase.set_value('1', 'a')
@@ -56,3 +273,12 @@ if __name__ == "__main__":
     assert dbase.delete_value('2') is None
     assert dbase.delete_value('1') == 'a'
     assert repr(dbase) == '{}'
+    assert dbase.set_many({'1': 1, '2': 2})
+    assert dbase.update('1', lambda v: v + 1) == 2
+    assert dbase.get_many(['1', '2', '3']) == [2, 2, None]
+    assert dbase.delete_many(['1', '3']) == [2, None]
+    compact = CompactDataBase()
+    assert compact.set_many({n: n * 100 for n in range(1, 51)})
+    assert compact.get_many([1, 50, 51]) == [100, 5000, None]
+    assert compact.delete_value(1) == 100
+    assert compact.memory_usage()["entries"] == 49
@@ -0,0 +1,912 @@
+"""
+Author: Tomas Dal Farra
+Date: 01/19/2023
+Description: Storage engines that persist the dictionary of FileDataBase. The snapshot engine rewrites the whole
+pickled dictionary on every change, the log engine appends one record per change and checkpoints the changed keys
+into a delta file (compacted into a snapshot), the hash engine keeps a hash index and the values in a file mapped in
+memory and decodes only what is used
+https://github.com/Kloke93/database_sync
+"""
+from collections.abc import MutableMapping
+from db_codecs import get_codec, codec_by_id
+from db_stats import Stats
+from sync_backend import files
+import threading
+import hashlib
+import logging
+import pickle
+import struct
+import mmap
+import time
+import zlib
+
+
+class CorruptFileError(ValueError):
+    """ The database file is cut or its content doesn't match its checksum """
+
+
+class SnapshotStorage:
+    """
+    The file is the encoded dictionary followed by a footer with the codec, a generation counter, the length and
+    the crc32 of the encoded dictionary (plain pickle readers ignore it, a file without footer is a pickled
+    dictionary). Files are written to a temporary file renamed over the database file, so a writer that dies
+    leaves the previous file, and reading checks length and crc32 before decoding. The last decoded dictionary is
+    kept and only read again when the version stamp of the file changes.
+    """
+    FOOTER = struct.Struct("<4sB3xQQI")     # magic, codec id, generation, length and crc32 of the encoded dictionary
+    FOOTER_MAGIC = b"WDB2"
+    OLD_FOOTER = struct.Struct("<4sB3xQQ")  # footer without crc32 of files written before (still read)
+    OLD_FOOTER_MAGIC = b"WDB1"
+    SHARED = False                          # lock-free readers decode a copy of the whole file (read_all)
+
+    def __init__(self, file_name, codec="pickle", stats=None):
+        self.file_name = file_name
+        self.codec = get_codec(codec)       # codec to write with (reading uses the one in the file)
+        self.stats = stats if stats is not None else Stats()
+        self.generation = 0                 # write counter of the file, kept in the footer
+        self.stamp = None                   # version stamp of the file when the dictionary was loaded
+
+    def file_stamp(self) -> tuple:
+        """
+        Gets the version stamp of the file: size, last write time and generation (0 if the file has no footer)
+        :return: version stamp
+        """
+        size, last_write, tail = files.stamp(self.file_name, SnapshotStorage.FOOTER.size)
+        footer = SnapshotStorage.footer(tail, size)
+        return size, last_write, 0 if footer is None else footer[1]
+
+    @staticmethod
+    def footer(tail, size):
+        """
+        Finds the footer at the end of a file
+        :param tail: last bytes of the file (at least FOOTER.size if the file is that big)
+        :param size: size of the file
+        :return: (codec id, generation, length, crc32 or None for an old footer) or None if it has no footer
+        """
+        new, old = SnapshotStorage.FOOTER, SnapshotStorage.OLD_FOOTER
+        if len(tail) >= new.size:
+            magic, codec_id, generation, length, crc = new.unpack_from(tail, len(tail) - new.size)
+            if magic == SnapshotStorage.FOOTER_MAGIC and length + new.size == size:
+                return codec_id, generation, length, crc
+        if len(tail) >= old.size:
+            magic, codec_id, generation, length = old.unpack_from(tail, len(tail) - old.size)
+            if magic == SnapshotStorage.OLD_FOOTER_MAGIC and length + old.size == size:
+                return codec_id, generation, length, None
+        return None
+
+    @staticmethod
+    def decode(data) -> dict:
+        """
+        Checks the content of a file (length and crc32 in one pass) and decodes it with the codec in its footer
+        (the buffer read is decoded without copies)
+        :param data: file content as read (bytearray, the footer is cut from it)
+        :return: dictionary
+        """
+        footer = SnapshotStorage.footer(data, len(data))
+        if footer is None:                                          # pickled dictionary or a cut file
+            if not data.endswith(b"."):                             # every pickle ends with STOP
+                raise CorruptFileError(f"Database file of {len(data)} bytes is cut")
+            try:
+                return pickle.loads(data)
+            except Exception as err:
+                raise CorruptFileError(f"Database file can't be decoded: {err}") from err
+        codec_id, _, length, crc = footer
+        del data[length:]
+        if crc is not None and zlib.crc32(data) != crc:
+            raise CorruptFileError("Database file doesn't match its checksum")
+        return codec_by_id(codec_id).decode(data)
+
+    def read_file(self) -> dict:
+        """
+        Reads and decodes the whole file
+        :return: dictionary
+        """
+        start = time.perf_counter()
+        data = files.read(self.file_name)
+        read = time.perf_counter()
+        self.stats.io("file_read", read - start, len(data))
+        db = SnapshotStorage.decode(data)
+        self.stats.time("decode", time.perf_counter() - read)
+        return db
+
+    def is_current(self) -> bool:
+        """
+        Checks if the file is the same that was last loaded or written
+        :return: if the loaded dictionary is up to date
+        """
+        return self.stamp is not None and self.file_stamp() == self.stamp
+
+    def invalidate(self):
+        """ Forgets the loaded dictionary, next load reads the file again """
+        self.stamp = None
+
+    def open(self, db) -> dict:
+        """
+        Opens the database without reading it (the dictionary is decoded by the first load)
+        :param db: empty dictionary
+        :return: the same dictionary
+        """
+        return db
+
+    def load(self, db) -> dict:
+        """
+        Gets the dictionary in the file (only read if the file changed since it was last read)
+        :param db: dictionary loaded before
+        :return: up to date dictionary
+        """
+        stamp = self.file_stamp()
+        if stamp == self.stamp:
+            return db
+        db = self.read_file()
+        self.stamp = stamp
+        self.generation = stamp[2]
+        return db
+
+    def version(self) -> tuple:
+        """
+        Gets the version of the database
+        :return: version stamp of the file
+        """
+        return self.file_stamp()
+
+    def read_all(self) -> tuple:
+        """
+        Reads the file without changing the loaded state (a file renamed over it is never read half written)
+        :return: (version, dictionary) of what was read
+        """
+        stamp = self.file_stamp()
+        return stamp, self.read_file()
+
+    def write(self, db):
+        """
+        Writes the whole dictionary as the next generation of the file: a temporary file synced to disk and renamed
+        over the file, so the file is never half written (a failed write or a crash leaves the previous one)
+        :param db: dictionary to write
+        """
+        self.stamp = None                                           # db may not match the file until written
+        generation = self.generation + 1
+        start = time.perf_counter()
+        s_data = self.codec.encode(db)
+        encoded = time.perf_counter()
+        self.stats.time("encode", encoded - start)
+        footer = SnapshotStorage.FOOTER.pack(SnapshotStorage.FOOTER_MAGIC, self.codec.id, generation, len(s_data),
+                                             zlib.crc32(s_data))
+        files.write(self.file_name + ".tmp", s_data + footer, durable=True)
+        files.replace(self.file_name + ".tmp", self.file_name, durable=True)
+        self.stats.io("file_write", time.perf_counter() - encoded, len(s_data) + len(footer))
+        self.generation = generation
+        stamp = self.file_stamp()
+        if stamp[2] == generation:                                  # nobody wrote after us
+            self.stamp = stamp
+
+    def create(self):
+        """ Creates the file with an empty dictionary """
+        self.write({})
+
+    def save(self, db, records):
+        """
+        Persists changes of the dictionary
+        :param db: whole dictionary (already changed)
+        :param records: changes, (key, value) for set or (key,) for delete
+        """
+        self.write(db)
+
+    def sync(self):
+        """ Waits until saved changes are on disk """
+        files.sync(self.file_name)
+
+
+_DELETED = object()                         # mark of a deleted key (hash overlay and log changes)
+
+
+class LogStorage:
+    """
+    Snapshot file plus an append-only log (file_name + ".log") with one record per set/delete. Opening replays the
+    log over the snapshot, later reads only apply the records appended since. When the log gets bigger than
+    CHECKPOINT_BYTES it is checkpointed: the keys changed since the snapshot are written to a delta file
+    (file_name + ".delta", temporary file and rename) and the log starts again, so a checkpoint costs the changed
+    keys and not the whole dictionary. When the delta gets bigger than the snapshot everything is compacted into a
+    new snapshot. Snapshot, delta and log share one generation counter: the delta has the generation of the
+    snapshot it applies to and the log header the generation of the state it applies to (delta or snapshot), so
+    files left behind by a crash during a checkpoint or compaction are ignored.
+    """
+    HEADER = struct.Struct("<4sQ")          # magic, generation of the snapshot or delta the log applies to
+    HEADER_MAGIC = b"WDBL"
+    RECORD = struct.Struct("<II")           # length and crc32 of the pickled record
+    DELTA_FOOTER = struct.Struct("<4sQQQ")  # magic, generation of its snapshot, own generation, length of the data
+    DELTA_MAGIC = b"WDBD"
+    CHECKPOINT_BYTES = 1 << 20              # log size that starts a checkpoint
+    SHARED = False                          # lock-free readers decode a copy of the whole database (read_all)
+
+    def __init__(self, file_name, codec="pickle", stats=None):
+        self.snapshot = SnapshotStorage(file_name, codec, stats)
+        self.stats = self.snapshot.stats
+        self.log_name = file_name + ".log"
+        self.delta_name = file_name + ".delta"
+        self.log_offset = 0                 # end of the last record applied
+        self.log_size = 0                   # size of the log when it was last read
+        self.log_stale = False              # the log belongs to an old snapshot or delta
+        self.generation = 0                 # generation of the loaded state (snapshot or delta)
+        self.delta_stamp = None             # version stamp of the delta applied (None if there wasn't one)
+        self.delta_size = 0
+        self.changes = {}                   # key: value (or _DELETED) changed since the snapshot
+
+    def _log_file_size(self) -> int:
+        """ Gets the size of the log (0 if it doesn't exist) """
+        try:
+            return files.size(self.log_name)
+        except OSError:
+            return 0
+
+    def _delta_file_stamp(self):
+        """ Gets the version stamp of the delta (None if it doesn't exist) """
+        try:
+            return files.stamp(self.delta_name, LogStorage.DELTA_FOOTER.size)
+        except OSError:
+            return None
+
+    @staticmethod
+    def replay(db, data, offset, generation, changes=None) -> tuple:
+        """
+        Applies log records to the dictionary, stopping at the first incomplete or corrupted one
+        :param db: dictionary to update
+        :param data: log content starting at offset
+        :param offset: position of data in the log
+        :param generation: generation of the snapshot or delta db comes from
+        :param changes: dictionary of changed keys to update too (deleted ones as _DELETED)
+        :return: (updated dictionary, end of the last record applied, if the log belongs to other state)
+        """
+        pos = 0
+        if offset == 0:                                             # data starts with the log header
+            if len(data) < LogStorage.HEADER.size:
+                return db, 0, False
+            magic, log_generation = LogStorage.HEADER.unpack_from(data)
+            if magic != LogStorage.HEADER_MAGIC or log_generation != generation:
+                return db, 0, True
+            pos = LogStorage.HEADER.size
+        while pos + LogStorage.RECORD.size <= len(data):
+            length, crc = LogStorage.RECORD.unpack_from(data, pos)
+            start = pos + LogStorage.RECORD.size
+            record = data[start:start + length]
+            if len(record) < length or zlib.crc32(record) != crc:
+                logging.debug("Incomplete log record at %s", offset + pos)
+                break
+            record = pickle.loads(record)
+            if len(record) == 2:
+                db[record[0]] = record[1]
+            else:
+                db.pop(record[0], None)
+            if changes is not None:
+                changes[record[0]] = record[1] if len(record) == 2 else _DELETED
+            pos = start + length
+        return db, offset + pos, False
+
+    @staticmethod
+    def apply_delta(db, data, generation, changes=None):
+        """
+        Applies the content of a delta file to the dictionary if it belongs to its snapshot
+        :param db: dictionary to update
+        :param data: delta file content
+        :param generation: generation of the snapshot db comes from
+        :param changes: dictionary of changed keys to update too (deleted ones as _DELETED)
+        :return: generation of the delta or None if it belongs to other snapshot (nothing applied)
+        """
+        if len(data) < LogStorage.DELTA_FOOTER.size:
+            return None
+        magic, base, delta_generation, length = LogStorage.DELTA_FOOTER.unpack_from(data, len(data) -
+                                                                                     LogStorage.DELTA_FOOTER.size)
+        if magic != LogStorage.DELTA_MAGIC or base != generation or length + LogStorage.DELTA_FOOTER.size != len(data):
+            return None
+        with memoryview(data) as view, view[:length] as s_data:
+            sets, deletes = pickle.loads(s_data)
+        for key in deletes:
+            db.pop(key, None)
+        db.update(sets)
+        if changes is not None:
+            changes.update(dict.fromkeys(deletes, _DELETED))
+            changes.update(sets)
+        return delta_generation
+
+    def _load_delta(self, db, delta_stamp) -> dict:
+        """
+        Applies the delta over the snapshot loaded (the log is read again from its start)
+        :param db: dictionary of the snapshot
+        :param delta_stamp: version stamp of the delta
+        :return: updated dictionary
+        """
+        self.generation = self.snapshot.generation
+        self.delta_stamp = delta_stamp
+        self.delta_size = 0
+        self.log_offset = 0
+        self.log_stale = False
+        if delta_stamp is None:
+            return db
+        try:
+            data = files.read(self.delta_name)
+        except OSError:                                             # deleted by a compaction meanwhile
+            return db
+        generation = LogStorage.apply_delta(db, data, self.snapshot.generation, self.changes)
+        if generation is not None:
+            self.generation = generation
+            self.delta_size = len(data)
+        return db
+
+    def invalidate(self):
+        """ Forgets the loaded dictionary, next load reads snapshot, delta and log again """
+        self.snapshot.invalidate()
+
+    def open(self, db) -> dict:
+        """
+        Opens the database without reading it (snapshot, delta and log are read by the first load)
+        :param db: empty dictionary
+        :return: the same dictionary
+        """
+        return db
+
+    def _reload(self, delta_stamp) -> dict:
+        """ Reads snapshot and delta again """
+        self.snapshot.invalidate()                                  # the cached dictionary was changed by the log
+        db = self.snapshot.load({})
+        self.changes = {}
+        return self._load_delta(db, delta_stamp)
+
+    def load(self, db) -> dict:
+        """
+        Gets the dictionary of snapshot, delta and log, reading only what changed since the last load
+        :param db: dictionary loaded before
+        :return: up to date dictionary
+        """
+        log_size = self._log_file_size()
+        delta_stamp = self._delta_file_stamp()
+        if not self.snapshot.is_current():
+            db = self._reload(delta_stamp)
+        elif delta_stamp != self.delta_stamp:                       # checkpoint of other instance
+            generation = self.generation
+            db = self._load_delta(db, delta_stamp)
+            if self.generation == self.snapshot.generation != generation:
+                db = self._reload(delta_stamp)                      # the delta applied before can't be undone
+        elif self.log_stale or log_size < self.log_offset:
+            db = self._reload(delta_stamp)
+        if log_size > self.log_offset:
+            start = time.perf_counter()
+            data = files.read_from(self.log_name, self.log_offset)
+            read = time.perf_counter()
+            self.stats.io("file_read", read - start, len(data))
+            db, self.log_offset, self.log_stale = LogStorage.replay(db, data, self.log_offset, self.generation,
+                                                                    self.changes)
+            self.stats.time("decode", time.perf_counter() - read)
+        self.log_size = log_size
+        return db
+
+    def version(self) -> tuple:
+        """
+        Gets the version of the database: stamps of the snapshot and delta and size of the log
+        :return: version
+        """
+        return self.snapshot.file_stamp(), self._delta_file_stamp(), self._log_file_size()
+
+    def read_all(self) -> tuple:
+        """
+        Reads snapshot, delta and log without changing the loaded state. It is read again if the snapshot or delta
+        is replaced while reading (the files can't be read at once)
+        :return: (version, dictionary) of what was read
+        """
+        while True:
+            stamp = self.snapshot.file_stamp()
+            delta_stamp = self._delta_file_stamp()
+            db = self.snapshot.read_file()
+            generation = stamp[2]
+            try:
+                generation = LogStorage.apply_delta(db, files.read(self.delta_name), stamp[2]) or generation
+            except OSError:
+                pass
+            try:
+                data = files.read(self.log_name)
+            except OSError:
+                data = b''
+            db = LogStorage.replay(db, data, 0, generation)[0]
+            if self.snapshot.file_stamp() == stamp and self._delta_file_stamp() == delta_stamp:
+                return (stamp, delta_stamp, len(data)), db
+
+    def _reset_log(self):
+        """ Starts an empty log for the current snapshot or delta """
+        files.write(self.log_name, LogStorage.HEADER.pack(LogStorage.HEADER_MAGIC, self.generation))
+        self.log_offset = self.log_size = LogStorage.HEADER.size
+        self.log_stale = False
+
+    def checkpoint(self):
+        """ Writes the keys changed since the snapshot to the delta and starts the log again """
+        start = time.perf_counter()
+        sets = {key: val for key, val in self.changes.items() if val is not _DELETED}
+        deletes = [key for key, val in self.changes.items() if val is _DELETED]
+        s_data = pickle.dumps((sets, deletes))
+        encoded = time.perf_counter()
+        self.stats.time("encode", encoded - start)
+        generation = self.generation + 1
+        footer = LogStorage.DELTA_FOOTER.pack(LogStorage.DELTA_MAGIC, self.snapshot.generation, generation,
+                                              len(s_data))
+        files.write(self.delta_name + ".tmp", s_data + footer, durable=True)
+        files.replace(self.delta_name + ".tmp", self.delta_name, durable=True)
+        self.stats.io("file_write", time.perf_counter() - encoded, len(s_data) + len(footer))
+        self.generation = generation
+        self.delta_stamp = self._delta_file_stamp()
+        self.delta_size = len(s_data) + len(footer)
+        self._reset_log()
+
+    def compact(self, db):
+        """
+        Writes the dictionary as a new snapshot and starts the log again without delta
+        :param db: whole dictionary
+        """
+        self.snapshot.generation = max(self.snapshot.generation, self.generation)  # newer than any delta or log
+        self.snapshot.write(db)
+        self.generation = self.snapshot.generation
+        self.changes = {}
+        self.delta_size = 0
+        self.delta_stamp = None
+        if self._delta_file_stamp() is not None:
+            files.delete(self.delta_name)                           # a delta left by a crash is ignored anyway
+        self._reset_log()
+
+    def create(self):
+        """ Creates the snapshot with an empty dictionary and an empty log """
+        self.compact({})
+
+    def save(self, db, records):
+        """
+        Appends the changes to the log (in a single write), checkpointing or compacting it when it gets too big
+        :param db: whole dictionary (already changed)
+        :param records: changes, (key, value) for set or (key,) for delete
+        """
+        if self.log_stale or self.log_offset < LogStorage.HEADER.size:
+            self.compact(db)                                        # log of an old snapshot or without header
+            return
+        if self.log_size != self.log_offset:
+            files.truncate(self.log_name, self.log_offset)          # drops an incomplete record left by a crash
+        start = time.perf_counter()
+        data = bytearray()
+        for record in records:
+            s_record = pickle.dumps(record)
+            data += LogStorage.RECORD.pack(len(s_record), zlib.crc32(s_record))
+            data += s_record
+            self.changes[record[0]] = record[1] if len(record) == 2 else _DELETED
+        encoded = time.perf_counter()
+        self.stats.time("encode", encoded - start)
+        self.log_size = files.append(self.log_name, bytes(data))
+        self.stats.io("file_write", time.perf_counter() - encoded, len(data))
+        self.log_offset = self.log_size
+        if self.log_size > LogStorage.CHECKPOINT_BYTES:
+            if self.delta_size + self.log_size > (self.snapshot.stamp[0] if self.snapshot.stamp else 0):
+                self.compact(db)                                    # most of the dictionary changed
+            else:
+                self.checkpoint()
+
+    def sync(self):
+        """ Waits until saved changes (snapshot, delta and log) are on disk """
+        self.snapshot.sync()
+        if self.delta_stamp is not None:
+            files.sync(self.delta_name)
+        if self._log_file_size():
+            files.sync(self.log_name)
+
+
+class HashTable(MutableMapping):
+    """
+    Dictionary view of the hash file of a HashStorage. Lookups probe the index and decode only the value found,
+    changes stay in an overlay until the storage saves them
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.overlay = {}
+
+    def __getitem__(self, key):
+        val = self.overlay.get(key, self)
+        if val is _DELETED:
+            raise KeyError(key)
+        if val is not self:
+            return val
+        offset = self.storage.find(HashStorage.key_bytes(key))
+        if offset is None:
+            raise KeyError(key)
+        return self.storage.value_at(offset)
+
+    def __contains__(self, key):
+        if key in self.overlay:
+            return self.overlay[key] is not _DELETED
+        return self.storage.find(HashStorage.key_bytes(key)) is not None
+
+    def __setitem__(self, key, val):
+        self.overlay[key] = val
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.overlay[key] = _DELETED
+
+    def __iter__(self):
+        for key in self.storage.keys():
+            if key not in self.overlay:
+                yield key
+        for key, val in list(self.overlay.items()):
+            if val is not _DELETED:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class HashStorage:
+    """
+    The file has a fixed header, an open addressing (linear probing) index of slots and a heap of records, and it is
+    accessed through mmap: opening it reads only the header and get_value touches the slots probed and one record
+    (decoded from the mapping without copying it). Keys are compared pickled, so equal keys of different types
+    (1 and 1.0) are different keys here. Changes are appended to the heap and the slots updated in place; when the
+    index gets too full or the heap has too much garbage the whole file is rebuilt and renamed over the old one
+    (marked as retired so that other processes map the new file). The generation is odd while a save is changing
+    the file (seqlock), readers that don't lock check it to retry. Records are always pickled (no codec).
+    """
+    HEADER = struct.Struct("<4sIQQQQQQQ")   # magic, retired, generation, capacity, count, used slots, heap end,
+    HEADER_MAGIC = b"WDBH"                  # live bytes, reserved
+    SLOT = struct.Struct("<QQ")             # key hash, record offset (0 empty, 1 deleted)
+    RECORD = struct.Struct("<II")           # key length, value length
+    EMPTY, DELETED = 0, 1
+    MIN_CAPACITY = 1024                     # slots
+    MAX_LOAD = 0.7                          # used slots (deleted included) that force a rebuild
+    READ_RETRIES = 10                       # lock-free reads tried while saves change the file
+    SHARED = True                           # lock-free readers read values from the mapping (read_values)
+    PICKLE_PROTOCOL = 4                     # fixed so that the same key is always the same bytes
+
+    def __init__(self, file_name, codec="pickle", stats=None):
+        self.file_name = file_name
+        self.codec = get_codec(codec)       # only checked, records are pickled
+        self.stats = stats if stats is not None else Stats()
+        self.file = None
+        self.mm = None
+        self.capacity = 0
+        self.table = HashTable(self)
+        self.lock = threading.RLock()       # mapping the file again (rebuilds and growth take it too)
+
+    @staticmethod
+    def key_bytes(key) -> bytes:
+        """ Gets the bytes that represent a key in the file """
+        return pickle.dumps(key, HashStorage.PICKLE_PROTOCOL)
+
+    @staticmethod
+    def key_hash(kbytes) -> int:
+        """ Gets the hash of a key in the file (the same in every process, unlike hash()) """
+        return int.from_bytes(hashlib.blake2b(kbytes, digest_size=8).digest(), "little")
+
+    def _header(self) -> list:
+        """ Gets the fields of the header """
+        return list(HashStorage.HEADER.unpack_from(self.mm))
+
+    def _open(self):
+        """ Maps the file (a new mapping if it was already mapped) """
+        f = open(self.file_name, "r+b")
+        mm = mmap.mmap(f.fileno(), 0)
+        if mm[:4] != HashStorage.HEADER_MAGIC:
+            mm.close()
+            f.close()
+            raise ValueError(f"{self.file_name} is not a hash database file")
+        self.file, self.mm = f, mm                              # the old mapping is closed when it isn't used
+        self.capacity = self._header()[3]
+
+    def _close(self):
+        """ Unmaps and closes the file (win32 can't resize or replace a file this process has mapped) """
+        if self.mm is None:
+            return
+        mm, f, self.mm, self.file = self.mm, self.file, None, None
+        try:
+            mm.close()
+        except BufferError:                                     # a lock-free reader still uses it, closed by gc
+            logging.debug("Mapping of %s in use, not closed", self.file_name)
+        f.close()
+
+    def _current(self):
+        """ Maps the file again if it was rebuilt or grew in other process """
+        with self.lock:
+            if self.mm is None:
+                try:
+                    self._open()
+                except ValueError:                              # pickled dictionary of the other engines
+                    self._rebuild(SnapshotStorage(self.file_name).read_all()[1].items())
+                    logging.debug("%s converted to hash database file", self.file_name)
+                return
+            header = self._header()
+            if header[1] or header[6] > len(self.mm):           # retired or heap beyond the mapping
+                self._open()
+
+    def open(self, db):
+        """
+        Maps the file reading only its header (the index and values are read from the mapping when used). Called
+        with the write lock: an odd generation is of a writer that died during a save, the counts of the header
+        may not match the index then, so the file is rebuilt from the records of the index that are valid
+        :param db: empty dictionary
+        :return: dictionary view
+        """
+        self._current()
+        header = self._header()
+        if header[2] % 2 and not header[1]:
+            logging.warning("%s: save that didn't finish (generation %s)", self.file_name, header[2])
+            self._rebuild(self._valid_items(), header[2], encoded=True)
+        return self.table
+
+    def load(self, db):
+        """
+        Gets the dictionary view of the file
+        :param db: view loaded before
+        :return: dictionary view
+        """
+        self._current()
+        return self.table
+
+    def invalidate(self):
+        """ Drops the changes that were not saved """
+        self.table.overlay = {}
+
+    def find(self, kbytes, mm=None, capacity=None):
+        """
+        Looks for a key in the index
+        :param kbytes: bytes of the key
+        :param mm: mapping to look in (the current one if None)
+        :param capacity: slots of the index of that mapping
+        :return: offset of its record or None if it doesn't exist
+        """
+        if mm is None:
+            mm, capacity = self.mm, self.capacity
+        mask = capacity - 1
+        key_hash = HashStorage.key_hash(kbytes)
+        i = key_hash & mask
+        while True:
+            slot_hash, offset = HashStorage.SLOT.unpack_from(mm, HashStorage.HEADER.size + i * HashStorage.SLOT.size)
+            if offset == HashStorage.EMPTY:
+                return None
+            if offset != HashStorage.DELETED and slot_hash == key_hash:
+                klen = HashStorage.RECORD.unpack_from(mm, offset)[0]
+                start = offset + HashStorage.RECORD.size
+                if mm[start:start + klen] == kbytes:
+                    return offset
+            i = (i + 1) & mask
+
+    def value_at(self, offset, mm=None):
+        """
+        Decodes the value of a record straight from the mapping
+        :param offset: offset of the record
+        :param mm: mapping of the record (the current one if None)
+        :return: value
+        """
+        mm = self.mm if mm is None else mm
+        klen, vlen = HashStorage.RECORD.unpack_from(mm, offset)
+        start = offset + HashStorage.RECORD.size + klen
+        decode_start = time.perf_counter()
+        with memoryview(mm) as view, view[start:start + vlen] as value:
+            val = pickle.loads(value)
+        self.stats.time("decode", time.perf_counter() - decode_start)
+        return val
+
+    def _raw_items(self):
+        """ Yields (key bytes, value bytes) of every record in the index """
+        mm = self.mm
+        for i in range(self.capacity):
+            offset = HashStorage.SLOT.unpack_from(mm, HashStorage.HEADER.size + i * HashStorage.SLOT.size)[1]
+            if offset > HashStorage.DELETED:
+                klen, vlen = HashStorage.RECORD.unpack_from(mm, offset)
+                start = offset + HashStorage.RECORD.size
+                yield mm[start:start + klen], mm[start + klen:start + klen + vlen]
+
+    def _valid_items(self):
+        """ Yields (key bytes, value bytes) of the records of the index that are in the file and match their slot """
+        mm = self.mm
+        heap_start = HashStorage.HEADER.size + self.capacity * HashStorage.SLOT.size
+        for i in range(self.capacity):
+            slot_hash, offset = HashStorage.SLOT.unpack_from(mm, HashStorage.HEADER.size + i * HashStorage.SLOT.size)
+            if offset <= HashStorage.DELETED:
+                continue
+            if heap_start <= offset <= len(mm) - HashStorage.RECORD.size:
+                klen, vlen = HashStorage.RECORD.unpack_from(mm, offset)
+                start = offset + HashStorage.RECORD.size
+                kbytes = mm[start:start + klen]
+                if start + klen + vlen <= len(mm) and HashStorage.key_hash(kbytes) == slot_hash:
+                    yield kbytes, mm[start + klen:start + klen + vlen]
+                    continue
+            logging.warning("%s: record at %s dropped", self.file_name, offset)
+
+    def keys(self):
+        """ Yields every key in the file """
+        for kbytes, _ in self._raw_items():
+            yield pickle.loads(kbytes)
+
+    def _rebuild(self, items, generation=0, encoded=False):
+        """
+        Writes a new file (temporary file renamed over the database file) with a compact heap
+        :param items: (key, value) pairs
+        :param generation: generation of the file that is replaced
+        :param encoded: items are already (key bytes, pickled value)
+        """
+        if encoded:
+            records = list(items)
+        else:
+            records = [(HashStorage.key_bytes(key), pickle.dumps(val)) for key, val in items]
+        capacity = HashStorage.MIN_CAPACITY
+        while len(records) > capacity // 2:
+            capacity *= 2
+        mask = capacity - 1
+        index = bytearray(capacity * HashStorage.SLOT.size)
+        heap = bytearray()
+        heap_start = HashStorage.HEADER.size + len(index)
+        for kbytes, vbytes in records:
+            key_hash = HashStorage.key_hash(kbytes)
+            i = key_hash & mask
+            while HashStorage.SLOT.unpack_from(index, i * HashStorage.SLOT.size)[1]:
+                i = (i + 1) & mask
+            HashStorage.SLOT.pack_into(index, i * HashStorage.SLOT.size, key_hash, heap_start + len(heap))
+            heap += HashStorage.RECORD.pack(len(kbytes), len(vbytes)) + kbytes + vbytes
+        header = HashStorage.HEADER.pack(HashStorage.HEADER_MAGIC, 0, (generation | 1) + 1, capacity, len(records),
+                                         len(records), heap_start + len(heap), len(heap), 0)
+        spare = bytes(max(len(heap) // 2, 1 << 16))            # free heap space for the next records
+        start = time.perf_counter()
+        files.write(self.file_name + ".tmp", header + index + heap + spare, durable=True)
+        with self.lock:
+            old = self.mm
+            if old is not None:                                 # processes that map the old file open the new one
+                self._retire(old, 1)
+                self._close()
+            try:
+                files.replace(self.file_name + ".tmp", self.file_name, durable=True)
+            except Exception:
+                if old is not None:                             # the old file is still the database
+                    self._open()
+                    self._retire(self.mm, 0)
+                raise
+            self._open()
+        self.stats.io("file_write", time.perf_counter() - start, len(header) + len(index) + len(heap) + len(spare))
+
+    @staticmethod
+    def _retire(mm, retired):
+        """
+        Sets the retired flag in the header of a mapping
+        :param mm: mapping of the file
+        :param retired: 1 if the file was replaced by a new one, 0 if not
+        """
+        HashStorage.HEADER.pack_into(mm, 0, *([HashStorage.HEADER_MAGIC, retired] +
+                                              list(HashStorage.HEADER.unpack_from(mm))[2:]))
+
+    def create(self):
+        """ Creates the file with an empty index """
+        self._rebuild([])
+
+    def _append(self, header, kbytes, vbytes) -> int:
+        """
+        Appends a record to the heap, growing the file if it doesn't fit, and writes the new heap end to the header
+        before any slot points to the record (a save that doesn't finish never leaves records after the heap end)
+        :param header: header fields (heap end is updated)
+        :return: offset of the record
+        """
+        record = HashStorage.RECORD.pack(len(kbytes), len(vbytes)) + kbytes + vbytes
+        offset = header[6]
+        if offset + len(record) > len(self.mm):
+            size = max(len(self.mm) * 2, offset + len(record))
+            with self.lock:
+                self._close()                                   # mapped files can't be resized on win32
+                files.truncate(self.file_name, size)
+                self._open()
+        self.mm[offset:offset + len(record)] = record
+        header[6] = offset + len(record)
+        HashStorage.HEADER.pack_into(self.mm, 0, *header)
+        return offset
+
+    def _put(self, header, kbytes, vbytes):
+        """
+        Sets a record in the index
+        :param header: header fields (counts are updated)
+        :param kbytes: bytes of the key
+        :param vbytes: bytes of the value or None to delete the key
+        """
+        mm, mask = self.mm, self.capacity - 1
+        key_hash = HashStorage.key_hash(kbytes)
+        i = key_hash & mask
+        free = None                                             # first deleted slot, reused for new keys
+        while True:
+            pos = HashStorage.HEADER.size + i * HashStorage.SLOT.size
+            slot_hash, offset = HashStorage.SLOT.unpack_from(mm, pos)
+            if offset == HashStorage.EMPTY:
+                break
+            if offset == HashStorage.DELETED:
+                free = pos if free is None else free
+            elif slot_hash == key_hash:
+                klen, vlen = HashStorage.RECORD.unpack_from(mm, offset)
+                start = offset + HashStorage.RECORD.size
+                if mm[start:start + klen] == kbytes:            # key exists
+                    header[7] -= HashStorage.RECORD.size + klen + vlen
+                    if vbytes is None:
+                        HashStorage.SLOT.pack_into(mm, pos, 0, HashStorage.DELETED)
+                        header[4] -= 1
+                    else:
+                        offset = self._append(header, kbytes, vbytes)
+                        HashStorage.SLOT.pack_into(self.mm, pos, key_hash, offset)
+                        header[7] += HashStorage.RECORD.size + len(kbytes) + len(vbytes)
+                    return
+            i = (i + 1) & mask
+        if vbytes is None:
+            return
+        if free is None:
+            free = pos
+            header[5] += 1
+        offset = self._append(header, kbytes, vbytes)
+        HashStorage.SLOT.pack_into(self.mm, free, key_hash, offset)
+        header[4] += 1
+        header[7] += HashStorage.RECORD.size + len(kbytes) + len(vbytes)
+
+    def save(self, db, records):
+        """
+        Writes the changes of the overlay to the file
+        :param db: dictionary view (its overlay has the changes)
+        :param records: changes, (key, value) for set or (key,) for delete
+        """
+        self._current()
+        overlay, self.table.overlay = self.table.overlay, {}
+        header = self._header()
+        heap_size = header[6] - HashStorage.HEADER.size - self.capacity * HashStorage.SLOT.size
+        if (header[5] + len(overlay) > self.capacity * HashStorage.MAX_LOAD
+                or heap_size > 2 * header[7] + (1 << 20)):     # index too full or too much garbage in the heap
+            items = dict(self._raw_items())
+            for key, val in overlay.items():
+                if val is _DELETED:
+                    items.pop(HashStorage.key_bytes(key), None)
+                else:
+                    items[HashStorage.key_bytes(key)] = pickle.dumps(val)
+            self._rebuild(items.items(), header[2], encoded=True)
+            return
+        header[2] |= 1                                          # odd while changing
+        HashStorage.HEADER.pack_into(self.mm, 0, *header)
+        try:
+            for key, val in overlay.items():
+                self._put(header, HashStorage.key_bytes(key), None if val is _DELETED else pickle.dumps(val))
+        finally:
+            header[2] += 1
+            HashStorage.HEADER.pack_into(self.mm, 0, *header)
+
+    def sync(self):
+        """ Waits until saved changes of the mapped file are on disk """
+        self._current()
+        self.mm.flush()
+
+    def version(self) -> int:
+        """
+        Gets the version of the database
+        :return: generation of the file
+        """
+        self._current()
+        return self._header()[2]
+
+    def read_values(self, keys):
+        """
+        Reads values straight from the mapping (the same memory in every process that maps the file) without
+        locking, again if a save changed the file meanwhile (seqlock)
+        :param keys: list of keys
+        :return: list of values (None for keys that don't exist) or None if saves kept changing the file
+        """
+        kbytes = [HashStorage.key_bytes(key) for key in keys]
+        for _ in range(HashStorage.READ_RETRIES):
+            self._current()
+            mm = self.mm                                        # the same mapping for the whole read
+            try:
+                header = HashStorage.HEADER.unpack_from(mm)
+                if header[2] % 2 == 0 and not header[1]:
+                    vals = []
+                    for k in kbytes:
+                        offset = self.find(k, mm, header[3])
+                        vals.append(None if offset is None else self.value_at(offset, mm))
+                    after = HashStorage.HEADER.unpack_from(mm)
+                    if after[2] == header[2] and not after[1]:
+                        return vals
+            except Exception as err:                            # records changed or mapping closed while reading
+                logging.debug("Hash value read retried: %s", err)
+            time.sleep(0)                                       # lets the writer finish
+        return None
+
+
+ENGINES = {"snapshot": SnapshotStorage, "log": LogStorage, "hash": HashStorage}
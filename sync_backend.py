@@ -0,0 +1,1013 @@
+"""
+Author: Tomas Dal Farra
+Date: 01/19/2023
+Description: Synchronization and file primitives used by the databases. Objects are created through a backend that
+is either win32 (win32event/win32file), threading (in-process) or POSIX (fcntl byte range locks between processes)
+https://github.com/Kloke93/database_sync
+"""
+import threading
+import tempfile
+import mmap
+import errno
+import time
+import sys
+import os
+try:
+    from win32event import CreateMutex, CreateSemaphore, ReleaseMutex, ReleaseSemaphore
+    from win32event import CreateEvent, SetEvent, ResetEvent
+    from win32event import WaitForSingleObject, WAIT_ABANDONED, WAIT_OBJECT_0, WAIT_TIMEOUT
+    from win32file import GENERIC_READ, GENERIC_WRITE, FILE_SHARE_READ, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL
+    from win32file import CREATE_ALWAYS, CreateFile, ReadFile, WriteFile, DeleteFile, GetFileAttributesEx
+    from win32file import CloseHandle, GetFileSize, GetFileTime, SetFilePointer, SetEndOfFile, MoveFileEx
+    from win32file import FILE_BEGIN, FILE_END, OPEN_ALWAYS, MOVEFILE_REPLACE_EXISTING, FILE_SHARE_WRITE
+    from win32file import FILE_SHARE_DELETE, FILE_CURRENT, FlushFileBuffers, MOVEFILE_WRITE_THROUGH
+    SHARE_ALL = FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE    # readers never stop writers or renames
+    HAS_WIN32 = True
+except ImportError:
+    # same values as in the win32 headers so callers can compare wait results the same way
+    WAIT_OBJECT_0 = 0x00000000
+    WAIT_ABANDONED = 0x00000080
+    WAIT_TIMEOUT = 0x00000102
+    HAS_WIN32 = False
+if sys.platform != "win32":
+    import fcntl
+
+
+# ---------------------------------------------------------------- win32 backend
+
+class Win32Mutex:
+    """ Named win32 mutex """
+    def __init__(self, name):
+        self.handle = CreateMutex(None,                                 # default security attributes
+                                  False,                                # initially not owned
+                                  name)                                 # mutex name
+
+    def wait(self, timeout):
+        """
+        Waits for the mutex
+        :param timeout: milliseconds to wait
+        :return: wait result (WAIT_OBJECT_0, WAIT_ABANDONED or WAIT_TIMEOUT)
+        """
+        return WaitForSingleObject(self.handle, timeout)
+
+    def release(self):
+        """ Releases the mutex """
+        ReleaseMutex(self.handle)
+
+
+class Win32Semaphore:
+    """ Named win32 semaphore """
+    def __init__(self, name, count):
+        self.handle = CreateSemaphore(None,                             # default security attributes
+                                      count,                            # initial count
+                                      count,                            # maximum count
+                                      name)                             # semaphore name
+
+    def wait(self, timeout):
+        """
+        Reduces semaphore counter by one and blocks if it is zero
+        :param timeout: milliseconds to wait
+        :return: wait result
+        """
+        return WaitForSingleObject(self.handle, timeout)
+
+    def release(self, count=1):
+        """
+        Increases semaphore counter
+        :param count: amount to increase
+        """
+        ReleaseSemaphore(self.handle, count)
+
+
+class Win32Event:
+    """ Named win32 manual-reset event (initially signaled) """
+    def __init__(self, name):
+        self.handle = CreateEvent(None,                                 # default security attributes
+                                  True,                                 # manual-reset event
+                                  True,                                 # initial state is signaled
+                                  name)                                 # event name
+
+    def wait(self, timeout):
+        """
+        Waits until the event is signaled
+        :param timeout: milliseconds to wait
+        :return: wait result
+        """
+        return WaitForSingleObject(self.handle, timeout)
+
+    def set(self):
+        """ Signals the event """
+        SetEvent(self.handle)
+
+    def reset(self):
+        """ Resets the event to non signaled """
+        ResetEvent(self.handle)
+
+
+class Win32RWLock:
+    """
+    Named reader-writer lock with writer preference made of win32 objects. Readers go through a turnstile mutex that
+    a waiting writer keeps, the first reader takes the room_empty semaphore and the last one gives it back (the count
+    of readers is in named shared memory). A writer needs only the turnstile and room_empty, whatever the amount of
+    reader slots is.
+    """
+    def __init__(self, name, readers):
+        self.turnstile = Win32Mutex(f"{name}_turnstile")
+        self.room_empty = Win32Semaphore(f"{name}_room_empty", 1)
+        self.counter_lock = Win32Mutex(f"{name}_counter")
+        self.counter = mmap.mmap(-1, 4, tagname=f"{name}_readers")     # shared by every process, starts as 0
+        self.slots = Win32Semaphore(f"{name}_slots", readers)
+
+    def _add_reader(self, delta) -> int:
+        """ Changes the count of readers (with counter_lock held) and returns it """
+        count = int.from_bytes(self.counter[:4], "little") + delta
+        self.counter[:4] = count.to_bytes(4, "little")
+        return count
+
+    def acquire_read(self, timeout):
+        """
+        Takes the lock for reading
+        :param timeout: milliseconds to wait for every object
+        :return: wait result
+        """
+        w = self.turnstile.wait(timeout)                            # waits for writers first
+        if w != WAIT_OBJECT_0:
+            return w
+        self.turnstile.release()
+        w = self.slots.wait(timeout)                                # limits the amount of readers
+        if w != WAIT_OBJECT_0:
+            return w
+        w = self.counter_lock.wait(timeout)
+        if w != WAIT_OBJECT_0:
+            self.slots.release()
+            return w
+        try:
+            if self._add_reader(1) == 1:                            # first reader locks writers out
+                w = self.room_empty.wait(timeout)
+                if w != WAIT_OBJECT_0:
+                    self._add_reader(-1)
+                    self.slots.release()
+        finally:
+            self.counter_lock.release()
+        return w
+
+    def release_read(self):
+        """ Releases the lock taken for reading """
+        self.counter_lock.wait(100000)
+        try:
+            if self._add_reader(-1) == 0:                           # last reader lets writers in
+                self.room_empty.release()
+        finally:
+            self.counter_lock.release()
+        self.slots.release()
+
+    def acquire_write(self, timeout):
+        """
+        Takes the lock for writing (exclusive)
+        :param timeout: milliseconds to wait for every object
+        :return: wait result
+        """
+        w = self.turnstile.wait(timeout)                            # new readers wait from now on
+        if w != WAIT_OBJECT_0:
+            return w
+        w = self.room_empty.wait(timeout)                           # waits readers inside to leave
+        if w != WAIT_OBJECT_0:
+            self.turnstile.release()
+        return w
+
+    def release_write(self):
+        """ Releases the lock taken for writing """
+        self.room_empty.release()
+        self.turnstile.release()
+
+
+class Win32Backend:
+    """ Named kernel objects, shared by every process of the session """
+    name = "win32"
+
+    @staticmethod
+    def create_mutex(name):
+        return Win32Mutex(name)
+
+    @staticmethod
+    def create_semaphore(name, count):
+        return Win32Semaphore(name, count)
+
+    @staticmethod
+    def create_event(name):
+        return Win32Event(name)
+
+    @staticmethod
+    def create_rwlock(name, readers):
+        return Win32RWLock(name, readers)
+
+
+# ---------------------------------------------------------------- threading backend
+
+class ThreadMutex:
+    """ In-process mutex (re-entrant for the owner thread like a win32 mutex) """
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.RLock()
+
+    def wait(self, timeout):
+        """
+        Waits for the mutex
+        :param timeout: milliseconds to wait
+        :return: wait result
+        """
+        return WAIT_OBJECT_0 if self.lock.acquire(timeout=timeout / 1000) else WAIT_TIMEOUT
+
+    def release(self):
+        """ Releases the mutex """
+        self.lock.release()
+
+
+class ThreadSemaphore:
+    """ In-process counting semaphore """
+    def __init__(self, name, count):
+        self.name = name
+        self.semaphore = threading.Semaphore(count)
+
+    def wait(self, timeout):
+        """
+        Reduces semaphore counter by one and blocks if it is zero
+        :param timeout: milliseconds to wait
+        :return: wait result
+        """
+        return WAIT_OBJECT_0 if self.semaphore.acquire(timeout=timeout / 1000) else WAIT_TIMEOUT
+
+    def release(self, count=1):
+        """
+        Increases semaphore counter
+        :param count: amount to increase
+        """
+        self.semaphore.release(count)
+
+
+class ThreadEvent:
+    """ In-process manual-reset event (initially signaled) """
+    def __init__(self, name):
+        self.name = name
+        self.event = threading.Event()
+        self.event.set()
+
+    def wait(self, timeout):
+        """
+        Waits until the event is signaled
+        :param timeout: milliseconds to wait
+        :return: wait result
+        """
+        return WAIT_OBJECT_0 if self.event.wait(timeout / 1000) else WAIT_TIMEOUT
+
+    def set(self):
+        """ Signals the event """
+        self.event.set()
+
+    def reset(self):
+        """ Resets the event to non signaled """
+        self.event.clear()
+
+
+class ThreadRWLock:
+    """ In-process reader-writer lock with writer preference: new readers wait while a writer is waiting """
+    def __init__(self, name, readers):
+        self.name = name
+        self.bound = readers                    # maximum readers at the same time
+        self.readers = 0
+        self.writing = False
+        self.waiting_writers = 0
+        self.condition = threading.Condition(threading.Lock())
+
+    def acquire_read(self, timeout):
+        """
+        Takes the lock for reading
+        :param timeout: milliseconds to wait
+        :return: wait result
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: not (self.writing or self.waiting_writers)
+                                           and self.readers < self.bound, timeout / 1000):
+                return WAIT_TIMEOUT
+            self.readers += 1
+        return WAIT_OBJECT_0
+
+    def release_read(self):
+        """ Releases the lock taken for reading """
+        with self.condition:
+            self.readers -= 1
+            self.condition.notify_all()
+
+    def acquire_write(self, timeout):
+        """
+        Takes the lock for writing (exclusive)
+        :param timeout: milliseconds to wait
+        :return: wait result
+        """
+        with self.condition:
+            self.waiting_writers += 1
+            try:
+                if not self.condition.wait_for(lambda: not (self.writing or self.readers), timeout / 1000):
+                    return WAIT_TIMEOUT
+            finally:
+                self.waiting_writers -= 1
+            self.writing = True
+        return WAIT_OBJECT_0
+
+    def release_write(self):
+        """ Releases the lock taken for writing """
+        with self.condition:
+            self.writing = False
+            self.condition.notify_all()
+
+
+class _NamedObjects:
+    """ Process wide registry so that objects with the same name are the same object (like named kernel objects) """
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.RLock()                   # objects may get other named objects when created
+
+    def get(self, kind, name, *args):
+        """
+        Gets the object with that name, creating it the first time
+        :param kind: class of the object
+        :param name: object name
+        :param args: extra arguments for the constructor
+        :return: shared object
+        """
+        with self.lock:
+            obj = self.objects.get((kind, name))
+            if obj is None:
+                obj = kind(name, *args)
+                self.objects[(kind, name)] = obj
+            return obj
+
+
+class ThreadBackend:
+    """ threading primitives, the cheapest option when only threads of one process share the database """
+    name = "threading"
+    objects = _NamedObjects()
+
+    @staticmethod
+    def create_mutex(name):
+        return ThreadBackend.objects.get(ThreadMutex, name)
+
+    @staticmethod
+    def create_semaphore(name, count):
+        return ThreadBackend.objects.get(ThreadSemaphore, name, count)
+
+    @staticmethod
+    def create_event(name):
+        return ThreadBackend.objects.get(ThreadEvent, name)
+
+    @staticmethod
+    def create_rwlock(name, readers):
+        return ThreadBackend.objects.get(ThreadRWLock, name, readers)
+
+
+# ---------------------------------------------------------------- POSIX backend
+
+def _poll(attempt, timeout):
+    """
+    Retries a non-blocking attempt with exponential backoff (fcntl locks can't wait with a timeout)
+    :param attempt: function that returns True when it succeeds
+    :param timeout: milliseconds to keep trying
+    :return: wait result
+    """
+    if attempt():
+        return WAIT_OBJECT_0
+    deadline = time.monotonic() + timeout / 1000
+    delay = 0.00005                                             # starts at 50 microseconds
+    while time.monotonic() < deadline:
+        time.sleep(delay)
+        if attempt():
+            return WAIT_OBJECT_0
+        delay = min(delay * 2, 0.005)                           # up to 5 milliseconds
+    return WAIT_TIMEOUT
+
+
+class _LockFile:
+    """ Byte range locks (fcntl) over a lock file in the temp directory, visible to every process """
+    # Closing any descriptor of a file drops every fcntl lock the process has on it, so descriptors are never closed
+    descriptors = {}
+
+    def __init__(self, name):
+        path = os.path.join(tempfile.gettempdir(), f"{name}.lock")
+        fd = _LockFile.descriptors.get(path)
+        if fd is None:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            _LockFile.descriptors[path] = fd
+        self.fd = fd
+
+    def try_lock(self, offset, exclusive=True, length=1) -> bool:
+        """
+        Tries to lock one byte (or a range) without blocking
+        :param offset: byte to lock
+        :param exclusive: exclusive (write) lock or shared (read) lock
+        :param length: bytes to lock (0 for every byte from offset on)
+        :return: if the lock was taken
+        """
+        try:
+            fcntl.lockf(self.fd, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB, length, offset)
+            return True
+        except OSError as err:
+            if err.errno in (errno.EACCES, errno.EAGAIN):
+                return False
+            raise
+
+    def unlock(self, offset, length=1):
+        """
+        Unlocks one byte (or a range)
+        :param offset: byte to unlock
+        :param length: bytes to unlock (0 for every byte from offset on)
+        """
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, length, offset)
+
+
+class PosixMutex:
+    """ Cross-process mutex: exclusive lock on the first byte of the lock file """
+    def __init__(self, name):
+        self.name = name
+        self.file = _LockFile(name)
+
+    def wait(self, timeout):
+        """
+        Waits for the mutex
+        :param timeout: milliseconds to wait
+        :return: wait result
+        """
+        return _poll(lambda: self.file.try_lock(0), timeout)
+
+    def release(self):
+        """ Releases the mutex """
+        self.file.unlock(0)
+
+
+class PosixSemaphore:
+    """ Cross-process semaphore: every unit is one byte of the lock file that can be locked by a single holder """
+    def __init__(self, name, count):
+        self.name = name
+        self.count = count
+        self.file = _LockFile(name)
+        self.held = set()                   # bytes held by this process (fcntl can't tell own locks apart)
+        self.next = os.getpid() % count     # byte tried first, processes start apart so the first try usually works
+        self.lock = threading.Lock()
+
+    def _try_acquire(self) -> bool:
+        """ Tries to lock any byte not already held by this process, from the one after the last taken """
+        with self.lock:
+            for i in range(self.count):
+                offset = (self.next + i) % self.count
+                if offset not in self.held and self.file.try_lock(offset):
+                    self.held.add(offset)
+                    self.next = (offset + 1) % self.count
+                    return True
+            return False
+
+    def wait(self, timeout):
+        """
+        Reduces semaphore counter by one and blocks if it is zero
+        :param timeout: milliseconds to wait
+        :return: wait result
+        """
+        return _poll(self._try_acquire, timeout)
+
+    def release(self, count=1):
+        """
+        Increases semaphore counter (only units held by this process can be released)
+        :param count: amount to increase
+        """
+        with self.lock:
+            for _ in range(count):
+                offset = self.held.pop()
+                self.file.unlock(offset)
+                self.next = offset                  # free for the next wait of this process
+
+
+class PosixEvent:
+    """
+    Cross-process manual-reset event (initially signaled). The process that resets it keeps an exclusive lock until
+    it sets it again, waiting means being able to take a shared lock. Only the resetting process can set it back.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.file = _LockFile(name)
+        self.owned = False
+
+    def _try_pass(self) -> bool:
+        """ Tries to get through the event, a shared lock is taken and dropped right away """
+        if self.owned:                      # own locks never block this process, it must wait for itself
+            return False
+        if self.file.try_lock(0, exclusive=False):
+            self.file.unlock(0)
+            return True
+        return False
+
+    def wait(self, timeout):
+        """
+        Waits until the event is signaled
+        :param timeout: milliseconds to wait
+        :return: wait result
+        """
+        return _poll(self._try_pass, timeout)
+
+    def set(self):
+        """ Signals the event """
+        if self.owned:
+            self.owned = False
+            self.file.unlock(0)
+
+    def reset(self):
+        """ Resets the event to non signaled (waits for readers that are just passing through) """
+        if not self.owned:
+            if _poll(lambda: self.file.try_lock(0), 100000) != WAIT_OBJECT_0:
+                raise TimeoutError(f"Could not reset event {self.name}")
+            self.owned = True
+
+
+class PosixRWLock:
+    """
+    Cross-process reader-writer lock with writer preference. Byte 0 of the lock file is a turnstile that a writer
+    keeps locked, bytes 1 to readers are reader slots: every reader locks one of them and the writer locks all of
+    them (a single lock from byte 1 on), so it waits for the readers inside and the readers of every process
+    together are bounded. The writer that has the turnstile sets the first byte of the lock file (mapped in
+    memory), and only then readers pass through the turnstile, otherwise they just lock a slot (a writer that dies
+    leaves it set: readers take the turnstile until the next writer). Threads of the same process are ordered by a
+    ThreadRWLock first because fcntl locks belong to the process.
+    """
+    def __init__(self, name, readers):
+        self.name = name
+        self.count = readers
+        self.file = _LockFile(name)
+        if os.fstat(self.file.fd).st_size < 1:
+            os.ftruncate(self.file.fd, 1)
+        self.waiting = mmap.mmap(self.file.fd, 1)   # first byte is 1 while a writer has the turnstile
+        self.local = ThreadRWLock(name, readers)
+        self.held = set()                           # slots locked by readers of this process
+        self.next = os.getpid() % readers           # slot tried first, processes start apart
+        self.lock = threading.Lock()
+
+    def _try_pass(self) -> bool:
+        """ Tries to lock a free reader slot, getting through the turnstile first if a writer is waiting """
+        if self.waiting[0]:
+            if not self.file.try_lock(0, exclusive=False):
+                return False
+            self.file.unlock(0)
+        with self.lock:
+            for i in range(self.count):
+                slot = (self.next + i) % self.count
+                if slot not in self.held and self.file.try_lock(1 + slot):     # own locks never fail
+                    self.held.add(slot)
+                    self.next = (slot + 1) % self.count
+                    return True
+            return False
+
+    def acquire_read(self, timeout):
+        """
+        Takes the lock for reading
+        :param timeout: milliseconds to wait
+        :return: wait result
+        """
+        w = self.local.acquire_read(timeout)
+        if w != WAIT_OBJECT_0:
+            return w
+        w = _poll(self._try_pass, timeout)
+        if w != WAIT_OBJECT_0:
+            self.local.release_read()
+        return w
+
+    def release_read(self):
+        """ Releases the lock taken for reading """
+        with self.lock:
+            slot = self.held.pop()
+            self.file.unlock(1 + slot)
+            self.next = slot                                    # free for the next reader of this process
+        self.local.release_read()
+
+    def acquire_write(self, timeout):
+        """
+        Takes the lock for writing (exclusive)
+        :param timeout: milliseconds to wait
+        :return: wait result
+        """
+        w = self.local.acquire_write(timeout)
+        if w != WAIT_OBJECT_0:
+            return w
+        w = _poll(lambda: self.file.try_lock(0), timeout)
+        if w == WAIT_OBJECT_0:
+            self.waiting[0] = 1                                 # new readers wait from now on
+            w = _poll(lambda: self.file.try_lock(1, length=0), timeout)    # waits readers inside to leave
+            if w != WAIT_OBJECT_0:
+                self.waiting[0] = 0
+                self.file.unlock(0)
+        if w != WAIT_OBJECT_0:
+            self.local.release_write()
+        return w
+
+    def release_write(self):
+        """ Releases the lock taken for writing """
+        self.waiting[0] = 0
+        self.file.unlock(1, length=0)
+        self.file.unlock(0)
+        self.local.release_write()
+
+
+class PosixBackend:
+    """ fcntl byte range locks over files in the temp directory, shared by every process of the machine """
+    name = "posix"
+    objects = _NamedObjects()
+
+    @staticmethod
+    def create_mutex(name):
+        return PosixBackend.objects.get(PosixMutex, name)
+
+    @staticmethod
+    def create_semaphore(name, count):
+        return PosixBackend.objects.get(PosixSemaphore, name, count)
+
+    @staticmethod
+    def create_event(name):
+        return PosixBackend.objects.get(PosixEvent, name)
+
+    @staticmethod
+    def create_rwlock(name, readers):
+        return PosixBackend.objects.get(PosixRWLock, name, readers)
+
+
+def get_backend(mode):
+    """
+    Picks the cheapest backend for the mode
+    :param mode: 1 (threading) or 0 (multiprocessing)
+    :return: backend class
+    """
+    if mode:
+        return ThreadBackend
+    if HAS_WIN32:
+        return Win32Backend
+    return PosixBackend
+
+
+# ---------------------------------------------------------------- file access
+
+class Win32Files:
+    """ File access through win32file """
+    @staticmethod
+    def size(file_name) -> int:
+        """
+        Gets the size of a file
+        :param file_name: file name
+        :return: size in bytes
+        """
+        return GetFileAttributesEx(file_name)[4]
+
+    @staticmethod
+    def stamp(file_name, tail) -> tuple:
+        """
+        Cheap version stamp of a file: size, last write time and its last bytes
+        :param file_name: file name
+        :param tail: amount of bytes to read from the end of the file
+        :return: (size, last write time, last bytes)
+        """
+        fhandle = 0
+        try:
+            fhandle = CreateFile(file_name,                                            # file name
+                                 GENERIC_READ,                                          # read access
+                                 SHARE_ALL,                                             # share to every request
+                                 None,                                                  # default security
+                                 OPEN_EXISTING,                                         # opens existing files only
+                                 FILE_ATTRIBUTE_NORMAL,                                 # normal file
+                                 None)                                                  # no attr. template
+            size = GetFileSize(fhandle)
+            last_write = GetFileTime(fhandle)[2]
+            if size < tail:
+                return size, last_write, b''
+            SetFilePointer(fhandle, size - tail, FILE_BEGIN)
+            return size, last_write, ReadFile(fhandle, tail)[1]
+        finally:
+            CloseHandle(fhandle)
+
+    @staticmethod
+    def _read_rest(fhandle) -> bytearray:
+        """
+        Reads an open file from its position until its end with one ReadFile into a buffer of the size of the file
+        :param fhandle: file handle
+        :return: file content after the position
+        """
+        position = SetFilePointer(fhandle, 0, FILE_CURRENT)
+        size = max(GetFileSize(fhandle) - position, 0)
+        buffer = bytearray(size)
+        done = 0
+        with memoryview(buffer) as view:
+            while done < size:                                                  # ReadFile may read less
+                read = len(ReadFile(fhandle, view[done:])[1])                   # slice of what was read
+                if not read:                                                    # file was cut meanwhile
+                    break
+                done += read
+        del buffer[done:]
+        read = ReadFile(fhandle, 1 << 16)[1]                                    # file grown meanwhile
+        while read:
+            buffer += read
+            read = ReadFile(fhandle, 1 << 16)[1]
+        return buffer
+
+    @staticmethod
+    def read(file_name) -> bytearray:
+        """
+        Reads the whole file
+        :param file_name: file name
+        :return: file content
+        """
+        fhandle = 0
+        try:
+            fhandle = CreateFile(file_name,                                            # file name
+                                 GENERIC_READ,                                          # read access
+                                 SHARE_ALL,                                             # share to every request
+                                 None,                                                  # default security
+                                 OPEN_EXISTING,                                         # opens existing files only
+                                 FILE_ATTRIBUTE_NORMAL,                                 # normal file
+                                 None)                                                  # no attr. template
+            return Win32Files._read_rest(fhandle)
+        finally:
+            CloseHandle(fhandle)
+
+    @staticmethod
+    def write(file_name, data, durable=False):
+        """
+        Replaces the file content
+        :param file_name: file name
+        :param data: bytes to write
+        :param durable: waits until the content is on disk (a file about to be renamed over another one)
+        """
+        fhandle = 0                                                         # just making fhandle exist
+        try:
+            fhandle = CreateFile(file_name,                                 # file name
+                                 GENERIC_WRITE,                             # write access
+                                 FILE_SHARE_READ | FILE_SHARE_DELETE,       # lock-free readers and renames
+                                 None,                                      # default security
+                                 CREATE_ALWAYS,                             # always creates a new file
+                                 FILE_ATTRIBUTE_NORMAL,                     # normal file
+                                 None)                                      # no attr. template
+            WriteFile(fhandle, data)
+            if durable:
+                FlushFileBuffers(fhandle)
+        finally:
+            CloseHandle(fhandle)
+
+    @staticmethod
+    def read_from(file_name, offset) -> bytearray:
+        """
+        Reads a file from an offset until its end
+        :param file_name: file name
+        :param offset: first byte to read
+        :return: file content after the offset
+        """
+        fhandle = 0
+        try:
+            fhandle = CreateFile(file_name, GENERIC_READ, SHARE_ALL, None, OPEN_EXISTING,
+                                 FILE_ATTRIBUTE_NORMAL, None)
+            SetFilePointer(fhandle, offset, FILE_BEGIN)
+            return Win32Files._read_rest(fhandle)
+        finally:
+            CloseHandle(fhandle)
+
+    @staticmethod
+    def append(file_name, data) -> int:
+        """
+        Appends data at the end of a file (created if it doesn't exist)
+        :param file_name: file name
+        :param data: bytes to append
+        :return: new size of the file
+        """
+        fhandle = 0
+        try:
+            fhandle = CreateFile(file_name,                                 # file name
+                                 GENERIC_WRITE,                             # write access
+                                 FILE_SHARE_READ | FILE_SHARE_DELETE,       # lock-free readers and renames
+                                 None,                                      # default security
+                                 OPEN_ALWAYS,                               # opens or creates the file
+                                 FILE_ATTRIBUTE_NORMAL,                     # normal file
+                                 None)                                      # no attr. template
+            size = SetFilePointer(fhandle, 0, FILE_END)
+            WriteFile(fhandle, data)
+            return size + len(data)
+        finally:
+            CloseHandle(fhandle)
+
+    @staticmethod
+    def truncate(file_name, size):
+        """
+        Cuts a file to a size
+        :param file_name: file name
+        :param size: new size in bytes
+        """
+        fhandle = 0
+        try:
+            fhandle = CreateFile(file_name, GENERIC_WRITE, SHARE_ALL, None, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL,
+                                 None)                          # other processes may have it open (or mapped)
+            SetFilePointer(fhandle, size, FILE_BEGIN)
+            SetEndOfFile(fhandle)
+        finally:
+            CloseHandle(fhandle)
+
+    @staticmethod
+    def sync(file_name):
+        """
+        Waits until the content of a file is on disk (not only in the system cache)
+        :param file_name: file name
+        """
+        fhandle = 0
+        try:
+            fhandle = CreateFile(file_name, GENERIC_WRITE, SHARE_ALL, None, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, None)
+            FlushFileBuffers(fhandle)
+        finally:
+            CloseHandle(fhandle)
+
+    @staticmethod
+    def replace(src, dst, durable=False):
+        """
+        Renames a file over another one in a single step
+        :param src: file to rename
+        :param dst: file to replace
+        :param durable: waits until the rename is on disk
+        """
+        MoveFileEx(src, dst, MOVEFILE_REPLACE_EXISTING | (MOVEFILE_WRITE_THROUGH if durable else 0))
+
+    @staticmethod
+    def delete(file_name):
+        """
+        Deletes a file
+        :param file_name: file name
+        """
+        DeleteFile(file_name)
+
+
+class PosixFiles:
+    """ File access through the os module """
+    @staticmethod
+    def size(file_name) -> int:
+        """
+        Gets the size of a file
+        :param file_name: file name
+        :return: size in bytes
+        """
+        return os.stat(file_name).st_size
+
+    @staticmethod
+    def stamp(file_name, tail) -> tuple:
+        """
+        Cheap version stamp of a file: size, last write time and its last bytes
+        :param file_name: file name
+        :param tail: amount of bytes to read from the end of the file
+        :return: (size, last write time, last bytes)
+        """
+        fd = os.open(file_name, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            st = os.fstat(fd)
+            if st.st_size < tail:
+                return st.st_size, st.st_mtime_ns, b''
+            os.lseek(fd, st.st_size - tail, os.SEEK_SET)
+            return st.st_size, st.st_mtime_ns, os.read(fd, tail)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _read_rest(f) -> bytearray:
+        """
+        Reads an open file from its position until its end into a buffer of the size of the file (readinto)
+        :param f: file opened without buffering
+        :return: file content after the position
+        """
+        size = max(os.fstat(f.fileno()).st_size - f.tell(), 0)
+        buffer = bytearray(size)
+        done = 0
+        with memoryview(buffer) as view:
+            while done < size:                                  # readinto may read less
+                read = f.readinto(view[done:])
+                if not read:                                    # file was cut meanwhile
+                    break
+                done += read
+        del buffer[done:]
+        buffer += f.read()                                      # file grown meanwhile (usually nothing)
+        return buffer
+
+    @staticmethod
+    def read(file_name) -> bytearray:
+        """
+        Reads the whole file
+        :param file_name: file name
+        :return: file content
+        """
+        with open(file_name, "rb", buffering=0) as f:
+            return PosixFiles._read_rest(f)
+
+    @staticmethod
+    def write(file_name, data, durable=False):
+        """
+        Replaces the file content
+        :param file_name: file name
+        :param data: bytes to write
+        :param durable: waits until the content is on disk (a file about to be renamed over another one)
+        """
+        with open(file_name, "wb") as f:
+            f.write(data)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+
+    @staticmethod
+    def read_from(file_name, offset) -> bytearray:
+        """
+        Reads a file from an offset until its end
+        :param file_name: file name
+        :param offset: first byte to read
+        :return: file content after the offset
+        """
+        with open(file_name, "rb", buffering=0) as f:
+            f.seek(offset)
+            return PosixFiles._read_rest(f)
+
+    @staticmethod
+    def append(file_name, data) -> int:
+        """
+        Appends data at the end of a file (created if it doesn't exist)
+        :param file_name: file name
+        :param data: bytes to append
+        :return: new size of the file
+        """
+        with open(file_name, "ab") as f:
+            f.write(data)
+            return f.tell()
+
+    @staticmethod
+    def truncate(file_name, size):
+        """
+        Cuts a file to a size
+        :param file_name: file name
+        :param size: new size in bytes
+        """
+        os.truncate(file_name, size)
+
+    @staticmethod
+    def sync(file_name):
+        """
+        Waits until the content of a file is on disk (not only in the system cache)
+        :param file_name: file name
+        """
+        fd = os.open(file_name, os.O_RDWR | getattr(os, "O_BINARY", 0))
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def replace(src, dst, durable=False):
+        """
+        Renames a file over another one in a single step
+        :param src: file to rename
+        :param dst: file to replace
+        :param durable: waits until the rename is on disk (syncs the directory)
+        """
+        os.replace(src, dst)
+        if durable and hasattr(os, "O_DIRECTORY"):             # directories can't be opened on every system
+            fd = os.open(os.path.dirname(os.path.abspath(dst)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def delete(file_name):
+        """
+        Deletes a file
+        :param file_name: file name
+        """
+        os.remove(file_name)
+
+
+files = Win32Files if HAS_WIN32 else PosixFiles
+
+
+if __name__ == "__main__":
+    for backend in (ThreadBackend, get_backend(0)):
+        mutex = backend.create_mutex("backend_test_mutex")
+        assert mutex.wait(1000) == WAIT_OBJECT_0
+        mutex.release()
+        semaphore = backend.create_semaphore("backend_test_semaphore", 2)
+        assert semaphore.wait(1000) == WAIT_OBJECT_0
+        assert semaphore.wait(1000) == WAIT_OBJECT_0
+        assert semaphore.wait(10) == WAIT_TIMEOUT
+        semaphore.release(2)
+        event = backend.create_event("backend_test_event")
+        assert event.wait(1000) == WAIT_OBJECT_0
+        event.reset()
+        assert event.wait(10) == WAIT_TIMEOUT
+        event.set()
+        assert event.wait(1000) == WAIT_OBJECT_0
+        rwlock = backend.create_rwlock("backend_test_rwlock", 2)
+        assert rwlock.acquire_read(1000) == WAIT_OBJECT_0
+        assert rwlock.acquire_read(1000) == WAIT_OBJECT_0
+        assert rwlock.acquire_read(10) == WAIT_TIMEOUT
+        rwlock.release_read()
+        rwlock.release_read()
+        assert rwlock.acquire_write(1000) == WAIT_OBJECT_0
+        rwlock.release_write()
@@ -0,0 +1,283 @@
+"""
+Author: Tomas Dal Farra
+Date: 01/19/2023
+Description: asyncio front-end for the synchronized database. Coroutines wait for the lock in the event loop and
+only the file work (and the lock of other processes) goes to a bounded pool of threads
+https://github.com/Kloke93/database_sync
+"""
+from winAPI_sync_database import SyncDataBase
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import asyncio
+import os
+
+
+class AsyncRWLock:
+    """
+    Reader-writer lock for coroutines. Waiters enter in arrival order (new readers wait behind a waiting writer),
+    only the ones that can enter are woken
+    """
+    def __init__(self, readers):
+        self.bound = readers                    # maximum readers at the same time
+        self.readers = 0
+        self.writing = False
+        self.waiters = collections.deque()      # (is writer, future) in arrival order
+
+    def _can_enter(self, write) -> bool:
+        """ Checks if a reader or writer can take the lock now """
+        if write:
+            return not (self.writing or self.readers)
+        return not self.writing and self.readers < self.bound
+
+    def _enter(self, write):
+        """ Takes the lock for a reader or writer that can enter """
+        if write:
+            self.writing = True
+        else:
+            self.readers += 1
+
+    def _wake(self):
+        """ Gives the lock to the first waiters that can take it """
+        while self.waiters:
+            write, future = self.waiters[0]
+            if future.done():                   # cancelled waiter
+                self.waiters.popleft()
+            elif self._can_enter(write):
+                self.waiters.popleft()
+                self._enter(write)
+                future.set_result(None)
+            else:
+                break
+
+    async def _acquire(self, write):
+        """ Takes the lock for reading or writing, waiting in line if someone is waiting or it can't enter """
+        if not self.waiters and self._can_enter(write):
+            self._enter(write)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((write, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():    # the lock was given meanwhile
+                self._release(write)
+            self._wake()                                    # the ones behind it may enter now
+            raise
+
+    def _release(self, write):
+        """ Releases the lock taken for reading or writing """
+        if write:
+            self.writing = False
+        else:
+            self.readers -= 1
+        self._wake()
+
+    async def acquire_read(self):
+        """ Takes the lock for reading """
+        await self._acquire(False)
+
+    def release_read(self):
+        """ Releases the lock taken for reading """
+        self._release(False)
+
+    async def acquire_write(self):
+        """ Takes the lock for writing (exclusive) """
+        await self._acquire(True)
+
+    def release_write(self):
+        """ Releases the lock taken for writing """
+        self._release(True)
+
+
+class AsyncSyncDataBase:
+    """
+    Synchronized database for asyncio: await get_value/set_value/delete_value
+    """
+    WORKERS = 4
+
+    def __init__(self, mode, file_name="dbfile.bin", engine="snapshot", readers=SyncDataBase.READERS_BOUND,
+                 snapshot_reads=False, codec="pickle", workers=WORKERS, durability="sync", feed=False):
+        """
+        Initializer for asyncio synchronized database class (opens the database file blocking)
+        :param mode: Takes a flag 1 or 0 where this means threading or multiprocessing correspondingly
+        :param file_name: Name of file for the database
+        :param engine: How changes are persisted: "snapshot", "log" or "hash"
+        :param readers: Maximum readers at the same time (coroutines and threads of the pool)
+        :param snapshot_reads: Readers don't lock, they read the last published version of the database
+        :param codec: Serializer of the dictionary: "pickle", "marshal" or "binary", with "+zlib" to compress it
+        :param workers: Threads that do the file work (at most readers of them read at once)
+        :param durability: When writes are on disk: "sync", "group" or "async" (see FileDataBase)
+        :param feed: Writes also append to the change feed that watch() tails (see FileDataBase)
+        """
+        self.database = SyncDataBase(mode, file_name, engine, readers, snapshot_reads, codec, durability, feed)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="async_database")
+        self.lock = AsyncRWLock(min(readers, workers))
+        self.reads = {}                         # key: task reading it, shared by concurrent get_value of the key
+
+    async def _run(self, func, *args):
+        """
+        Runs a blocking method of the synchronized database in the pool of threads
+        :param func: method
+        :param args: arguments of the method
+        :return: what the method returns
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _read(self, func, *args):
+        """ Runs a reading method under the read lock of the coroutines """
+        await self.lock.acquire_read()
+        try:
+            return await self._run(func, *args)
+        finally:
+            self.lock.release_read()
+
+    async def _write(self, keys, func, *args):
+        """ Runs a writing method under the write lock of the coroutines, later reads of the keys read again """
+        await self.lock.acquire_write()
+        try:
+            return await self._run(func, *args)
+        finally:
+            for key in keys:
+                self.reads.pop(key, None)       # reads in flight may have started before the write
+            self.lock.release_write()
+
+    def _forget_read(self, key, task):
+        """ Removes a finished read of a key (unless a write already replaced it) """
+        if self.reads.get(key) is task:
+            del self.reads[key]
+
+    async def get_value(self, key):
+        """
+        Gets value according to the key of the database. Calls for a key that is already being read wait for
+        that read instead of reading again
+        If key doesn't exist None is returned
+        :param key: Key for the database element
+        :return: Value from the database if found
+        """
+        task = self.reads.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._read(self.database.get_value, key))
+            self.reads[key] = task
+            task.add_done_callback(lambda done: self._forget_read(key, done))
+        return await asyncio.shield(task)       # a cancelled caller doesn't cancel the read of the others
+
+    async def set_value(self, key, val) -> bool:
+        """
+        Sets new key:value to database
+        :param key: Key for the database
+        :param val: Value of the key
+        :return: If the operation was successful
+        """
+        return await self._write((key,), self.database.set_value, key, val)
+
+    async def delete_value(self, key):
+        """
+        Deletes value from database
+        :param key: Key for a database value
+        :return: Deleted value if existed
+        """
+        return await self._write((key,), self.database.delete_value, key)
+
+    async def get_many(self, keys) -> list:
+        """
+        Gets the values of many keys from a single read
+        :param keys: iterable of keys
+        :return: list of values in the same order as the keys (None for keys that don't exist)
+        """
+        return await self._read(self.database.get_many, list(keys))
+
+    async def set_many(self, items) -> bool:
+        """
+        Sets many key:value to database with a single write
+        :param items: dictionary or iterable of (key, value)
+        :return: If the operation was successful
+        """
+        items = dict(items)
+        return await self._write(items, self.database.set_many, items)
+
+    async def delete_many(self, keys) -> list:
+        """
+        Deletes many values from database with a single write
+        :param keys: iterable of keys
+        :return: list of deleted values (None for keys that didn't exist)
+        """
+        keys = list(keys)
+        return await self._write(keys, self.database.delete_many, keys)
+
+    async def update(self, key, func):
+        """
+        Sets the value of a key from its previous value atomically
+        :param key: Key for the database
+        :param func: function that gets the previous value (None if it didn't exist) and returns the new one
+        :return: New value of the key
+        """
+        return await self._write((key,), self.database.update, key, func)
+
+    async def incr(self, key, delta=1):
+        """
+        Adds to the value of a key atomically (a key that doesn't exist counts as 0)
+        :param key: Key for the database
+        :param delta: amount to add
+        :return: New value of the key
+        """
+        return await self._write((key,), self.database.incr, key, delta)
+
+    async def compare_and_set(self, key, expected, new) -> bool:
+        """
+        Sets the value of a key atomically only if it is still the expected one
+        :param key: Key for the database
+        :param expected: value the key must have (None for a key that doesn't exist)
+        :param new: new value of the key
+        :return: If the value was set
+        """
+        return await self._write((key,), self.database.compare_and_set, key, expected, new)
+
+    async def setdefault(self, key, default):
+        """
+        Sets the value of a key atomically only if it doesn't exist
+        :param key: Key for the database
+        :param default: value for the key if it doesn't exist
+        :return: value of the key (default if it was set)
+        """
+        return await self._write((key,), self.database.setdefault, key, default)
+
+    def watch(self, keys=None, prefix=None, since=None):
+        """
+        Watches the changes written to the database: async for event in database.watch(...)
+        :param keys: iterable of keys (None for every key)
+        :param prefix: str or bytes that the keys start with (None for every key)
+        :param since: version of the last change seen, to resume after it (None from now on)
+        :return: async iterator of ChangeEvent(key, old, new, version)
+        """
+        return self.database.watch(keys, prefix, since)
+
+    def close(self):
+        """ Waits for the file work sent to the threads and stops them """
+        self.executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        """
+        Prints file name and then file dictionary (blocking)
+        :return: string description of the database
+        """
+        return repr(self.database)
+
+
+if __name__ == "__main__":
+    async def main():
+        async with AsyncSyncDataBase(1, "testfile.bin") as database:
+            assert await database.set_value("1", "2")
+            assert await database.get_value("1") == "2"
+            assert await asyncio.gather(*(database.get_value("1") for _ in range(100))) == ["2"] * 100
+            assert await database.delete_value("1") == "2"
+            assert await database.get_value("1") is None
+    try:
+        asyncio.run(main())
+    finally:
+        os.remove("testfile.bin")
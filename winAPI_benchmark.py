@@ -0,0 +1,350 @@
+"""
+Author: Tomas Dal Farra
+Date: 01/19/2023
+Description: Benchmarks for the synchronized database and its parts. Run one of them with:
+python winAPI_benchmark.py locks
+python winAPI_benchmark.py codecs
+python winAPI_benchmark.py read
+python winAPI_benchmark.py shards
+python winAPI_benchmark.py durability
+python winAPI_benchmark.py workload --scenario mixed --workers 12 --json results.json
+https://github.com/Kloke93/database_sync
+"""
+from sync_backend import get_backend, WAIT_OBJECT_0
+from sync_backend import files
+from winAPI_sharded_database import ShardedSyncDataBase
+from winAPI_sync_database import SyncDataBase
+from db_codecs import get_codec
+import multiprocessing
+import threading
+import argparse
+import random
+import pickle
+import json
+import time
+import os
+
+
+class DrainLock:
+    """ Previous SyncDataBase protocol: writers get a mutex, reset an event and take every semaphore slot """
+    def __init__(self, backend, readers):
+        self.readers = readers
+        self.not_writing = backend.create_event(f"bench_not_writing_{readers}")
+        self.to_write_lock = backend.create_mutex(f"bench_to_write_lock_{readers}")
+        self.semaphore = backend.create_semaphore(f"bench_limit_semaphore_{readers}", readers)
+
+    def acquire_read(self, timeout):
+        self.not_writing.wait(timeout)
+        return self.semaphore.wait(timeout)
+
+    def release_read(self):
+        self.semaphore.release(1)
+
+    def acquire_write(self, timeout):
+        self.to_write_lock.wait(timeout)
+        self.not_writing.reset()
+        for _ in range(self.readers):
+            self.semaphore.wait(timeout)
+        return WAIT_OBJECT_0
+
+    def release_write(self):
+        self.semaphore.release(self.readers)
+        self.not_writing.set()
+        self.to_write_lock.release()
+
+
+def time_lock(lock, reps) -> tuple:
+    """
+    Measures acquire and release of a lock without competition
+    :param lock: object with acquire_read/release_read/acquire_write/release_write
+    :param reps: repetitions of each operation
+    :return: microseconds per read lock and per write lock
+    """
+    start = time.perf_counter()
+    for _ in range(reps):
+        lock.acquire_read(100000)
+        lock.release_read()
+    read = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(reps):
+        lock.acquire_write(100000)
+        lock.release_write()
+    write = time.perf_counter() - start
+    return read / reps * 1e6, write / reps * 1e6
+
+
+def bench_locks(args):
+    """ Compares lock acquire/release latency of the reader-writer lock and the previous protocol """
+    print(f"{'backend':<10} {'slots':>5} {'lock':<7} {'read us':>9} {'write us':>9}")
+    for mode in (1, 0):
+        backend = get_backend(mode)
+        for readers in args.slots:
+            for name, lock in (("drain", DrainLock(backend, readers)),
+                               ("rwlock", backend.create_rwlock(f"bench_rwlock_{readers}", readers))):
+                read, write = time_lock(lock, args.reps)
+                print(f"{backend.name:<10} {readers:>5} {name:<7} {read:>9.2f} {write:>9.2f}")
+
+
+def bench_codecs(args):
+    """ Compares encode/decode time and encoded size of the codecs for dictionaries of str keys and values """
+    print(f"{'codec':<13} {'entries':>8} {'encode ms':>10} {'decode ms':>10} {'size KiB':>10}")
+    for entries in args.sizes:
+        db = {f"key{n}": f"value{n}" for n in range(entries)}
+        for name in args.codecs:
+            codec = get_codec(name)
+            start = time.perf_counter()
+            data = codec.encode(db)
+            encode = time.perf_counter() - start
+            start = time.perf_counter()
+            assert codec.decode(data) == db
+            decode = time.perf_counter() - start
+            print(f"{name:<13} {entries:>8} {encode * 1e3:>10.1f} {decode * 1e3:>10.1f} {len(data) / 1024:>10.1f}")
+
+
+def chunked_read(file_name) -> bytes:
+    """ Previous FileDataBase read: 1024 bytes at a time into a growing bytes object """
+    data = b''
+    fd = os.open(file_name, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        read = os.read(fd, 1024)
+        while read:
+            data += read
+            read = os.read(fd, 1024)
+        return data
+    finally:
+        os.close(fd)
+
+
+def bench_read(args):
+    """ Compares read throughput of the whole file read of the file layer and the previous chunked loop """
+    file_name = "bench_read.bin"
+    print(f"{'read':<8} {'size KiB':>10} {'ms':>9} {'MiB/s':>9}")
+    try:
+        for size in args.sizes:
+            files.write(file_name, os.urandom(size))
+            for name, read in (("chunked", chunked_read), ("bulk", files.read)):
+                start = time.perf_counter()
+                for _ in range(args.reps):
+                    assert len(read(file_name)) == size
+                elapsed = (time.perf_counter() - start) / args.reps
+                print(f"{name:<8} {size / 1024:>10.0f} {elapsed * 1e3:>9.2f} {size / elapsed / (1 << 20):>9.1f}")
+    finally:
+        files.delete(file_name)
+
+
+def shard_writer(shards, worker, reps):
+    """ Writes keys of a worker in the sharded database of the benchmark (run in its own process) """
+    database = ShardedSyncDataBase(0, "bench_shards.bin", shards)
+    for n in range(reps):
+        database.set_value((worker, n % 64), n)
+
+
+def bench_shards(args):
+    """ Compares write throughput of processes writing to the same database with different amounts of shards """
+    print(f"{'shards':>6} {'procs':>5} {'writes/s':>10}")
+    for shards in args.shards:
+        ShardedSyncDataBase(0, "bench_shards.bin", shards)                 # creates the files before timing
+        procs = [multiprocessing.Process(target=shard_writer, args=(shards, worker, args.reps))
+                 for worker in range(args.procs)]
+        start = time.perf_counter()
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        elapsed = time.perf_counter() - start
+        print(f"{shards:>6} {args.procs:>5} {args.procs * args.reps / elapsed:>10.0f}")
+        for n in range(shards):
+            files.delete(f"bench_shards.{n}.bin")
+
+
+def bench_durability(args):
+    """ Compares write throughput of threads writing with each durability mode """
+    print(f"{'durability':<10} {'threads':>7} {'writes/s':>10} {'saves':>7}")
+    for durability in ("sync", "group", "async"):
+        database = SyncDataBase(1, "bench_durability.bin", durability=durability)
+        saves = []
+        save = database.storage.save
+        database.storage.save = lambda db, records: saves.append(len(records)) or save(db, records)
+
+        def write(worker):
+            for n in range(args.reps):
+                database.set_value((worker, n % 64), n)
+
+        threads = [threading.Thread(target=write, args=(worker,)) for worker in range(args.threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        database.flush()
+        elapsed = time.perf_counter() - start
+        print(f"{durability:<10} {args.threads:>7} {args.threads * args.reps / elapsed:>10.0f} {len(saves):>7}")
+        files.delete("bench_durability.bin")
+
+
+class TimedLock:
+    """ Reader-writer lock that adds up the time each thread waits to acquire it """
+    def __init__(self, lock):
+        self.lock = lock
+        self.waits = threading.local()
+
+    def _timed(self, acquire, timeout):
+        start = time.perf_counter()
+        w = acquire(timeout)
+        self.waits.total = self.waited() + time.perf_counter() - start
+        return w
+
+    def waited(self) -> float:
+        """ Gets the seconds the calling thread waited for the lock """
+        return getattr(self.waits, "total", 0.0)
+
+    def acquire_read(self, timeout):
+        return self._timed(self.lock.acquire_read, timeout)
+
+    def release_read(self):
+        self.lock.release_read()
+
+    def acquire_write(self, timeout):
+        return self._timed(self.lock.acquire_write, timeout)
+
+    def release_write(self):
+        self.lock.release_write()
+
+
+WORKLOAD_FILE = "bench_workload.bin"
+SCENARIOS = {"read": 1.0, "write": 0.0, "mixed": None, "rmw": 0.0}     # share of reads (mixed: --read-ratio)
+
+
+def open_workload(args) -> SyncDataBase:
+    """ Opens the database of the workload with its lock timed """
+    database = SyncDataBase(args.mode, WORKLOAD_FILE, args.engine, snapshot_reads=args.snapshot_reads,
+                            durability=args.durability)
+    database.rwlock = TimedLock(database.rwlock)
+    return database
+
+
+def run_workload(database, args, worker) -> dict:
+    """
+    Runs the operations of a worker (the same scenarios as winAPI_test_sync.py)
+    :param database: database with a timed lock
+    :param args: workload parameters
+    :param worker: worker number (seed of its keys)
+    :return: latencies in seconds, lock wait and start/end wall clock time
+    """
+    rng = random.Random(worker)
+    reads = SCENARIOS[args.scenario] if SCENARIOS[args.scenario] is not None else args.read_ratio
+    value = b"x" * args.value_size
+    latencies = []
+    start = time.time()
+    for _ in range(args.ops):
+        key = rng.randrange(args.keys)
+        op_start = time.perf_counter()
+        if rng.random() < reads:
+            database.get_value(key)
+        elif args.scenario == "rmw":
+            database._set_value_testing(key)
+        else:
+            database.set_value(key, value)
+        latencies.append(time.perf_counter() - op_start)
+    return {"latencies": latencies, "lock_wait": database.rwlock.waited(), "start": start, "end": time.time()}
+
+
+def workload_process(args, worker) -> dict:
+    """ Runs a worker in its own process with its own instance of the database """
+    return run_workload(open_workload(args), args, worker)
+
+
+def bench_workload(args):
+    """ Measures a scenario of the synchronized database tests and reports it as JSON """
+    initial = 0 if args.scenario == "rmw" else b"x" * args.value_size       # rmw increases int values
+    with open(WORKLOAD_FILE, "wb") as f:
+        pickle.dump({key: initial for key in range(args.keys)}, f)
+    try:
+        if args.mode:
+            database = open_workload(args)
+            results = []
+            threads = [threading.Thread(target=lambda n: results.append(run_workload(database, args, n)), args=(n,))
+                       for n in range(args.workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            database.flush()
+        else:
+            with multiprocessing.Pool(args.workers) as pool:
+                results = pool.starmap(workload_process, [(args, n) for n in range(args.workers)])
+    finally:
+        files.delete(WORKLOAD_FILE)
+        if args.engine == "log":
+            files.delete(WORKLOAD_FILE + ".log")
+            if os.path.exists(WORKLOAD_FILE + ".delta"):
+                files.delete(WORKLOAD_FILE + ".delta")
+    latencies = sorted(latency for result in results for latency in result["latencies"])
+    elapsed = max(result["end"] for result in results) - min(result["start"] for result in results)
+    busy = sum(latencies)
+    lock_wait = sum(result["lock_wait"] for result in results)
+    report = {
+        "params": {name: getattr(args, name) for name in ("scenario", "mode", "workers", "ops", "keys",
+                                                          "value_size", "read_ratio", "engine", "durability",
+                                                          "snapshot_reads")},
+        "ops": len(latencies),
+        "seconds": elapsed,
+        "ops_per_sec": len(latencies) / elapsed,
+        "latency_us": {name: latencies[min(int(len(latencies) * q), len(latencies) - 1)] * 1e6
+                       for name, q in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999))},
+        "lock_wait_sec": lock_wait,                 # time of all workers waiting for the lock
+        "io_sec": busy - lock_wait,                 # rest of the time in operations (file and decoding)
+    }
+    text = json.dumps(report, indent=2)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(text)
+    print(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the synchronized database")
+    commands = parser.add_subparsers(dest="command", required=True)
+    locks = commands.add_parser("locks", help="lock acquire/release latency at several reader slots")
+    locks.add_argument("--slots", type=int, nargs="+", default=[1, 10, 100], help="reader slots")
+    locks.add_argument("--reps", type=int, default=10000, help="acquire/release per measure")
+    locks.set_defaults(func=bench_locks)
+    codecs = commands.add_parser("codecs", help="encode/decode time and size of the database codecs")
+    codecs.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000], help="entries")
+    codecs.add_argument("--codecs", nargs="+", help="codecs to compare",
+                        default=["pickle", "marshal", "binary", "pickle+zlib", "marshal+zlib", "binary+zlib"])
+    codecs.set_defaults(func=bench_codecs)
+    read = commands.add_parser("read", help="whole file read throughput at several file sizes")
+    read.add_argument("--sizes", type=int, nargs="+", default=[1 << 16, 1 << 20, 1 << 22], help="file sizes")
+    read.add_argument("--reps", type=int, default=5, help="reads per measure")
+    read.set_defaults(func=bench_read)
+    shards = commands.add_parser("shards", help="write throughput of processes at several amounts of shards")
+    shards.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8], help="shard files")
+    shards.add_argument("--procs", type=int, default=os.cpu_count(), help="writing processes")
+    shards.add_argument("--reps", type=int, default=2000, help="writes of each process")
+    shards.set_defaults(func=bench_shards)
+    durability = commands.add_parser("durability", help="write throughput of threads with each durability mode")
+    durability.add_argument("--threads", type=int, default=8, help="writing threads")
+    durability.add_argument("--reps", type=int, default=500, help="writes of each thread")
+    durability.set_defaults(func=bench_durability)
+    workload = commands.add_parser("workload", help="scenario of the synchronized database tests, JSON report")
+    workload.add_argument("--scenario", choices=SCENARIOS, default="mixed",
+                          help="read-only, write-only, mixed reads and writes or read-modify-write")
+    workload.add_argument("--mode", type=int, choices=(0, 1), default=1, help="1 threads, 0 processes")
+    workload.add_argument("--workers", type=int, default=12, help="threads or processes")
+    workload.add_argument("--ops", type=int, default=5000, help="operations of each worker")
+    workload.add_argument("--keys", type=int, default=50, help="keys of the database")
+    workload.add_argument("--value-size", type=int, default=16, help="bytes of each value")
+    workload.add_argument("--read-ratio", type=float, default=0.75, help="share of reads in the mixed scenario")
+    workload.add_argument("--engine", default="snapshot", help="storage engine")
+    workload.add_argument("--durability", default="sync", help="sync, group or async")
+    workload.add_argument("--snapshot-reads", action="store_true",
+                          help="readers don't lock (with the hash engine they read the shared mapping)")
+    workload.add_argument("--json", help="file to write the report to")
+    workload.set_defaults(func=bench_workload)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""
+Author: Tomas Dal Farra
+Date: 01/19/2023
+Description: Per-process value cache in front of a database for keys that are read much more than the rest. The
+cache is dropped whenever the write version of the database changes, so writes of other processes are never
+served stale
+https://github.com/Kloke93/database_sync
+"""
+from db_stats import Stats
+from contextlib import contextmanager
+import collections
+import threading
+import time
+import os
+
+
+class CachedDataBase:
+    """
+    Bounded LRU cache (with optional TTL) of get_value in front of a FileDataBase, SyncDataBase or
+    ShardedSyncDataBase. Every read compares the write version of the database (a stat of the file, no lock) with
+    the version the cached values were read at
+    """
+    SIZE = 1024
+
+    def __init__(self, database, size=SIZE, ttl=None):
+        """
+        Initializer for the cache of a database
+        :param database: database to cache (writes must go through the cache to be seen by its reads at once)
+        :param size: Maximum keys in the cache, the least recently used is evicted
+        :param ttl: Seconds a value stays in the cache (None for no limit)
+        """
+        self.database = database
+        self.size = size
+        self.ttl = ttl
+        self.cache = collections.OrderedDict()      # key: (value, expiry time or None), least recently used first
+        self.cache_version = None                   # version of the database the values were read at
+        self.epoch = 0                              # drops of cached values, a read that crosses one isn't kept
+        self.lock = threading.Lock()
+        self.metrics = getattr(database, "metrics", None) or Stats()
+
+    def _check_version(self):
+        """ Drops the cache if the database was written since its values were read """
+        version = self.database.version()
+        if version != self.cache_version:
+            with self.lock:
+                if self.cache:
+                    self.metrics.count("cache_invalidations")
+                self.cache.clear()
+                self.cache_version = version
+                self.epoch += 1
+
+    def _lookup(self, key):
+        """
+        Gets a value from the cache
+        :param key: Key for the database element
+        :return: (if it was found, value)
+        """
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                self.metrics.count("cache_misses")
+                return False, None
+            if entry[1] is not None and entry[1] < time.monotonic():
+                del self.cache[key]
+                self.metrics.count("cache_expired")
+                self.metrics.count("cache_misses")
+                return False, None
+            self.cache.move_to_end(key)
+            self.metrics.count("cache_hits")
+            return True, entry[0]
+
+    def _store(self, items, epoch):
+        """
+        Keeps values read from the database, evicting the least recently used keys
+        :param items: (key, value) read
+        :param epoch: epoch of the cache before reading them
+        """
+        expiry = None if self.ttl is None else time.monotonic() + self.ttl
+        with self.lock:
+            if epoch != self.epoch:                     # a write or a new version may be newer than what was read
+                return
+            for key, val in items:
+                self.cache[key] = (val, expiry)
+                self.cache.move_to_end(key)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+                self.metrics.count("cache_evictions")
+
+    def _forget(self, keys=None):
+        """
+        Drops keys that are written through the cache
+        :param keys: iterable of keys (None for all of them)
+        """
+        with self.lock:
+            self.epoch += 1
+            if keys is None:
+                self.cache.clear()
+            else:
+                for key in keys:
+                    self.cache.pop(key, None)
+
+    def get_value(self, key):
+        """
+        Gets value according to the key from the cache or the database
+        If key doesn't exist None is returned
+        :param key: Key for the database element
+        :return: Value from the database if found
+        """
+        self._check_version()
+        found, val = self._lookup(key)
+        if found:
+            return val
+        epoch = self.epoch
+        val = self.database.get_value(key)
+        self._store(((key, val),), epoch)
+        return val
+
+    def get_many(self, keys) -> list:
+        """
+        Gets the values of many keys, the ones that are not in the cache with a single read
+        :param keys: iterable of keys
+        :return: list of values in the same order as the keys (None for keys that don't exist)
+        """
+        self._check_version()
+        keys = list(keys)
+        vals = [None] * len(keys)
+        missing = []                                    # (position, key) not in the cache
+        for pos, key in enumerate(keys):
+            found, vals[pos] = self._lookup(key)
+            if not found:
+                missing.append((pos, key))
+        if missing:
+            epoch = self.epoch
+            read = self.database.get_many([key for _, key in missing])
+            for (pos, _), val in zip(missing, read):
+                vals[pos] = val
+            self._store(zip((key for _, key in missing), read), epoch)
+        return vals
+
+    def scan(self, start=None, end=None):
+        """
+        Iterates the entries with start <= key < end in key order from the database (not cached)
+        :param start: first key (None from the first key)
+        :param end: key where the scan stops, not included (None until the last key)
+        :return: iterator of (key, value)
+        """
+        return self.database.scan(start, end)
+
+    def prefix(self, prefix):
+        """
+        Iterates the entries whose key starts with a prefix in key order from the database (not cached)
+        :param prefix: str or bytes (only keys of the same type)
+        :return: iterator of (key, value)
+        """
+        return self.database.prefix(prefix)
+
+    def watch(self, keys=None, prefix=None, since=None):
+        """
+        Watches the changes written to the database (not cached)
+        :param keys: iterable of keys (None for every key)
+        :param prefix: str or bytes that the keys start with (None for every key)
+        :param since: version of the last change seen, to resume after it (None from now on)
+        :return: iterator and async iterator of ChangeEvent(key, old, new, version)
+        """
+        return self.database.watch(keys, prefix, since)
+
+    def set_value(self, key, val) -> bool:
+        """
+        Sets new key:value to database
+        :param key: Key for the database
+        :param val: Value of the key
+        :return: If the operation was successful
+        """
+        try:
+            return self.database.set_value(key, val)
+        finally:
+            self._forget((key,))
+
+    def delete_value(self, key):
+        """
+        Deletes value from database
+        :param key: Key for a database value
+        :return: Deleted value if existed
+        """
+        try:
+            return self.database.delete_value(key)
+        finally:
+            self._forget((key,))
+
+    def set_many(self, items) -> bool:
+        """
+        Sets many key:value to database with a single write
+        :param items: dictionary or iterable of (key, value)
+        :return: If the operation was successful
+        """
+        items = dict(items)
+        try:
+            return self.database.set_many(items)
+        finally:
+            self._forget(items)
+
+    def delete_many(self, keys) -> list:
+        """
+        Deletes many values from database with a single write
+        :param keys: iterable of keys
+        :return: list of deleted values (None for keys that didn't exist)
+        """
+        keys = list(keys)
+        try:
+            return self.database.delete_many(keys)
+        finally:
+            self._forget(keys)
+
+    def update(self, key, func):
+        """
+        Sets the value of a key from its previous value atomically (read from the database, not the cache)
+        :param key: Key for the database
+        :param func: function that gets the previous value (None if it didn't exist) and returns the new one
+        :return: New value of the key
+        """
+        try:
+            return self.database.update(key, func)
+        finally:
+            self._forget((key,))
+
+    def incr(self, key, delta=1):
+        """
+        Adds to the value of a key atomically (read from the database, not the cache)
+        :param key: Key for the database
+        :param delta: amount to add
+        :return: New value of the key
+        """
+        try:
+            return self.database.incr(key, delta)
+        finally:
+            self._forget((key,))
+
+    def compare_and_set(self, key, expected, new) -> bool:
+        """
+        Sets the value of a key atomically only if it is still the expected one (compared in the database)
+        :param key: Key for the database
+        :param expected: value the key must have (None for a key that doesn't exist)
+        :param new: new value of the key
+        :return: If the value was set
+        """
+        try:
+            return self.database.compare_and_set(key, expected, new)
+        finally:
+            self._forget((key,))
+
+    def setdefault(self, key, default):
+        """
+        Sets the value of a key atomically only if it doesn't exist in the database
+        :param key: Key for the database
+        :param default: value for the key if it doesn't exist
+        :return: value of the key (default if it was set)
+        """
+        try:
+            return self.database.setdefault(key, default)
+        finally:
+            self._forget((key,))
+
+    @contextmanager
+    def transaction(self):
+        """
+        Transaction of the database (reads of the block don't use the cache), the cache is dropped at its end
+        :return: context manager that gives the database
+        """
+        try:
+            with self.database.transaction() as db:
+                yield db
+        finally:
+            self._forget()
+
+    def flush(self):
+        """ Waits until every write queued until now is written to file """
+        self.database.flush()
+
+    def version(self):
+        """
+        Gets the write version of the database
+        :return: version
+        """
+        return self.database.version()
+
+    def stats(self) -> dict:
+        """
+        Gets the counters of the cache (cache_hits, cache_misses, cache_evictions, cache_expired and
+        cache_invalidations) with the ones of the database
+        :return: {"counters": {name: value}, "histograms": {name: summary}}
+        """
+        return self.metrics.snapshot()
+
+    def _set_value_testing(self, key) -> bool:
+        """ Special set_value modification to change previous value of key in dictionary by one"""
+        try:
+            return self.database._set_value_testing(key)
+        finally:
+            self._forget((key,))
+
+    def get_name(self) -> str:
+        """
+        Gets file name of the database
+        :return: file name
+        """
+        return self.database.get_name()
+
+    def __repr__(self):
+        """
+        Prints the database (not the cache)
+        :return: string description of the database
+        """
+        return repr(self.database)
+
+
+if __name__ == "__main__":
+    from winAPI_sync_database import SyncDataBase
+    try:
+        database = CachedDataBase(SyncDataBase(1, "testfile.bin"), size=2)
+        other = SyncDataBase(1, "testfile.bin")
+        assert database.set_value(1, "a")
+        assert database.get_value(1) == "a"
+        assert database.get_value(1) == "a"
+        assert other.set_value(1, "b")
+        assert database.get_value(1) == "b"
+        assert database.stats()["counters"]["cache_hits"] == 1
+    finally:
+        os.remove("testfile.bin")
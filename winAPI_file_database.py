@@ -1,29 +1,71 @@
 """
 Author: Tomas Dal Farra
 Date: 01/19/2023
-Description: Defines a class where to handle a dictionary database within a file with win32file
+Description: Defines a class where to handle a dictionary database within a file with win32file (os on POSIX)
 https://github.com/Kloke93/database_sync
 """
-from win32file import GENERIC_READ, GENERIC_WRITE, FILE_SHARE_READ, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, CREATE_ALWAYS
-from win32file import CreateFile, ReadFile, WriteFile, DeleteFile, GetFileAttributesEx, CloseHandle
 from dict_database import DataBase
+from storage_engines import ENGINES
+from db_stats import Stats
+from db_feed import ChangeFeed
+from sync_backend import files
+from contextlib import contextmanager
+from concurrent.futures import Future
+import threading
 import logging
-import pickle
+import time
 
 
 class FileDataBase(DataBase):
     """
     File handling dictionary database
     """
-    def __init__(self, file_name="dbfile.bin"):
+    DURABILITY = ("sync", "group", "async")
+    GROUP_WINDOW = 0.002                    # seconds a group commit waits for more writers
+    ASYNC_LAG = 0.05                        # maximum seconds an async write stays only in memory
+    ASYNC_QUEUE = 10000                     # queued async writes before writers wait for a commit
+    _DELETED = object()
+
+    def __init__(self, file_name="dbfile.bin", engine="snapshot", codec="pickle", durability="sync", feed=False):
+        """
+        Initializer for file database class
+        :param file_name: Name of file for the database
+        :param engine: How changes are persisted: "snapshot" (whole file rewritten), "log" (append-only log) or
+        "hash" (hash index and values mapped in memory)
+        :param codec: Serializer of the dictionary: "pickle", "marshal" or "binary" (str/bytes/int only), with
+        "+zlib" to compress it. Readers use the codec the file was written with
+        :param durability: When writes are on disk: "sync" (written to file before returning), "group" (writes
+        that arrive within GROUP_WINDOW are written and synced to disk together, callers wait for it) or "async"
+        (written and synced in the background at most ASYNC_LAG later, callers don't wait)
+        :param feed: Writes also append (key, old value, new value) to the change feed (file_name + ".feed") that
+        watch() tails. Every instance that writes the file must use it for the feed to have every change
+        """
+        if durability not in FileDataBase.DURABILITY:
+            raise ValueError(f"Unknown durability {durability}")
         self.file_name = file_name
+        if not hasattr(self, "metrics"):    # counters and histograms given by stats() (subclasses may time locks
+            self.metrics = Stats()          # before this)
+        self.storage = ENGINES[engine](file_name, codec, self.metrics)
+        self.pending = None                 # changes of the open transaction (None when there isn't one)
+        self.durability = durability
+        self.load_lock = threading.Lock()
+        self.index_version = None           # version of the file the key index was built or updated at
+        self.commit_cond = threading.Condition()
+        self.queue = []                     # (sequence, method name, arguments, future) waiting for the committer
+        self.sequence = 0                   # writes queued until now
+        self.unflushed = {}                 # key: (sequence, value or _DELETED) of queued async writes
+        self.committer = None               # thread that writes the queue (exits when it is empty)
+        self.waiting = 0                    # queued writes whose callers wait (async commits them without lag)
+        self.last_future = None             # future of the last queued write
+        self.feed = ChangeFeed(file_name) if feed else None
+        self.previous = {}                  # key: value before the changes not written yet (for the feed)
         super().__init__()
         if not self._non_zero_file():      # creates file with empty dictionary if it doesn't exist
-            self.__write_database({})
+            self.storage.create()
             logging.debug("New database initialized")
         else:
-            self.__read_database()
-            logging.debug("Previous database content loaded")
+            self.db = self.storage.open(self.db)        # decoded when it is used, not here
+            logging.debug("Previous database opened")
 
     def _non_zero_file(self) -> bool:
         """
@@ -31,52 +73,266 @@ class FileDataBase(DataBase):
         :return: if file meets the condition
         """
         try:
-            attr = GetFileAttributesEx(self.file_name)
-            if attr[4]:
+            if files.size(self.file_name):
                 return True
             return False
         except Exception as err:
-            logging.error(f"Error loading the database: {err}")
+            logging.error("Error loading the database: %s", err)
             return False
 
     def __read_database(self):
-        """ Updates self.db reading database """
-        data = b''
-        fhandle = 0
+        """ Updates self.db reading database (only what changed since it was last read) """
+        if self.pending is None:                            # in a transaction self.db has changes not in file yet
+            with self.load_lock:                            # concurrent readers wait for the one loading it
+                self.db = self.storage.load(self.db)
+
+    def __save(self, records):
+        """
+        Writes changes of self.db to file (or keeps them until the end of the transaction)
+        :param records: changes, (key, value) for set or (key,) for delete
+        """
+        if self.pending is None:
+            self.__save_records(records)
+            self._on_save()
+        else:
+            self.pending.extend(records)
+
+    def __save_records(self, records):
+        """
+        Writes changes of self.db to file (and to the change feed), the key index stays valid if it had the keys
+        of the file before
+        :param records: changes, (key, value) for set or (key,) for delete
+        """
+        index_valid = self.index is not None and self._index_valid()
+        self.storage.save(self.db, records)
+        if index_valid:
+            self.index_version = self.storage.version()
+        if self.feed is not None:
+            values, self.previous = self.previous, {}
+            changes = []
+            for record in records:
+                old, new = values.get(record[0]), record[1] if len(record) == 2 else None
+                if old is not None or new is not None:          # deleting a key that doesn't exist changes nothing
+                    changes.append((record[0], old, new))
+                values[record[0]] = new
+            self.feed.append(changes)
+
+    def __remember(self, keys):
+        """
+        Keeps the values of keys before they are changed for the change feed (in a transaction the ones before it)
+        :param keys: iterable of keys
+        """
+        if self.feed is None:
+            return
+        for key in keys:
+            if self.pending is None or key not in self.previous:
+                self.previous[key] = self.db.get(key)
+
+    def __invalidate(self):
+        """
+        Drops the changes of self.db (and its key index) that are not in file, next read loads the file. Nothing is
+        dropped in a transaction: it keeps its earlier changes and drops them all if it raises
+        """
+        if self.pending is not None:
+            return
+        self.storage.invalidate()
+        self.index = None
+        self.previous = {}
+        self._on_invalidate()
+
+    def _scan(self, low, high):
+        """ Yields (key, value) from sort key low to high a page at a time, after the writes queued until now """
+        if self._defers():
+            self.flush()
+        yield from super()._scan(low, high)
+
+    def _index_valid(self) -> bool:
+        """ Checks if the key index has the keys of the file (and of the open transaction) """
+        return self.index is not None and self.index_version == self.storage.version()
+
+    def _scan_page(self, low, inclusive, high, limit) -> list:
+        """
+        Gets the entries of the next page of a scan, reading the file if it changed (values of the hash engine are
+        decoded only for the entries of the page)
+        :param low: sort key where the page starts (None from the first key)
+        :param inclusive: if a key with sort key low is in the page
+        :param high: sort key where the scan ends, not included (None until the last key)
+        :param limit: maximum entries
+        :return: list of (key, value) in order
+        """
         try:
-            fhandle = CreateFile(self.file_name,                                        # file name
-                                 GENERIC_READ,                                          # read access
-                                 FILE_SHARE_READ,                                       # share to read requests
-                                 None,                                                  # default security
-                                 OPEN_EXISTING,                                         # opens existing files only
-                                 FILE_ATTRIBUTE_NORMAL,                                 # normal file
-                                 None)                                                  # no attr. template
-            read = ReadFile(fhandle, 1024)[1]                # string read from 1024 buffer
-            while read:                                      # while read still has data
-                data += read
-                read = ReadFile(fhandle, 1024)[1]
-            self.db = pickle.loads(data)
-        finally:
-            CloseHandle(fhandle)
+            version = self.storage.version()
+            self.__read_database()
+            if not self._index_valid():
+                self.index = None
+                page = super()._scan_page(low, inclusive, high, limit)
+                self.index_version = version                # a write after version makes the next page build it
+                return page
+            return super()._scan_page(low, inclusive, high, limit)
+        except Exception as err:
+            logging.error("There was a problem to scan values: %s", err)
+            raise err
+
+    def _on_save(self):
+        """ Called after changes of self.db are written to file """
+
+    def _on_invalidate(self):
+        """ Called after changes of self.db that are not in file are dropped """
+
+    def _defers(self) -> bool:
+        """ Checks if a write has to be queued for the committer instead of written now """
+        return (self.durability != "sync" and self.pending is None
+                and threading.current_thread() is not self.committer)
 
-    def __write_database(self, data):
+    def _write_later(self, name, args, changes=None, result=None):
         """
-        Updates self.db and database file writing something on it
-        :param data: data to serialize and write to file
+        Queues a write for the committer thread
+        :param name: name of the method that does the write
+        :param args: arguments of the method
+        :param changes: {key: value or _DELETED} the write makes, async writes with them don't wait
+        :param result: what an async write that doesn't wait returns
+        :return: what the method returned
+        """
+        future = Future()
+        with self.commit_cond:
+            self.sequence += 1
+            self.queue.append((self.sequence, name, args, future))
+            self.last_future = future
+            if self.durability == "async" and changes is not None:
+                for key, val in changes.items():
+                    self.unflushed[key] = (self.sequence, val)
+            waits = self.durability == "group" or changes is None
+            if waits:
+                self.waiting += 1
+                self.commit_cond.notify_all()
+            if self.committer is None:
+                self.committer = threading.Thread(target=self._commit_queue, name="committer")
+                self.committer.start()
+            while len(self.queue) > FileDataBase.ASYNC_QUEUE:             # bounded lag
+                self.commit_cond.wait()
+        if not waits:
+            return result
+        return future.result()
+
+    def _commit_queue(self):
+        """ Writes the queued writes in batches, each one in a transaction synced to disk once """
+        while True:
+            with self.commit_cond:
+                if self.durability == "async":                  # waits for the lag unless someone waits
+                    self.commit_cond.wait_for(lambda: self.waiting, FileDataBase.ASYNC_LAG)
+                batch, self.queue = self.queue, []
+                self.waiting = 0
+                self.commit_cond.notify_all()
+                if not batch:
+                    self.committer = None
+                    return
+            results = self._commit_batch(batch)
+            with self.commit_cond:
+                for key, (sequence, _) in list(self.unflushed.items()):
+                    if sequence <= batch[-1][0]:
+                        del self.unflushed[key]
+            for future, result, err in results:
+                if err is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(err)
+            if self.durability == "group" and self.queue:
+                time.sleep(FileDataBase.GROUP_WINDOW)           # writers came during the commit, more may come
+
+    def _commit_batch(self, batch) -> list:
+        """
+        Writes queued writes in one transaction. If it raises nothing is written and every write is done again in
+        its own transaction, so only the writes that raise fail
+        :param batch: list of (sequence, method name, arguments, future)
+        :return: list of (future, result, error)
         """
-        fhandle = 0                                                         # just making fhandle exist
         try:
-            fhandle = CreateFile(self.file_name,                            # file name
-                                 GENERIC_WRITE,                             # read access
-                                 0,                                         # do not share
-                                 None,                                      # default security
-                                 CREATE_ALWAYS,                             # always creates a new file
-                                 FILE_ATTRIBUTE_NORMAL,                     # normal file
-                                 None)                                      # no attr. template
-            s_data = pickle.dumps(data)
-            WriteFile(fhandle, s_data)
-        finally:
-            CloseHandle(fhandle)
+            results = []
+            with self.transaction():
+                for _, name, args, future in batch:
+                    results.append((future, getattr(self, name)(*args), None))
+            return results
+        except Exception as err:
+            if len(batch) == 1:
+                logging.error("Queued write was not written: %s", err)
+                return [(batch[0][3], None, err)]
+        results = []
+        for write in batch:
+            results += self._commit_batch([write])
+        return results
+
+    def _unflushed_value(self, key, default=None):
+        """
+        Gets the value of a key from async writes that are not in file yet
+        :param key: Key for the database
+        :param default: what to return if the key has no queued write
+        :return: value (None if deleted) or default
+        """
+        if not self.unflushed:
+            return default
+        with self.commit_cond:
+            change = self.unflushed.get(key)
+        if change is None:
+            return default
+        return None if change[1] is FileDataBase._DELETED else change[1]
+
+    def _with_unflushed(self, keys, vals) -> list:
+        """
+        Replaces values read from file by the ones of async writes that are not in file yet
+        :param keys: list of keys
+        :param vals: their values in file
+        :return: up to date values
+        """
+        if not self.unflushed:
+            return vals
+        return [self._unflushed_value(key, val) for key, val in zip(keys, vals)]
+
+    def flush(self):
+        """ Waits until every write queued until now is written to file (sync durability writes immediately) """
+        if threading.current_thread() is self.committer:
+            return
+        with self.commit_cond:
+            future = self.last_future
+            if future is None or future.done():
+                return
+            self.waiting += 1                                   # async commits without waiting for the lag
+            self.commit_cond.notify_all()
+        future.exception()                                      # waits without raising the error of the write
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups changes so that they are written to file once when the block ends (nothing is written if it raises)
+        :return: context manager that gives the database
+        """
+        if self.pending is not None:                        # nested transactions join the open one
+            yield self
+            return
+        self.flush()                                        # queued writes go before the transaction
+        with self._transaction():
+            yield self
+
+    @contextmanager
+    def _transaction(self):
+        """ Transaction without waiting for queued writes """
+        if self.pending is not None:
+            yield self
+            return
+        self.__read_database()
+        self.pending = []
+        try:
+            yield self
+            records, self.pending = self.pending, None
+            if records:
+                self.__save_records(records)
+                if self.durability != "sync":
+                    self.storage.sync()
+                self._on_save()
+        except BaseException as err:
+            self.pending = None
+            self.__invalidate()                             # drops changes of self.db, next read loads the file
+            logging.error("Transaction was not written: %r", err)
+            raise
 
     def set_value(self, key, val) -> bool:
         """
@@ -85,13 +341,17 @@ class FileDataBase(DataBase):
         :param val: Value of the key
         :return: If the operation was successful
         """
+        if self._defers():
+            return self._write_later("set_value", (key, val), {key: val}, True)
         try:
             self.__read_database()
+            self.__remember((key,))
             is_set = super().set_value(key, val)
-            self.__write_database(self.db)                    # writes to file serialization of self.db
+            self.__save([(key, val)])                         # writes the change to file
             return is_set
         except Exception as err:
-            logging.error(f"There was a problem to set value: {err}")
+            self.__invalidate()                               # self.db may have changes that are not in file
+            logging.error("There was a problem to set value: %s", err)
             raise err
 
     def get_value(self, key):
@@ -101,11 +361,14 @@ class FileDataBase(DataBase):
         :param key: Key for the database element
         :return: Value from the database if found
         """
+        val = self._unflushed_value(key, self)
+        if val is not self:
+            return val
         try:
             self.__read_database()
             return super().get_value(key)
         except Exception as err:
-            logging.error(f"There was a problem to get value: {err}")
+            logging.error("There was a problem to get value: %s", err)
             raise err
 
     def delete_value(self, key):
@@ -114,15 +377,136 @@ class FileDataBase(DataBase):
         :param key: Key for a database value
         :return: Deleted value if existed
         """
+        if self._defers():
+            deleted = self.get_value(key) if self.durability == "async" else None
+            return self._write_later("delete_value", (key,), {key: FileDataBase._DELETED}, deleted)
         try:
             self.__read_database()
+            self.__remember((key,))
             val = super().delete_value(key)
-            self.__write_database(self.db)                    # writes to file serialization of self.db
+            self.__save([(key,)])                             # writes the change to file
+            return val
+        except Exception as err:
+            self.__invalidate()                               # self.db may have changes that are not in file
+            logging.error("There was a problem to delete value: %s", err)
+            raise err
+
+    def set_many(self, items) -> bool:
+        """
+        Sets many key:value to database in file, written to file once
+        :param items: dictionary or iterable of (key, value)
+        :return: If the operation was successful
+        """
+        if self._defers():
+            items = dict(items)
+            return self._write_later("set_many", (items,), items, True)
+        try:
+            self.__read_database()
+            items = dict(items)
+            self.__remember(items)
+            is_set = True
+            for key, val in items.items():
+                is_set = super().set_value(key, val) and is_set
+            self.__save(list(items.items()))
+            return is_set
+        except Exception as err:
+            self.__invalidate()
+            logging.error("There was a problem to set many values: %s", err)
+            raise err
+
+    def get_many(self, keys) -> list:
+        """
+        Gets the values of many keys from a single read of the database in file
+        :param keys: iterable of keys
+        :return: list of values in the same order as the keys (None for keys that don't exist)
+        """
+        try:
+            self.__read_database()
+            keys = list(keys)
+            return self._with_unflushed(keys, [self.db.get(key) for key in keys])
+        except Exception as err:
+            logging.error("There was a problem to get many values: %s", err)
+            raise err
+
+    def delete_many(self, keys) -> list:
+        """
+        Deletes many values from database in file, written to file once
+        :param keys: iterable of keys
+        :return: list of deleted values (None for keys that didn't exist)
+        """
+        if self._defers():
+            keys = list(keys)
+            deleted = self.get_many(keys) if self.durability == "async" else None
+            return self._write_later("delete_many", (keys,), dict.fromkeys(keys, FileDataBase._DELETED), deleted)
+        try:
+            self.__read_database()
+            keys = list(keys)
+            self.__remember(keys)
+            deleted = []
+            for key in keys:
+                deleted.append(super().delete_value(key))
+            self.__save([(key,) for key in keys])
+            return deleted
+        except Exception as err:
+            self.__invalidate()
+            logging.error("There was a problem to delete many values: %s", err)
+            raise err
+
+    def update(self, key, func):
+        """
+        Sets the value of a key in file from its previous value
+        :param key: Key for the database
+        :param func: function that gets the previous value (None if it didn't exist) and returns the new one (or
+        DataBase.KEEP to write nothing)
+        :return: New value of the key
+        """
+        if self._defers():
+            return self._write_later("update", (key, func))         # waits, the new value depends on the file
+        try:
+            self.__read_database()
+            old = super().get_value(key)
+            val = func(old)
+            if val is DataBase.KEEP:
+                return old
+            self.__remember((key,))
+            super().set_value(key, val)
+            self.__save([(key, val)])
             return val
         except Exception as err:
-            logging.error(f"There was a problem to delete value: {err}")
+            self.__invalidate()
+            logging.error("There was a problem to update value: %s", err)
             raise err
 
+    def watch(self, keys=None, prefix=None, since=None):
+        """
+        Watches the changes written to the database (by any instance or process that writes with feed=True),
+        without locking nor reading the database
+        :param keys: iterable of keys (None for every key)
+        :param prefix: str or bytes that the keys start with (None for every key)
+        :param since: version of the last change seen, to resume after it (None from now on)
+        :return: iterator and async iterator of ChangeEvent(key, old, new, version), see db_feed.Watch
+        """
+        if self.feed is None:
+            raise ValueError("The database was opened without feed=True")
+        return self.feed.watch(keys, prefix, since)
+
+    def stats(self) -> dict:
+        """
+        Gets counters and latency histograms of this instance: lock waits (lock_read_wait, lock_write_wait,
+        lock_timeouts, lock_abandoned), file I/O (file_read, file_write and their _bytes counters) and encode/decode
+        time. Use self.metrics.export(hook) to send them to a metrics client periodically
+        :return: {"counters": {name: value}, "histograms": {name: {count, total, mean, max, p50, p99, p999...}}}
+        """
+        return self.metrics.snapshot()
+
+    def version(self):
+        """
+        Gets the write version of the database file without reading it (it changes with every write of any
+        instance or process, queued writes change it when they are written)
+        :return: version (only compared for equality)
+        """
+        return self.storage.version()
+
     def get_name(self) -> str:
         """
         Gets file name
@@ -138,23 +522,27 @@ class FileDataBase(DataBase):
         try:
             self.__read_database()
         except Exception as err:
-            logging.error(f"There was a problem trying to print database: {err}")
+            logging.error("There was a problem trying to print database: %s", err)
             raise err
         return f"{self.file_name}: " + super().__repr__()
 
 
 if __name__ == "__main__":
-    database = FileDataBase('testfile.bin')
-    try:
-        assert database.set_value('1', '2')
-        assert database.set_value(1, '3')
-        assert database.get_value(1) == '3'
-        assert database.delete_value('1') == '2'
-        assert database.get_value('1') is None
-        assert database.delete_value('1') is None
-        assert repr(database) == database.get_name() + ": {1: '3'}"
-    finally:
-        DeleteFile(database.get_name())
+    for storage_engine in ENGINES:
+        database = FileDataBase('testfile.bin', storage_engine)
+        try:
+            assert database.set_value('1', '2')
+            assert database.set_value(1, '3')
+            assert database.get_value(1) == '3'
+            assert database.delete_value('1') == '2'
+            assert database.get_value('1') is None
+            assert database.delete_value('1') is None
+            assert repr(database) == database.get_name() + ": {1: '3'}"
+            assert repr(FileDataBase('testfile.bin', storage_engine)) == database.get_name() + ": {1: '3'}"
+        finally:
+            files.delete(database.get_name())
+            if storage_engine == "log":
+                files.delete(database.get_name() + ".log")
     # logging configuration just when running
     # log_file = "file_database.log"                                                   # file to save the log
     # log_level = logging.DEBUG                                                        # set the minimum logger level
@@ -0,0 +1,387 @@
+"""
+Author: Tomas Dal Farra
+Date: 01/19/2023
+Description: TCP (or Unix socket) key-value server on top of the synchronized database and its client. The server
+keeps the dictionary in memory and writes changes to the database file in the background
+Every message is a frame: length of the body and opcode (status in answers) followed by the body, a list encoded
+with the binary codec (str, bytes, int and None). Answers go in the order of the requests, so clients can send many
+requests before reading (pipelining). Run the server with:
+python winAPI_server.py --port 6380 --file dbfile.bin
+https://github.com/Kloke93/database_sync
+"""
+from winAPI_sync_database import SyncDataBase
+from db_codecs import BinaryCodec
+from contextlib import contextmanager
+import threading
+import argparse
+import logging
+import asyncio
+import socket
+import struct
+import queue
+
+FRAME = struct.Struct("<IB")                # length of the body, opcode (request) or status (answer)
+MAX_FRAME = 1 << 26                         # bigger bodies close the connection
+GET, SET, DEL = 1, 2, 3                     # bodies: [key...], [key, value...], [key...]
+OK, ERROR = 0, 1                            # bodies: results, [error message]
+DEFAULT_PORT = 6380
+
+
+class ServerError(Exception):
+    """ The server couldn't do a request """
+
+
+def frame(code, objs) -> bytes:
+    """
+    Builds a message
+    :param code: opcode or status
+    :param objs: objects of the body
+    :return: message bytes
+    """
+    body = BinaryCodec.pack(objs)
+    return FRAME.pack(len(body), code) + body
+
+
+class DataBaseServer:
+    """
+    Key-value server: reads are answered from memory, changes are written to the database file every flush
+    interval (in a single transaction). It must be the only writer of the database file
+    """
+    FLUSH_INTERVAL = 0.05                   # seconds between writes of the changes to file
+    _DELETED = object()
+
+    def __init__(self, mode, file_name="dbfile.bin", engine="snapshot", codec="pickle",
+                 flush_interval=FLUSH_INTERVAL):
+        """
+        Initializer for the server, loads the whole database in memory
+        :param mode: Takes a flag 1 or 0 where this means threading or multiprocessing correspondingly
+        :param file_name: Name of file for the database
+        :param engine: How changes are persisted: "snapshot", "log" or "hash"
+        :param codec: Serializer of the dictionary in file
+        :param flush_interval: seconds between writes of the changes to file
+        """
+        self.database = SyncDataBase(mode, file_name, engine, codec=codec)
+        with self.database.transaction() as db:
+            self.data = dict(db.db.items())
+        self.flush_interval = flush_interval
+        self.dirty = {}                     # key: value (or _DELETED) changed since the last flush
+        self.flush_lock = asyncio.Lock()    # changes are written in order, one flush at a time
+        self.connections = set()            # writers of the open connections
+        self.server = None
+        self.flusher = None
+
+    def _write(self, changes):
+        """ Writes changes to the database file (in a thread, the event loop keeps answering) """
+        sets = {key: val for key, val in changes.items() if val is not DataBaseServer._DELETED}
+        deletes = [key for key, val in changes.items() if val is DataBaseServer._DELETED]
+        with self.database.transaction() as db:
+            if sets:
+                db.set_many(sets)
+            if deletes:
+                db.delete_many(deletes)
+
+    async def flush(self):
+        """ Writes the changes since the last flush to file """
+        async with self.flush_lock:
+            if not self.dirty:
+                return
+            changes, self.dirty = self.dirty, {}
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._write, changes)
+            except Exception as err:
+                logging.error("Changes of the server were not written: %s", err)
+                self.dirty = {**changes, **self.dirty}                  # tried again in the next flush
+
+    async def _flush_forever(self):
+        """ Flushes every flush interval """
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await asyncio.shield(self.flush())          # a flush that started ends even if the server closes
+
+    def execute(self, opcode, body) -> bytes:
+        """
+        Does a request
+        :param opcode: GET, SET or DEL
+        :param body: request body
+        :return: answer message
+        """
+        try:
+            args = BinaryCodec.unpack(body)
+            if opcode == GET:
+                results = [self.data.get(key) for key in args]
+            elif opcode == SET:
+                for key, val in zip(args[::2], args[1::2]):
+                    self.data[key] = val
+                    self.dirty[key] = val
+                results = [len(args) // 2]
+            elif opcode == DEL:
+                results = [self.data.pop(key, None) for key in args]
+                for key in args:
+                    self.dirty[key] = DataBaseServer._DELETED
+            else:
+                raise ValueError(f"Unknown opcode {opcode}")
+            return frame(OK, results)
+        except Exception as err:
+            return frame(ERROR, [f"{type(err).__name__}: {err}"])
+
+    async def _serve(self, reader, writer):
+        """ Answers the requests of a connection in order """
+        self.connections.add(writer)
+        try:
+            while True:
+                length, opcode = FRAME.unpack(await reader.readexactly(FRAME.size))
+                if length > MAX_FRAME:
+                    logging.error("Frame of %s bytes, closing connection", length)
+                    break
+                writer.write(self.execute(opcode, await reader.readexactly(length)))
+                await writer.drain()                # only waits if the client doesn't read its answers
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass                                    # client closed the connection
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=DEFAULT_PORT, path=None):
+        """
+        Starts listening and writing changes in the background
+        :param host: address to listen at
+        :param port: TCP port (0 takes a free one)
+        :param path: Unix socket path (instead of TCP)
+        :return: address listened at
+        """
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self._serve, path)
+        else:
+            self.server = await asyncio.start_server(self._serve, host, port)
+        self.flusher = asyncio.ensure_future(self._flush_forever())
+        return self.server.sockets[0].getsockname()
+
+    async def serve(self, host="127.0.0.1", port=DEFAULT_PORT, path=None):
+        """ Starts the server and serves until it is cancelled """
+        await self.start(host, port, path)
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        """ Stops listening and writes the last changes """
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.connections):
+                writer.close()
+            await self.server.wait_closed()
+        await self.flush()
+
+
+class Pipeline:
+    """ Requests sent together by execute, answers are read after sending all of them """
+    def __init__(self, client):
+        self.client = client
+        self.requests = []                          # (opcode, objects, how to get the result from the answer)
+
+    def get_value(self, key):
+        """ Adds a get_value (result: value or None) """
+        self.requests.append((GET, [key], lambda results: results[0]))
+        return self
+
+    def get_many(self, keys):
+        """ Adds a get_many (result: list of values) """
+        self.requests.append((GET, list(keys), lambda results: results))
+        return self
+
+    def set_value(self, key, val):
+        """ Adds a set_value (result: True) """
+        self.requests.append((SET, [key, val], lambda results: True))
+        return self
+
+    def set_many(self, items):
+        """ Adds a set_many (result: True) """
+        objs = [obj for item in dict(items).items() for obj in item]
+        self.requests.append((SET, objs, lambda results: True))
+        return self
+
+    def delete_value(self, key):
+        """ Adds a delete_value (result: deleted value or None) """
+        self.requests.append((DEL, [key], lambda results: results[0]))
+        return self
+
+    def delete_many(self, keys):
+        """ Adds a delete_many (result: list of deleted values) """
+        self.requests.append((DEL, list(keys), lambda results: results))
+        return self
+
+    def execute(self) -> list:
+        """
+        Sends the requests and reads their answers
+        :return: result of each request in order
+        """
+        requests, self.requests = self.requests, []
+        answers = self.client.call([(opcode, objs) for opcode, objs, _ in requests])
+        return [result(answer) for (_, _, result), answer in zip(requests, answers)]
+
+
+class DataBaseClient:
+    """
+    Client of the key-value server. Connections are kept in a pool shared by the threads that use the client
+    """
+    POOL_SIZE = 4
+
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, path=None, pool_size=POOL_SIZE, timeout=10):
+        """
+        Initializer for the client (connects when a request needs it)
+        :param host: server address
+        :param port: server TCP port
+        :param path: server Unix socket path (instead of TCP)
+        :param pool_size: maximum open connections (more threads wait for a free one)
+        :param timeout: seconds to wait for the server
+        """
+        self.address = path if path is not None else (host, port)
+        self.family = socket.AF_UNIX if path is not None else socket.AF_INET
+        self.timeout = timeout
+        self.pool = queue.LifoQueue()                   # idle connections
+        self.slots = threading.BoundedSemaphore(pool_size)
+
+    def _connect(self) -> socket.socket:
+        """ Opens a connection to the server """
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        if self.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.connect(self.address)
+        return sock
+
+    @contextmanager
+    def _connection(self):
+        """ Takes a connection of the pool (opens it if there isn't an idle one) and gives it back """
+        self.slots.acquire()
+        try:
+            try:
+                sock = self.pool.get_nowait()
+            except queue.Empty:
+                sock = self._connect()
+            try:
+                yield sock
+            except BaseException:
+                sock.close()                            # answers of the connection may be half read
+                raise
+            self.pool.put(sock)
+        finally:
+            self.slots.release()
+
+    @staticmethod
+    def _recv(sock, size) -> bytearray:
+        """ Reads exactly size bytes of a connection """
+        buffer = bytearray(size)
+        with memoryview(buffer) as view:
+            done = 0
+            while done < size:
+                read = sock.recv_into(view[done:])
+                if not read:
+                    raise ConnectionError("Server closed the connection")
+                done += read
+        return buffer
+
+    def call(self, requests) -> list:
+        """
+        Sends requests in one write and reads their answers
+        :param requests: list of (opcode, objects)
+        :return: list of results of each request
+        """
+        with self._connection() as sock:
+            sock.sendall(b"".join(frame(opcode, objs) for opcode, objs in requests))
+            answers = []
+            for _ in requests:
+                length, status = FRAME.unpack(self._recv(sock, FRAME.size))
+                answers.append((status, BinaryCodec.unpack(self._recv(sock, length))))
+        for status, results in answers:
+            if status != OK:
+                raise ServerError(results[0])
+        return [results for _, results in answers]
+
+    def pipeline(self) -> Pipeline:
+        """
+        Gets a pipeline to send many requests at once
+        :return: pipeline
+        """
+        return Pipeline(self)
+
+    def set_value(self, key, val) -> bool:
+        """
+        Sets new key:value in the server
+        :param key: Key for the database (str, bytes or int)
+        :param val: Value of the key (str, bytes, int or None)
+        :return: If the operation was successful
+        """
+        return self.pipeline().set_value(key, val).execute()[0]
+
+    def get_value(self, key):
+        """
+        Gets value according to the key from the server
+        If key doesn't exist None is returned
+        :param key: Key for the database element
+        :return: Value from the database if found
+        """
+        return self.pipeline().get_value(key).execute()[0]
+
+    def delete_value(self, key):
+        """
+        Deletes value from the server
+        :param key: Key for a database value
+        :return: Deleted value if existed
+        """
+        return self.pipeline().delete_value(key).execute()[0]
+
+    def set_many(self, items) -> bool:
+        """
+        Sets many key:value in one request
+        :param items: dictionary or iterable of (key, value)
+        :return: If the operation was successful
+        """
+        return self.pipeline().set_many(items).execute()[0]
+
+    def get_many(self, keys) -> list:
+        """
+        Gets the values of many keys in one request
+        :param keys: iterable of keys
+        :return: list of values in the same order as the keys (None for keys that don't exist)
+        """
+        return self.pipeline().get_many(keys).execute()[0]
+
+    def delete_many(self, keys) -> list:
+        """
+        Deletes many values in one request
+        :param keys: iterable of keys
+        :return: list of deleted values (None for keys that didn't exist)
+        """
+        return self.pipeline().delete_many(keys).execute()[0]
+
+    def close(self):
+        """ Closes the idle connections """
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Key-value server of the synchronized database")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen at")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="TCP port")
+    parser.add_argument("--path", help="Unix socket path (instead of TCP)")
+    parser.add_argument("--file", default="dbfile.bin", help="database file")
+    parser.add_argument("--engine", default="snapshot", help="storage engine of the database file")
+    args = parser.parse_args()
+    server = DataBaseServer(0, args.file, args.engine)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.path))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""
+Author: Tomas Dal Farra
+Date: 01/19/2023
+Description: Synchronized database split in shard files, each one with its own lock so that writers of different
+shards don't wait for each other
+https://github.com/Kloke93/database_sync
+"""
+from winAPI_sync_database import SyncDataBase
+from storage_engines import HashStorage
+from dict_database import DataBase
+from contextlib import contextmanager, ExitStack
+import numbers
+import heapq
+import os
+
+
+class ShardedSyncDataBase:
+    """
+    Synchronized database with keys partitioned by hash in N files (dbfile.0.bin, dbfile.1.bin...)
+    """
+    def __init__(self, mode, file_name="dbfile.bin", shards=4, engine="snapshot",
+                 readers=SyncDataBase.READERS_BOUND, snapshot_reads=False, codec="pickle", durability="sync"):
+        """
+        Initializer for sharded synchronized database class
+        :param mode: Takes a flag 1 or 0 where this means threading or multiprocessing correspondingly
+        :param file_name: Base name of the shard files (the shard number goes before the extension)
+        :param shards: Amount of shard files (every instance of the database must use the same)
+        :param engine: How changes are persisted: "snapshot", "log" or "hash"
+        :param readers: Maximum readers at the same time in each shard
+        :param snapshot_reads: Readers don't lock, they read the last published version of the shard
+        :param codec: Serializer of the dictionaries: "pickle", "marshal" or "binary", with "+zlib" to compress it
+        :param durability: When writes are on disk: "sync", "group" or "async" (see FileDataBase)
+        """
+        root, ext = os.path.splitext(file_name)
+        self.file_name = file_name
+        self.shards = [SyncDataBase(mode, f"{root}.{n}{ext}", engine, readers, snapshot_reads, codec, durability)
+                       for n in range(shards)]
+
+    @staticmethod
+    def key_hash(key) -> int:
+        """
+        Gets a hash of a key that is the same in every process and for equal keys of different types (1, 1.0 and
+        True): hash() of numbers (not randomized), the hash of the pickled key for other keys
+        :param key: Key for the database
+        :return: hash
+        """
+        if isinstance(key, numbers.Number):
+            return hash(key)
+        if isinstance(key, tuple):
+            items = b"".join((ShardedSyncDataBase.key_hash(item) % (1 << 64)).to_bytes(8, "little") for item in key)
+            return HashStorage.key_hash(b"(" + items)
+        return HashStorage.key_hash(HashStorage.key_bytes(key))
+
+    def shard(self, key) -> SyncDataBase:
+        """
+        Gets the shard of a key (the same in every process and for equal keys, see key_hash)
+        :param key: Key for the database
+        :return: database of the shard
+        """
+        return self.shards[ShardedSyncDataBase.key_hash(key) % len(self.shards)]
+
+    def _group(self, keys) -> dict:
+        """
+        Groups keys by shard
+        :param keys: iterable of keys
+        :return: {shard: [(position in keys, key)...]}
+        """
+        groups = {}
+        for pos, key in enumerate(keys):
+            groups.setdefault(self.shard(key), []).append((pos, key))
+        return groups
+
+    def set_value(self, key, val) -> bool:
+        """
+        Sets new key:value in the shard of the key
+        :param key: Key for the database
+        :param val: Value of the key
+        :return: If the operation was successful
+        """
+        return self.shard(key).set_value(key, val)
+
+    def get_value(self, key):
+        """
+        Gets value according to the key from its shard
+        If key doesn't exist None is returned
+        :param key: Key for the database element
+        :return: Value from the database if found
+        """
+        return self.shard(key).get_value(key)
+
+    def delete_value(self, key):
+        """
+        Deletes value from the shard of the key
+        :param key: Key for a database value
+        :return: Deleted value if existed
+        """
+        return self.shard(key).delete_value(key)
+
+    def set_many(self, items) -> bool:
+        """
+        Sets many key:value, one write for each shard (shards are written one after the other, not at once)
+        :param items: dictionary or iterable of (key, value)
+        :return: If the operation was successful
+        """
+        items = dict(items)
+        is_set = True
+        for shard, keys in self._group(items).items():
+            is_set = shard.set_many({key: items[key] for _, key in keys}) and is_set
+        return is_set
+
+    def get_many(self, keys) -> list:
+        """
+        Gets the values of many keys, one read for each shard (use a transaction to read every shard at once)
+        :param keys: iterable of keys
+        :return: list of values in the same order as the keys (None for keys that don't exist)
+        """
+        keys = list(keys)
+        vals = [None] * len(keys)
+        for shard, group in self._group(keys).items():
+            for (pos, _), val in zip(group, shard.get_many([key for _, key in group])):
+                vals[pos] = val
+        return vals
+
+    def delete_many(self, keys) -> list:
+        """
+        Deletes many values, one write for each shard
+        :param keys: iterable of keys
+        :return: list of deleted values (None for keys that didn't exist)
+        """
+        keys = list(keys)
+        deleted = [None] * len(keys)
+        for shard, group in self._group(keys).items():
+            for (pos, _), val in zip(group, shard.delete_many([key for _, key in group])):
+                deleted[pos] = val
+        return deleted
+
+    def scan(self, start=None, end=None):
+        """
+        Iterates the entries with start <= key < end of every shard in key order (see DataBase.key_order), lazily
+        a page of each shard at a time
+        :param start: first key (None from the first key)
+        :param end: key where the scan stops, not included (None until the last key)
+        :return: iterator of (key, value)
+        """
+        return heapq.merge(*(shard.scan(start, end) for shard in self.shards),
+                           key=lambda item: DataBase.key_order(item[0]))
+
+    def prefix(self, prefix):
+        """
+        Iterates the entries of every shard whose key starts with a prefix in key order, lazily
+        :param prefix: str or bytes (only keys of the same type)
+        :return: iterator of (key, value)
+        """
+        return heapq.merge(*(shard.prefix(prefix) for shard in self.shards),
+                           key=lambda item: DataBase.key_order(item[0]))
+
+    def update(self, key, func):
+        """
+        Sets the value of a key from its previous value atomically (under the write lock of its shard)
+        :param key: Key for the database
+        :param func: function that gets the previous value (None if it didn't exist) and returns the new one
+        :return: New value of the key
+        """
+        return self.shard(key).update(key, func)
+
+    def incr(self, key, delta=1):
+        """
+        Adds to the value of a key atomically under the write lock of its shard only, so counters of different
+        shards are updated in parallel (the shard locks are the striped locks of the key space)
+        :param key: Key for the database
+        :param delta: amount to add
+        :return: New value of the key
+        """
+        return self.shard(key).incr(key, delta)
+
+    def compare_and_set(self, key, expected, new) -> bool:
+        """
+        Sets the value of a key atomically only if it is still the expected one (in its shard)
+        :param key: Key for the database
+        :param expected: value the key must have (None for a key that doesn't exist)
+        :param new: new value of the key
+        :return: If the value was set
+        """
+        return self.shard(key).compare_and_set(key, expected, new)
+
+    def setdefault(self, key, default):
+        """
+        Sets the value of a key atomically only if it doesn't exist (in its shard)
+        :param key: Key for the database
+        :param default: value for the key if it doesn't exist
+        :return: value of the key (default if it was set)
+        """
+        return self.shard(key).setdefault(key, default)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Takes the write lock of every shard (always in the same order) for the whole block, each shard is written
+        once at the end. If the block raises nothing is written
+        :return: context manager that gives the database
+        """
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.transaction())
+            yield self
+
+    def flush(self):
+        """ Waits until every write queued until now is written to the shard files """
+        for shard in self.shards:
+            shard.flush()
+
+    def version(self) -> tuple:
+        """
+        Gets the write version of the database (it changes with every write to any shard)
+        :return: versions of the shards
+        """
+        return tuple(shard.version() for shard in self.shards)
+
+    def _set_value_testing(self, key) -> bool:
+        """ Special set_value modification to change previous value of key in dictionary by one"""
+        return self.shard(key)._set_value_testing(key)
+
+    def get_name(self) -> str:
+        """
+        Gets base file name
+        :return: file name
+        """
+        return self.file_name
+
+    def __repr__(self):
+        """
+        Prints base file name and then the shards
+        :return: string description of the database
+        """
+        return f"{self.file_name}: [" + ", ".join(repr(shard) for shard in self.shards) + "]"
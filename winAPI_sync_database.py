@@ -1,105 +1,203 @@
 """
 Author: Tomas Dal Farra
 Date: 01/19/2023
-Description: Synchronized database class with win32event
+Description: Synchronized database class with win32event (threading or fcntl locks where it is not available)
 https://github.com/Kloke93/database_sync
 """
-from win32event import CreateMutex, CreateSemaphore, ReleaseMutex, ReleaseSemaphore
-from win32event import CreateEvent, SetEvent, ResetEvent
-from win32event import WaitForSingleObject, WAIT_ABANDONED, WAIT_OBJECT_0, WAIT_TIMEOUT
+from sync_backend import get_backend, WAIT_ABANDONED, WAIT_OBJECT_0, WAIT_TIMEOUT
 from winAPI_file_database import FileDataBase
+from storage_engines import HashStorage
+from dict_database import DataBase
+from db_stats import Stats
+from contextlib import contextmanager
+import threading
+import time
+import hashlib
 import logging
+import pickle
+import os
 
 
 class SyncDataBase(FileDataBase):
     """
     Simple database thread/process synchronized
     """
-    # All the not_reading event part was commented out because it didn't work.
     READERS_BOUND = 10
+    SNAPSHOT_RETRIES = 3                        # lock-free reads tried before taking the read lock
+    STRIPES = 64                                # locks of update (incr, compare_and_set...) by key hash
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.DEBUG)              # set the minimum logger level
+    logger_lock = threading.Lock()              # the log file handler is added once, by the first instance
+    LOG_FILE = os.environ.get("DATABASE_LOG", "file_database.log")     # file to save the log (None for no file)
 
-    def __init__(self, mode, file_name="dbfile.bin"):
+    def __init__(self, mode, file_name="dbfile.bin", engine="snapshot", readers=READERS_BOUND,
+                 snapshot_reads=False, codec="pickle", durability="sync", feed=False):
         """
         Initializer for synchronized database class
         :param mode: Takes a flag 1 or 0 where this means threading or multiprocessing correspondingly
         :param file_name: Name of file for the database
+        :param engine: How changes are persisted: "snapshot" (whole file rewritten), "log" (append-only log) or
+        "hash" (hash index and values mapped in memory)
+        :param readers: Maximum readers at the same time (the first instance that creates the lock sets it)
+        :param snapshot_reads: Readers don't lock, they read the last published version of the database (writers
+        publish whole files by renaming them over the database file). With the "hash" engine they read the values
+        straight from the file mapped in memory, shared by every process
+        :param codec: Serializer of the dictionary: "pickle", "marshal" or "binary", with "+zlib" to compress it
+        :param durability: When writes are on disk: "sync", "group" (writes of many threads written and synced
+        together) or "async" (written and synced in the background), see FileDataBase
+        :param feed: Writes also append to the change feed that watch() tails, see FileDataBase
         """
-        # Event to check if there are writers
-        self.not_writing = CreateEvent(None,                            # default security attributes
-                                       True,                            # manual-reset event
-                                       True,                            # initial state is signaled
-                                       "not_writing")                   # event name
-
-        # Mutex for writers
-        self.to_write_lock = CreateMutex(None,                          # default security attributes
-                                         False,                         # initially not owned
-                                         "to_write_lock")               # mutex name
-
-        # Semaphore to limit readers and for one writer at a time
-        self.semaphore = CreateSemaphore(None,                          # default security attributes
-                                         SyncDataBase.READERS_BOUND,    # initial count
-                                         SyncDataBase.READERS_BOUND,    # maximum count
-                                         "limit_semaphore")             # unnamed semaphore
-        # logging format
-        if mode or True:
-            formatter = logging.Formatter("[%(filename)s][%(threadName)s][%(asctime)s] %(message)s")
-        else:
-            formatter = logging.Formatter("[%(filename)s][%(processName)s][%(asctime)s] %(message)s")
-        # logger configuration
-        file_handler = logging.FileHandler("file_database.log")         # file to save the log
-        file_handler.setFormatter(formatter)
-        SyncDataBase.logger.addHandler(file_handler)
-        SyncDataBase.logger.info(f"Start in mode {mode}")
+        self.snapshot_reads = snapshot_reads
+        self.published = None                                           # (version, dictionary) for readers
+        self.saved_version = None                                       # version self.db was saved as (copied later)
+        self.backend = get_backend(mode)                                # cheapest primitives for the mode
+        self.writer = None                                              # thread holding the write lock
+        self.write_depth = 0                                            # nested write locks of that thread
+        self.stripes = [threading.Lock() for _ in range(SyncDataBase.STRIPES)]
+        # Reader-writer lock (writer preference): one acquire for writers whatever the amount of readers is
+        self.rwlock = self.backend.create_rwlock(self.lock_name(file_name), readers)
+        SyncDataBase.setup_logger(mode)
+        SyncDataBase.logger.info("Start in mode %s (%s backend)", mode, self.backend.name)
+        self.metrics = Stats()                                          # lock waits, I/O and codec times
         # creating synchronized instance
         self.__lock_write()
-        super().__init__(file_name)
+        super().__init__(file_name, engine, codec, durability, feed)
         self.__release_write()
 
     @staticmethod
-    def __check_wait(w):
+    def setup_logger(mode):
+        """
+        Adds the handler of LOG_FILE to the logger the first time it is called (later instances use the same one)
+        :param mode: Takes a flag 1 or 0 where this means threading or multiprocessing correspondingly
+        """
+        with SyncDataBase.logger_lock:
+            if SyncDataBase.logger.handlers or SyncDataBase.LOG_FILE is None:
+                return
+            # logging format
+            if mode or True:
+                formatter = logging.Formatter("[%(filename)s][%(threadName)s][%(asctime)s] %(message)s")
+            else:
+                formatter = logging.Formatter("[%(filename)s][%(processName)s][%(asctime)s] %(message)s")
+            # logger configuration
+            file_handler = logging.FileHandler(SyncDataBase.LOG_FILE)
+            file_handler.setFormatter(formatter)
+            SyncDataBase.logger.addHandler(file_handler)
+
+    @staticmethod
+    def lock_name(file_name) -> str:
+        """
+        Gets the name of the lock of a database file, so that only instances of the same file wait for each other
+        :param file_name: Name of file for the database
+        :return: lock name (valid for named win32 objects and file names)
+        """
+        path = os.path.normcase(os.path.abspath(file_name))
+        return "database_lock_" + hashlib.blake2b(path.encode(), digest_size=8).hexdigest()
+
+    def __check_wait(self, w):
         """ Checks if WaitForSingleObject was successfully executed """
         if w == WAIT_OBJECT_0:
             return None
         elif w == WAIT_ABANDONED:
+            self.metrics.count("lock_abandoned")
             SyncDataBase.logger.error("Wait was abandoned")
             raise Exception
         elif w == WAIT_TIMEOUT:
+            self.metrics.count("lock_timeouts")
             SyncDataBase.logger.error("Timeout was exceeded")
             raise Exception
 
     def __lock_write(self):
-        """ Manages locking for writing functions """
-        w = WaitForSingleObject(self.to_write_lock,                 # locks for other writers
-                                100000)                             # waits up to 100 seconds
+        """ Manages locking for writing functions (the thread that has the lock can take it again) """
+        if self.writer == threading.get_ident():
+            self.write_depth += 1
+            return
+        start = time.perf_counter()
+        w = self.rwlock.acquire_write(100000)                       # exclusive, waits up to 100 seconds
+        self.metrics.time("lock_write_wait", time.perf_counter() - start)
         self.__check_wait(w)
-        ResetEvent(self.not_writing)                                # There is someone writing (has priority)
-        for i in range(SyncDataBase.READERS_BOUND):
-            w = WaitForSingleObject(self.semaphore,                 # gets the whole semaphore buffer
-                                    100000)                         # waits up to 100 seconds
-            self.__check_wait(w)
+        self.writer = threading.get_ident()
+        self.write_depth = 1
 
     def __release_write(self):
         """ Manages releasing locking for writing functions """
-        ReleaseSemaphore(self.semaphore,                            # releases semaphore
-                         SyncDataBase.READERS_BOUND)                # increases count up to his maximum count
-        SetEvent(self.not_writing)                                  # Indicates no one is writing
-        ReleaseMutex(self.to_write_lock)                            # releases lock for other writers
+        self.write_depth -= 1
+        if self.write_depth:                                        # still inside an outer write lock
+            return
+        self.writer = None
+        self.rwlock.release_write()                                 # lets readers and other writers in
+
+    def __snapshot(self):
+        """
+        Gets the last published dictionary without locking, reading the file first if it has a newer version
+        :return: dictionary (must not be changed) or None if the file kept changing while reading it
+        """
+        if self.writer == threading.get_ident():                    # a transaction reads its own changes
+            return None
+        for _ in range(SyncDataBase.SNAPSHOT_RETRIES):
+            try:
+                version = self.storage.version()
+                published = self.published
+                if published is None or published[0] != version:
+                    published = self.__publish(version) or self.storage.read_all()
+                    self.published = published
+                return published[1]
+            except Exception as err:                                # file replaced while it was opened
+                SyncDataBase.logger.debug("Snapshot read retried: %s", err)
+        return None
+
+    def __snapshot_values(self, keys):
+        """
+        Gets values without locking: straight from the memory shared by every process for the hash engine, from the
+        last published dictionary for the others
+        :param keys: list of keys
+        :return: list of values (None for keys that don't exist) or None if the file kept changing while reading it
+        """
+        if self.storage.SHARED:
+            if self.writer == threading.get_ident():                # a transaction reads its own changes
+                return None
+            return self.storage.read_values(keys)
+        db = self.__snapshot()
+        return None if db is None else [db.get(key) for key in keys]
+
+    def __publish(self, version):
+        """
+        Copies the dictionary this instance saved as a version of the file, if no writer has the lock (readers don't
+        wait for it, they read the file instead)
+        :param version: version of the file
+        :return: (version, dictionary) or None if it isn't the one saved or a writer has the lock
+        """
+        if version != self.saved_version or self.rwlock.acquire_read(0) != WAIT_OBJECT_0:
+            return None
+        try:
+            if self.saved_version == version == self.storage.version():    # self.db is not changing now
+                return version, dict(self.db)
+        finally:
+            self.rwlock.release_read()
+        return None
+
+    def _on_save(self):
+        """ Remembers the version written, readers of this instance copy the dictionary the first time they read it """
+        if self.snapshot_reads and not self.storage.SHARED:
+            self.saved_version = self.storage.version()
+
+    def _on_invalidate(self):
+        """ Forgets the version written, self.db may have changes that are not in it """
+        self.saved_version = None
 
     def __lock_read(self):
-        """ Manages locking for reading functions """
-        w = WaitForSingleObject(self.not_writing,                   # waits until no one is writing
-                                100000)                             # waits up to 100 seconds
-        self.__check_wait(w)
-        w = WaitForSingleObject(self.semaphore,                     # reduces semaphore counter by 1 and blocks if = 0
-                                100000)                             # waits up to 100 seconds
+        """ Manages locking for reading functions (nothing to do for the thread that has the write lock) """
+        if self.writer == threading.get_ident():
+            return
+        start = time.perf_counter()
+        w = self.rwlock.acquire_read(100000)                        # waits for writers and a free reader slot
+        self.metrics.time("lock_read_wait", time.perf_counter() - start)
         self.__check_wait(w)
 
     def __release_read(self):
         """ Manages releasing locking for reading functions """
-        ReleaseSemaphore(self.semaphore,                            # increases semaphore count by one
-                         1)
+        if self.writer == threading.get_ident():
+            return
+        self.rwlock.release_read()                                  # frees the reader slot
 
     def set_value(self, key, val) -> bool:
         """
@@ -108,11 +206,13 @@ class SyncDataBase(FileDataBase):
         :param val: Value of the key
         :return: If the operation was successful
         """
+        if self._defers():                                          # queued, the committer takes the lock
+            return super().set_value(key, val)
         self.__lock_write()
         try:
             is_set = super().set_value(key, val)
         except Exception as err:
-            SyncDataBase.logger.error(f"Error setting key<{key}> to value<{val}>: {err}")
+            SyncDataBase.logger.error("Error setting key<%s> to value<%s>: %s", key, val, err)
             raise err
         finally:
             self.__release_write()
@@ -125,11 +225,18 @@ class SyncDataBase(FileDataBase):
         :param key: Key for the database element
         :return: Value from the database if found
         """
+        val = self._unflushed_value(key, self)
+        if val is not self:
+            return val
+        if self.snapshot_reads:
+            vals = self.__snapshot_values([key])
+            if vals is not None:
+                return vals[0]
         self.__lock_read()
         try:
             val = super().get_value(key)
         except Exception as err:
-            SyncDataBase.logger.error(f"Error getting key<{key}>: {err}")
+            SyncDataBase.logger.error("Error getting key<%s>: %s", key, err)
             raise err
         finally:
             self.__release_read()
@@ -141,25 +248,178 @@ class SyncDataBase(FileDataBase):
         :param key: Key for a database value
         :return: Deleted value if existed
         """
+        if self._defers():
+            return super().delete_value(key)
         self.__lock_write()
         try:
             deleted = super().delete_value(key)
         except Exception as err:
-            SyncDataBase.logger.error(f"Error deleting key<{key}>: {err}")
+            SyncDataBase.logger.error("Error deleting key<%s>: %s", key, err)
             raise err
         finally:
             self.__release_write()
         return deleted
 
-    def _set_value_testing(self, key) -> bool:
-        """ Special set_value modification to change previous value of key in dictionary by one"""
+    def set_many(self, items) -> bool:
+        """
+        Sets many key:value to database in file under a single write lock
+        :param items: dictionary or iterable of (key, value)
+        :return: If the operation was successful
+        """
+        if self._defers():
+            return super().set_many(items)
         self.__lock_write()
         try:
-            val = super().get_value(key)
-            is_set = super().set_value(key, val + 1)
+            is_set = super().set_many(items)
         except Exception as err:
-            SyncDataBase.logger.error(f"Error setting (test) key<{key}>: {err}")
+            SyncDataBase.logger.error("Error setting many values: %s", err)
             raise err
         finally:
             self.__release_write()
         return is_set
+
+    def get_many(self, keys) -> list:
+        """
+        Gets the values of many keys under a single read lock
+        :param keys: iterable of keys
+        :return: list of values in the same order as the keys (None for keys that don't exist)
+        """
+        keys = list(keys)
+        if self.snapshot_reads:
+            vals = self.__snapshot_values(keys)
+            if vals is not None:
+                return self._with_unflushed(keys, vals)
+        self.__lock_read()
+        try:
+            vals = super().get_many(keys)
+        except Exception as err:
+            SyncDataBase.logger.error("Error getting many values: %s", err)
+            raise err
+        finally:
+            self.__release_read()
+        return vals
+
+    def delete_many(self, keys) -> list:
+        """
+        Deletes many values from database in file under a single write lock
+        :param keys: iterable of keys
+        :return: list of deleted values (None for keys that didn't exist)
+        """
+        if self._defers():
+            return super().delete_many(keys)
+        self.__lock_write()
+        try:
+            deleted = super().delete_many(keys)
+        except Exception as err:
+            SyncDataBase.logger.error("Error deleting many values: %s", err)
+            raise err
+        finally:
+            self.__release_write()
+        return deleted
+
+    def stripe(self, key) -> threading.Lock:
+        """
+        Gets the lock of the stripe of a key (the same key always gets the same lock, other keys most likely not)
+        :param key: Key for the database
+        :return: lock
+        """
+        return self.stripes[HashStorage.key_hash(HashStorage.key_bytes(key)) % len(self.stripes)]
+
+    def update(self, key, func):
+        """
+        Sets the value of a key from its previous value atomically. The previous value is read and the new one is
+        computed under the lock of the key stripe only, the write lock is taken just to check that the key didn't
+        change meanwhile (the file has the same version or the key the same pickled value, values like nan are not
+        equal to themselves; it is computed again if it changed) and to save it. Updates of keys of other stripes run at
+        the same time. Queued writes and transactions update under the write lock
+        :param key: Key for the database
+        :param func: function that gets the previous value (None if it didn't exist) and returns the new one (or
+        DataBase.KEEP to write nothing), it may be called again if another instance changed the key meanwhile
+        :return: New value of the key
+        """
+        if self._defers():
+            return super().update(key, func)
+        if self.writer == threading.get_ident():                    # inside a transaction
+            return self.__update_locked(key, func)
+        with self.stripe(key):                                      # threads of the key wait here, not on the file
+            while True:
+                version = self.storage.version()
+                old = self.get_value(key)                           # read lock or lock-free
+                val = func(old)
+                if val is DataBase.KEEP:
+                    return old
+                self.__lock_write()
+                try:
+                    if self.storage.version() == version or self.__unchanged(key, old):
+                        super().set_value(key, val)
+                        return val
+                except Exception as err:
+                    SyncDataBase.logger.error("Error updating key<%s>: %s", key, err)
+                    raise err
+                finally:
+                    self.__release_write()
+                self.metrics.count("update_retries")
+
+    def __unchanged(self, key, old) -> bool:
+        """
+        Checks if a key still has a value read before, compared pickled (not with ==)
+        :param key: Key for the database
+        :param old: value read before
+        :return: if the value is the same
+        """
+        val = super().get_value(key)
+        return val is old or pickle.dumps(val, pickle.HIGHEST_PROTOCOL) == pickle.dumps(old, pickle.HIGHEST_PROTOCOL)
+
+    def __update_locked(self, key, func):
+        """ Sets the value of a key from its previous value under the write lock (see update) """
+        self.__lock_write()
+        try:
+            val = super().update(key, func)
+        except Exception as err:
+            SyncDataBase.logger.error("Error updating key<%s>: %s", key, err)
+            raise err
+        finally:
+            self.__release_write()
+        return val
+
+    @contextmanager
+    def transaction(self):
+        """
+        Takes the write lock for the whole block, every operation of the block is written to file once at the end
+        :return: context manager that gives the database
+        """
+        if self._defers():
+            self.flush()                                            # queued writes go before the transaction
+        self.__lock_write()
+        try:
+            with super()._transaction():
+                yield self
+        finally:
+            self.__release_write()
+
+    def _scan_page(self, low, inclusive, high, limit) -> list:
+        """
+        Gets the entries of the next page of a scan under the read lock (the lock isn't kept between pages)
+        :param low: sort key where the page starts (None from the first key)
+        :param inclusive: if a key with sort key low is in the page
+        :param high: sort key where the scan ends, not included (None until the last key)
+        :param limit: maximum entries
+        :return: list of (key, value) in order
+        """
+        self.__lock_read()
+        try:
+            return super()._scan_page(low, inclusive, high, limit)
+        except Exception as err:
+            SyncDataBase.logger.error("Error scanning values: %s", err)
+            raise err
+        finally:
+            self.__release_read()
+
+    def _set_value_testing(self, key) -> bool:
+        """ Special set_value modification to change previous value of key in dictionary by one"""
+        try:
+            self.incr(key)
+        except Exception as err:
+            SyncDataBase.logger.error("Error setting (test) key<%s>: %s", key, err)
+            raise err
+        return True
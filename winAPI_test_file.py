@@ -0,0 +1,562 @@
+"""
+Author: Tomas Dal Farra
+Date: 01/19/2023
+Description: Test file for the file database (without synchronization)
+https://github.com/Kloke93/database_sync
+"""
+from winAPI_file_database import FileDataBase
+from storage_engines import LogStorage, HashStorage, CorruptFileError
+from dict_database import DataBase, CompactDataBase
+from compact_maps import SortedArrayMap
+from db_feed import ChangeFeed
+import compact_maps
+from unittest import mock
+import sync_backend
+import multiprocessing
+import unittest
+import random
+import sys
+import pickle
+import zlib
+import time
+import os
+
+
+class TestFileDB(unittest.TestCase):
+    """ Class to test the file database of a single process """
+    test_fname = "testfile_file.bin"
+
+    @staticmethod
+    def get_database_dict():
+        """
+        Gets the database dictionary
+        :return: Dictionary from file
+        """
+        with open(TestFileDB.test_fname, "rb") as f:
+            db = pickle.load(f)
+        return db
+
+    def setUp(self):
+        """
+        sets up the testing file with a specific dictionary and creates an instance of the database
+        """
+        self.test_dict = {n: n * 100 for n in range(1, 51)}
+        with open(TestFileDB.test_fname, "wb") as f:
+            pickle.dump(self.test_dict, f)
+        self.file_db = FileDataBase(TestFileDB.test_fname)
+
+    def test_cached_reads(self):
+        """ Tests that reading without changes in the file does not read the whole file again """
+        with mock.patch.object(sync_backend.files, "read", wraps=sync_backend.files.read) as read:
+            for _ in range(100):
+                self.assertEqual(self.file_db.get_value(40), 4000)
+            self.assertEqual(read.call_count, 1)            # only the first read (opening doesn't read it)
+
+    def test_changes_from_other_instance(self):
+        """ Tests that changes written by other instance are seen (file changed, cache invalidated) """
+        other_db = FileDataBase(TestFileDB.test_fname)
+        for i in range(100):
+            self.assertTrue(other_db.set_value(40, i))
+            self.assertEqual(self.file_db.get_value(40), i)
+        self.assertIsNone(other_db.delete_value(60))
+        self.assertEqual(other_db.delete_value(40), 99)
+        self.assertIsNone(self.file_db.get_value(40))
+        del self.test_dict[40]
+        self.assertEqual(self.get_database_dict(), self.test_dict)
+
+    def test_transaction_single_write(self):
+        """ Tests that every change of a transaction is written to file at once """
+        with mock.patch.object(self.file_db.storage, "save", wraps=self.file_db.storage.save) as save:
+            with self.file_db.transaction() as db:
+                for i in range(100):
+                    db.set_value(i, db.get_value(i))
+                    self.test_dict[i] = self.test_dict.get(i)
+                db.delete_value(1)
+                del self.test_dict[1]
+            self.assertEqual(save.call_count, 1)
+        self.assertEqual(self.get_database_dict(), self.test_dict)
+
+    def test_atomic_ops(self):
+        """ Tests incr, compare_and_set and setdefault, and that the ones that change nothing don't write """
+        self.assertEqual(self.file_db.incr(40, 5), 4005)
+        self.assertEqual(self.file_db.incr(60), 1)
+        with mock.patch.object(self.file_db.storage, "save", wraps=self.file_db.storage.save) as save:
+            self.assertFalse(self.file_db.compare_and_set(40, 4000, 0))
+            self.assertEqual(self.file_db.setdefault(40, 0), 4005)
+            self.assertEqual(save.call_count, 0)
+            self.assertTrue(self.file_db.compare_and_set(40, 4005, 0))
+            self.assertTrue(self.file_db.compare_and_set(70, None, 7))
+            self.assertEqual(self.file_db.setdefault(80, 8), 8)
+            self.assertEqual(save.call_count, 3)
+        self.test_dict.update({40: 0, 60: 1, 70: 7, 80: 8})
+        self.assertEqual(self.get_database_dict(), self.test_dict)
+
+    def test_codec_detected(self):
+        """ Tests that a file written with other codec is read by instances with the default codec """
+        for codec in ("marshal", "binary+zlib", "pickle+zlib"):
+            writer = FileDataBase(TestFileDB.test_fname, codec=codec)
+            self.assertTrue(writer.set_value(0, codec))
+            self.test_dict[0] = codec
+            self.assertEqual(FileDataBase(TestFileDB.test_fname).storage.load({}), self.test_dict)
+            self.assertEqual(self.file_db.get_value(0), codec)
+
+    def test_binary_codec_types(self):
+        """ Tests that the binary codec refuses types it can't encode (and nothing is written) """
+        writer = FileDataBase(TestFileDB.test_fname, codec="binary")
+        with self.assertRaises(TypeError):
+            writer.set_value(0, 1.5)
+        self.assertEqual(writer.get_value(0), None)
+        self.assertEqual(FileDataBase(TestFileDB.test_fname).storage.load({}), self.test_dict)
+
+    def test_scan(self):
+        """ Tests range and prefix scans in key order, a page at a time, with changes of this and other instance """
+        other_db = FileDataBase(TestFileDB.test_fname)
+        with mock.patch.object(DataBase, "SCAN_PAGE", 4):
+            self.assertEqual(list(self.file_db.scan(10, 20)), [(n, n * 100) for n in range(10, 20)])
+            self.assertTrue(self.file_db.set_many({"ab": 1, "abc": 2, "ac": 3, b"ab": 4, 15.5: 5}))
+            self.assertIsNone(self.file_db.delete_value(60))
+            self.assertEqual(self.file_db.delete_value(12), 1200)
+            self.assertTrue(other_db.set_value(13, 0))
+            self.assertEqual(list(self.file_db.scan(11, 16)), [(11, 1100), (13, 0), (14, 1400), (15, 1500),
+                                                                (15.5, 5)])
+            self.assertEqual(list(self.file_db.prefix("ab")), [("ab", 1), ("abc", 2)])
+            self.assertEqual(list(self.file_db.prefix("")), [("ab", 1), ("abc", 2), ("ac", 3)])
+            self.assertEqual(list(self.file_db.prefix(b"a")), [(b"ab", 4)])
+            self.assertEqual([key for key, _ in self.file_db.scan(48)], [48, 49, 50, "ab", "abc", "ac", b"ab"])
+            with self.assertRaises(KeyError):
+                with self.file_db.transaction() as db:
+                    db.set_value(16.5, 0)
+                    self.assertEqual(list(db.scan(16, 17)), [(16, 1600), (16.5, 0)])
+                    raise KeyError
+            self.assertEqual(list(self.file_db.scan(16, 17)), [(16, 1600)])
+        with self.assertRaises(TypeError):
+            self.file_db.prefix(1)
+
+    def test_stats(self):
+        """ Tests that file I/O and encoding are counted only when they happen """
+        self.assertNotIn("file_read", self.file_db.stats()["histograms"])     # opened without reading it
+        for i in range(5):
+            self.file_db.get_value(i)
+            self.assertTrue(self.file_db.set_value(i, i))
+        stats = self.file_db.stats()
+        self.assertEqual(stats["histograms"]["file_read"]["count"], 1)
+        self.assertEqual(stats["histograms"]["encode"]["count"], 5)
+        self.assertEqual(stats["histograms"]["file_write"]["count"], 5)
+        self.assertGreaterEqual(stats["counters"]["file_write_bytes"], 5 * os.path.getsize(TestFileDB.test_fname) - 50)
+        hook = mock.Mock()
+        self.file_db.metrics.export(hook, 0.01)
+        time.sleep(0.1)
+        self.file_db.metrics.stop_export()
+        self.assertEqual(hook.call_args.args[0]["counters"], stats["counters"])
+
+    def test_watch(self):
+        """ Tests that writes of other instances are watched with their old values and resumed from a version """
+        writer = FileDataBase(TestFileDB.test_fname, feed=True)
+        reader = FileDataBase(TestFileDB.test_fname, feed=True)
+        watch = reader.watch(prefix="a")
+        everything = reader.watch()
+        writer.set_value("a1", 1)
+        writer.set_value(1, 0)
+        with writer.transaction() as db:
+            db.set_value("a1", 2)
+            db.set_value("a2", 3)
+            db.delete_value("a1")
+        writer.delete_value("a3")                           # didn't exist, nothing changes
+        self.assertEqual([tuple(watch.next_event(1)) for _ in range(4)],
+                         [("a1", None, 1, 1), ("a1", 1, 2, 3), ("a2", None, 3, 4), ("a1", 2, None, 5)])
+        self.assertIsNone(watch.next_event(0))
+        self.assertEqual(everything.next_event(1)[1:], (None, 1, 1))
+        self.assertEqual(tuple(everything.next_event(1)), (1, 100, 0, 2))
+        resumed = FileDataBase(TestFileDB.test_fname, feed=True).watch(keys=["a1"], since=3)
+        self.assertEqual(tuple(resumed.next_event(1)), ("a1", 2, None, 5))
+        with self.assertRaises(ValueError):
+            self.file_db.watch()
+
+    def test_watch_trimmed(self):
+        """ Tests that watchers follow the feed when it drops its oldest half and fail if they were behind it """
+        self.file_db = FileDataBase(TestFileDB.test_fname, feed=True)
+        watch = self.file_db.watch()
+        behind = self.file_db.watch()
+        with mock.patch.object(ChangeFeed, "FEED_BYTES", 1000):
+            for i in range(100):
+                self.file_db.set_value(1, i)
+                self.assertEqual(watch.next_event(1).new, i)
+        with self.assertRaises(ValueError):
+            behind.next_event(0)
+        self.assertLess(os.path.getsize(TestFileDB.test_fname + ".feed"), 1000)
+
+    def test_feed_rewritten(self):
+        """ Tests that writers and watchers read again a feed rewritten with the same size """
+        def records(changes, version):
+            data = bytearray()
+            for change in changes:
+                record = pickle.dumps(change, pickle.HIGHEST_PROTOCOL)
+                version += 1
+                data += ChangeFeed.RECORD.pack(version, len(record), zlib.crc32(record)) + record
+            return data
+
+        feed = ChangeFeed(TestFileDB.test_fname)
+        other = ChangeFeed(TestFileDB.test_fname)
+        self.assertEqual(feed.append([("a", None, 1)]), 1)
+        self.assertEqual(other.append([("b", None, 2)]), 2)
+        watch = other.watch()
+        rewritten = records([("a", None, 1), ("b", None, 3)], 2)
+        self.assertEqual(len(rewritten), os.path.getsize(feed.feed_name))
+        with open(feed.feed_name, "wb") as f:
+            f.write(rewritten)
+        self.assertEqual(tuple(watch.next_event(0)), ("a", None, 1, 3))
+        self.assertEqual(tuple(watch.next_event(0)), ("b", None, 3, 4))
+        self.assertEqual(other.append([("c", None, 5)]), 5)
+
+    def test_watch_start(self):
+        """ Tests that a new watch doesn't read the feed that its instance already knows """
+        self.file_db = FileDataBase(TestFileDB.test_fname, feed=True)
+        for i in range(10):
+            self.file_db.set_value(1, i)
+        with mock.patch.object(ChangeFeed, "_read", wraps=self.file_db.feed._read) as read:
+            watch = self.file_db.watch()
+            read.assert_not_called()
+        self.file_db.set_value(1, 10)
+        self.assertEqual(tuple(watch.next_event(1)), (1, 9, 10, 11))
+
+    def tearDown(self):
+        """
+        Deletes the testing file
+        """
+        os.remove(TestFileDB.test_fname)
+        if os.path.exists(TestFileDB.test_fname + ".feed"):
+            os.remove(TestFileDB.test_fname + ".feed")
+
+
+class TestLogFileDB(unittest.TestCase):
+    """ Class to test the file database with the append-only log engine """
+    test_fname = "testfile_log.bin"
+
+    def setUp(self):
+        """
+        creates an instance of the database with the log engine from the testing dictionary
+        """
+        self.test_dict = {n: n * 100 for n in range(1, 51)}
+        with open(TestLogFileDB.test_fname, "wb") as f:
+            pickle.dump(self.test_dict, f)
+        self.file_db = FileDataBase(TestLogFileDB.test_fname, "log")
+
+    def reopen_dict(self):
+        """
+        Gets the dictionary that a new instance of the database loads
+        :return: Dictionary from snapshot and log
+        """
+        return FileDataBase(TestLogFileDB.test_fname, "log").storage.load({})
+
+    def test_writes_append(self):
+        """ Tests that set/delete append to the log without rewriting the snapshot """
+        self.file_db.set_value(0, 0)                # first write starts the log (the snapshot gets its footer)
+        self.test_dict[0] = 0
+        snapshot_size = os.path.getsize(TestLogFileDB.test_fname)
+        for i in range(100):
+            self.assertTrue(self.file_db.set_value(i % 10, i))
+            self.test_dict[i % 10] = i
+        self.assertEqual(self.file_db.delete_value(40), 4000)
+        del self.test_dict[40]
+        self.assertEqual(os.path.getsize(TestLogFileDB.test_fname), snapshot_size)
+        self.assertEqual(self.reopen_dict(), self.test_dict)
+
+    def test_changes_from_other_instance(self):
+        """ Tests that an instance reads the records appended by other instance """
+        other_db = FileDataBase(TestLogFileDB.test_fname, "log")
+        for i in range(50):
+            other_db.set_value(40, i)
+            self.assertEqual(self.file_db.get_value(40), i)
+        other_db.delete_value(40)
+        self.assertIsNone(self.file_db.get_value(40))
+
+    def test_compaction(self):
+        """ Tests that the log is compacted into the snapshot when it gets too big """
+        other_db = FileDataBase(TestLogFileDB.test_fname, "log")
+        with mock.patch.object(LogStorage, "CHECKPOINT_BYTES", 1024):
+            for i in range(500):
+                self.file_db.set_value(i, str(i))
+                self.test_dict[i] = str(i)
+                self.assertEqual(other_db.get_value(i), str(i))
+        self.assertLess(os.path.getsize(TestLogFileDB.test_fname + ".log"), 2048)
+        with open(TestLogFileDB.test_fname, "rb") as f:
+            self.assertGreater(len(pickle.load(f)), len(self.test_dict) // 2)     # most records are in the snapshot
+        self.assertEqual(self.reopen_dict(), self.test_dict)
+        self.assertEqual(other_db.db, self.test_dict)
+
+    def test_checkpoint(self):
+        """ Tests that checkpoints write only the changed keys to the delta and leave the snapshot as it is """
+        self.file_db.set_many({n: "x" * 100 for n in range(1000)})
+        self.test_dict.update({n: "x" * 100 for n in range(1000)})
+        with mock.patch.object(LogStorage, "CHECKPOINT_BYTES", 1024):
+            self.file_db.storage.compact(self.file_db.db)
+            snapshot_stamp = os.stat(TestLogFileDB.test_fname).st_mtime_ns
+            other_db = FileDataBase(TestLogFileDB.test_fname, "log")
+            for i in range(100):
+                self.assertTrue(self.file_db.set_value(i % 20, i))
+                self.test_dict[i % 20] = i
+                self.assertEqual(other_db.get_value(i % 20), i)
+            self.assertEqual(self.file_db.delete_value(999), "x" * 100)
+            del self.test_dict[999]
+        self.assertEqual(os.stat(TestLogFileDB.test_fname).st_mtime_ns, snapshot_stamp)
+        self.assertEqual(len(self.file_db.storage.changes), 21)
+        self.assertLess(os.path.getsize(TestLogFileDB.test_fname + ".delta"), 1024)
+        self.assertEqual(self.reopen_dict(), self.test_dict)
+        self.assertEqual(other_db.get_value(999), None)
+        self.assertEqual(other_db.db, self.test_dict)
+
+    def test_lazy_open(self):
+        """ Tests that opening the database reads nothing until it is used """
+        with mock.patch.object(sync_backend.files, "read", wraps=sync_backend.files.read) as read:
+            database = FileDataBase(TestLogFileDB.test_fname, "log")
+            self.assertEqual(read.call_count, 0)
+            self.assertEqual(database.get_value(40), 4000)
+            self.assertEqual(read.call_count, 1)
+
+    def test_incomplete_record(self):
+        """ Tests that a half written record (crash) is ignored and overwritten by the next write """
+        self.file_db.set_value(1, "a")
+        with open(TestLogFileDB.test_fname + ".log", "ab") as f:
+            f.write(b"\x10\x00\x00\x00\x00")
+        self.test_dict[1] = "a"
+        self.assertEqual(self.reopen_dict(), self.test_dict)
+        writer = FileDataBase(TestLogFileDB.test_fname, "log")
+        writer.set_value(2, "b")
+        self.test_dict[2] = "b"
+        self.assertEqual(self.reopen_dict(), self.test_dict)
+
+    def tearDown(self):
+        """
+        Deletes the testing files
+        """
+        os.remove(TestLogFileDB.test_fname)
+        for suffix in (".log", ".delta"):
+            if os.path.exists(TestLogFileDB.test_fname + suffix):
+                os.remove(TestLogFileDB.test_fname + suffix)
+
+
+class TestHashFileDB(unittest.TestCase):
+    """ Class to test the file database with the hash index engine """
+    test_fname = "testfile_hash.bin"
+
+    def setUp(self):
+        """
+        creates an instance of the database with the hash engine from the testing dictionary (converted)
+        """
+        self.test_dict = {n: n * 100 for n in range(1, 51)}
+        with open(TestHashFileDB.test_fname, "wb") as f:
+            pickle.dump(self.test_dict, f)
+        self.file_db = FileDataBase(TestHashFileDB.test_fname, "hash")
+
+    def reopen_dict(self):
+        """
+        Gets the dictionary that a new instance of the database has
+        :return: Dictionary from the hash file
+        """
+        return dict(FileDataBase(TestHashFileDB.test_fname, "hash").db.items())
+
+    def test_converted(self):
+        """ Tests that the pickled dictionary was converted to the hash file """
+        with open(TestHashFileDB.test_fname, "rb") as f:
+            self.assertEqual(f.read(4), HashStorage.HEADER_MAGIC)
+        self.assertEqual(self.reopen_dict(), self.test_dict)
+
+    def test_get_decodes_one_value(self):
+        """ Tests that get_value decodes only the value of the key """
+        with mock.patch("storage_engines.pickle.loads", wraps=pickle.loads) as loads:
+            self.assertEqual(self.file_db.get_value(40), 4000)
+            self.assertIsNone(self.file_db.get_value(60))
+            self.assertEqual(loads.call_count, 1)
+
+    def test_changes_and_growth(self):
+        """ Tests set/delete seen by other instance while the file grows and is rebuilt """
+        other_db = FileDataBase(TestHashFileDB.test_fname, "hash")
+        for i in range(3000):
+            self.assertTrue(self.file_db.set_value(f"key{i}", "x" * (i % 50)))
+            self.test_dict[f"key{i}"] = "x" * (i % 50)
+            if i % 3 == 0:
+                self.assertEqual(other_db.delete_value(f"key{i}"), "x" * (i % 50))
+                del self.test_dict[f"key{i}"]
+        self.assertEqual(other_db.get_value("key2999"), "x" * 49)
+        self.assertEqual(dict(other_db.db.items()), self.test_dict)
+        self.assertEqual(self.reopen_dict(), self.test_dict)
+
+    def test_scan_decodes_page(self):
+        """ Tests that a scan decodes only the values of the entries it gives """
+        with mock.patch.object(DataBase, "SCAN_PAGE", 4), \
+                mock.patch.object(HashStorage, "value_at", wraps=self.file_db.storage.value_at) as value_at:
+            scan = self.file_db.scan(10)
+            self.assertEqual([next(scan) for _ in range(3)], [(n, n * 100) for n in range(10, 13)])
+            self.assertEqual(value_at.call_count, 4)
+        self.assertTrue(self.file_db.set_value(11.5, 0))
+        self.assertEqual(list(self.file_db.scan(11, 12)), [(11, 1100), (11.5, 0)])
+
+    def test_transaction_rollback(self):
+        """ Tests that changes of a transaction that raises are not written """
+        with self.assertRaises(KeyError):
+            with self.file_db.transaction() as db:
+                db.set_value(1, 0)
+                self.assertEqual(db.get_value(1), 0)
+                raise KeyError
+        self.assertEqual(self.file_db.get_value(1), 100)
+        self.assertEqual(self.reopen_dict(), self.test_dict)
+
+    def test_transaction_failed_write(self):
+        """ Tests that a write that raises in a transaction keeps the earlier changes of the transaction """
+        with self.file_db.transaction() as db:
+            db.set_value(1, "a")
+            with self.assertRaises(ZeroDivisionError):
+                db.update(2, lambda val: 1 / 0)
+            self.assertEqual(db.get_value(1), "a")
+        self.test_dict[1] = "a"
+        self.assertEqual(self.reopen_dict(), self.test_dict)
+
+    def tearDown(self):
+        """
+        Deletes the testing file
+        """
+        os.remove(TestHashFileDB.test_fname)
+
+
+class TestCrashSafeFileDB(unittest.TestCase):
+    """ Class to test that writes that fail or are killed never leave a cut database file """
+    test_fname = "testfile_crash.bin"
+    entries = 20000
+
+    @staticmethod
+    def write_forever():
+        """ Writes every key with the same value, a new one each time, until the process is killed """
+        file_db = FileDataBase(TestCrashSafeFileDB.test_fname)
+        i = 0
+        while True:
+            i += 1
+            file_db.set_many(dict.fromkeys(range(TestCrashSafeFileDB.entries), i))
+
+    def setUp(self):
+        """
+        creates the testing file with a specific dictionary
+        """
+        self.test_dict = {n: n * 100 for n in range(1, 51)}
+        self.file_db = FileDataBase(TestCrashSafeFileDB.test_fname)
+        self.file_db.set_many(self.test_dict)
+
+    def test_failed_write(self):
+        """ Tests that a write that fails half way leaves the previous file """
+        def write_half(file_name, data, durable=False):
+            with open(file_name, "wb") as f:
+                f.write(data[:len(data) // 2])
+            raise OSError("disk full")
+
+        with mock.patch.object(sync_backend.files, "write", side_effect=write_half):
+            with self.assertRaises(OSError):
+                self.file_db.set_value(1, 0)
+        self.assertEqual(self.file_db.get_value(1), 100)
+        self.assertEqual(FileDataBase(TestCrashSafeFileDB.test_fname).get_many([1, 50]), [100, 5000])
+
+    def test_torn_file(self):
+        """ Tests that cut or changed files are refused before decoding them """
+        with open(TestCrashSafeFileDB.test_fname, "rb") as f:
+            data = f.read()
+        for torn in (data[:len(data) // 2], data[:-1], data[:10] + bytes([data[10] ^ 1]) + data[11:]):
+            with open(TestCrashSafeFileDB.test_fname, "wb") as f:
+                f.write(torn)
+            with mock.patch("pickle.loads") as loads:
+                with self.assertRaises(CorruptFileError):
+                    FileDataBase(TestCrashSafeFileDB.test_fname).get_value(1)
+                loads.assert_not_called()
+
+    def test_killed_writers(self):
+        """ Tests that processes killed while writing leave a whole file, of the last write or of the one before """
+        for _ in range(5):
+            proc = multiprocessing.Process(target=self.write_forever, name="proc_w")
+            proc.start()
+            time.sleep(random.uniform(0.2, 0.5))
+            proc.kill()
+            proc.join()
+            vals = set(FileDataBase(TestCrashSafeFileDB.test_fname).get_many(range(TestCrashSafeFileDB.entries)))
+            self.assertEqual(len(vals), 1)
+            self.assertGreater(vals.pop(), 0)
+
+    def tearDown(self):
+        """
+        Deletes the testing files
+        """
+        for name in (TestCrashSafeFileDB.test_fname, TestCrashSafeFileDB.test_fname + ".tmp"):
+            if os.path.exists(name):
+                os.remove(name)
+
+
+class TestCompactDB(unittest.TestCase):
+    """ Class to test the dictionary database kept in sorted arrays """
+    def check_same(self, kind, make_key, make_val):
+        """
+        Applies the same random changes to a compact database and a plain one and compares them
+        :param kind: kind of compact database
+        :param make_key: function that gets a random key
+        :param make_val: function that gets a random value
+        """
+        compact, plain = CompactDataBase(kind), DataBase()
+        self.assertTrue(compact.set_many({make_key(): make_val() for _ in range(100)}))
+        plain.set_many(dict(compact.db.items()))
+        for _ in range(2000):
+            key = make_key()
+            if random.random() < 0.3:
+                self.assertEqual(compact.delete_value(key), plain.delete_value(key))
+            else:
+                val = make_val()
+                self.assertEqual(compact.set_value(key, val), plain.set_value(key, val))
+            self.assertEqual(compact.get_value(key), plain.get_value(key))
+        keys = [make_key() for _ in range(200)]
+        self.assertEqual(compact.get_many(keys), plain.get_many(keys))
+        self.assertEqual(dict(compact.db.items()), plain.db)
+        self.assertEqual(list(compact.db), sorted(plain.db))
+        self.assertEqual(len(compact.db), len(plain.db))
+
+    def test_int(self):
+        """ Tests int to int against a dictionary (many merges of the changes into the arrays) """
+        with mock.patch.object(SortedArrayMap, "MERGE_MIN", 16):
+            self.check_same("int", lambda: random.randint(-300, 300), lambda: random.randint(-1 << 63, 1 << 62))
+            with mock.patch.object(compact_maps, "numpy", None):
+                self.check_same("int", lambda: random.randint(-300, 300), lambda: random.randint(0, 10))
+
+    def test_bytes(self):
+        """ Tests str to bytes against a dictionary """
+        with mock.patch.object(SortedArrayMap, "MERGE_MIN", 16):
+            self.check_same("bytes", lambda: random.choice(["", "a", "é", "ab", "\U0001f600"]) * random.randint(1, 3)
+                            + str(random.randint(0, 30)), lambda: os.urandom(random.randint(0, 8)))
+
+    def test_types(self):
+        """ Tests that values of other types are refused and that mixed keys are read through one search each """
+        compact = CompactDataBase()
+        for key, val in ((1.5, 1), ("1", 1), (1, None), (1 << 63, 1)):
+            with self.assertRaises(TypeError):
+                compact.set_value(key, val)
+        compact.set_many({1: 100, 2: 200})
+        self.assertEqual(compact.get_many([1, "1", 2.0, 3, 1 << 70]), [100, None, None, None, None])
+        with self.assertRaises(TypeError):
+            CompactDataBase("bytes").set_value("a", "b")
+
+    def test_scan(self):
+        """ Tests that keys set with set_many after a scan are scanned """
+        compact = CompactDataBase()
+        compact.set_many({1: 10, 2: 20})
+        self.assertEqual(list(compact.scan()), [(1, 10), (2, 20)])
+        compact.set_many({3: 30, 0: 0})
+        compact.set_value(4, 40)
+        self.assertEqual(list(compact.scan()), [(0, 0), (1, 10), (2, 20), (3, 30), (4, 40)])
+
+    def test_memory(self):
+        """ Tests that the compact database uses much less memory than a dictionary of objects """
+        compact, plain = CompactDataBase(), DataBase()
+        items = {n: n * 100 for n in range(100000)}
+        compact.set_many(items)
+        plain.set_many(items)
+        usage = compact.memory_usage()
+        self.assertEqual(usage["entries"], 100000)
+        self.assertEqual(usage["overlay_bytes"], sys.getsizeof({}))
+        self.assertLess(usage["bytes_per_entry"], 20)
+        self.assertLess(usage["bytes"] * 4, plain.memory_usage()["bytes"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,14 +5,28 @@ Description: Test file for threading and multiprocessing synchronized with win a
 https://github.com/Kloke93/database_sync
 """
 from winAPI_sync_database import SyncDataBase
+from winAPI_sharded_database import ShardedSyncDataBase
+from winAPI_async_database import AsyncSyncDataBase
+from winAPI_cached_database import CachedDataBase
+from dict_database import DataBase
+from storage_engines import HashStorage
+from winAPI_server import DataBaseServer, DataBaseClient, ServerError
+from sync_backend import get_backend, WAIT_OBJECT_0, WAIT_TIMEOUT
 from random import randint
+from unittest import mock
 import multiprocessing
+import asyncio
 import threading
 import unittest
+import time
+import tempfile
 import pickle
 import os
 
 
+SyncDataBase.LOG_FILE = os.path.join(tempfile.gettempdir(), "file_database_test.log")   # not in the working directory
+
+
 class TestThreadDB(unittest.TestCase):
     """ Class to test synchronized database in threading mode """
     test_fname = "testfile.bin"
@@ -38,6 +52,30 @@ class TestThreadDB(unittest.TestCase):
         for _ in range(TestThreadDB.reps):
             self.assertIsInstance(self.sync_db.get_value(key), int)
 
+    def transfer(self, src, dst):
+        """ Test transaction moving one unit from a key to another """
+        for _ in range(TestThreadDB.reps // 10):
+            with self.sync_db.transaction() as db:
+                db.set_value(src, db.get_value(src) - 1)
+                db.set_value(dst, db.get_value(dst) + 1)
+
+    def get_many_sum(self, keys, total):
+        """ Test get_many method sees transactions completely or not at all """
+        for _ in range(TestThreadDB.reps // 10):
+            self.assertEqual(sum(self.sync_db.get_many(keys)), total)
+
+    def incr(self, key):
+        """ Test incr method """
+        for _ in range(TestThreadDB.reps // 10):
+            self.sync_db.incr(key)
+
+    def compare_and_set(self, key):
+        """ Test compare_and_set method increasing a value by one (again if another thread changed it first) """
+        for _ in range(TestThreadDB.reps // 10):
+            val = self.sync_db.get_value(key)
+            while not self.sync_db.compare_and_set(key, val, val + 1):
+                val = self.sync_db.get_value(key)
+
     @staticmethod
     def get_database_dict():
         """
@@ -92,6 +130,115 @@ class TestThreadDB(unittest.TestCase):
             self.test_dict[i] += TestThreadDB.reps
         self.assertEqual(self.get_database_dict(), self.test_dict)
 
+    def test_batch(self):
+        """ Tests set_many, get_many and delete_many """
+        self.assertTrue(self.sync_db.set_many({n: -n for n in range(1, 11)}))
+        self.assertEqual(self.sync_db.get_many([1, 10, 60]), [-1, -10, None])
+        self.assertEqual(self.sync_db.delete_many([1, 60]), [-1, None])
+        self.test_dict.update({n: -n for n in range(2, 11)})
+        del self.test_dict[1]
+        self.assertEqual(self.get_database_dict(), self.test_dict)
+
+    def test_transaction(self):
+        """ Tests of 3 threads moving units between keys in transactions while 3 threads read the total """
+        total = sum(self.test_dict[k] for k in (1, 2, 3))
+        threads = [threading.Thread(target=self.transfer, name=f"thread_{i}", args=(i, i % 3 + 1))
+                   for i in range(1, 4)]
+        threads += [threading.Thread(target=self.get_many_sum, name=f"thread_{i}", args=((1, 2, 3), total))
+                    for i in range(4, 7)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.get_database_dict(), self.test_dict)
+
+    def test_atomic_ops(self):
+        """ Tests of 3 threads incrementing a counter each, 3 the same one and 3 with compare_and_set """
+        threads = [threading.Thread(target=self.incr, name=f"thread_{i}", args=(i,)) for i in range(1, 4)]
+        threads += [threading.Thread(target=self.incr, name=f"thread_{i}", args=(60,)) for i in range(4, 7)]
+        threads += [threading.Thread(target=self.compare_and_set, name=f"thread_{i}", args=(10,))
+                    for i in range(7, 10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for key in (1, 2, 3):
+            self.test_dict[key] += TestThreadDB.reps // 10
+        self.test_dict[60] = 3 * (TestThreadDB.reps // 10)
+        self.test_dict[10] += 3 * (TestThreadDB.reps // 10)
+        self.assertEqual(self.sync_db.setdefault(60, 0), self.test_dict[60])
+        self.assertEqual(self.sync_db.setdefault(70, 7), 7)
+        self.test_dict[70] = 7
+        self.sync_db.flush()
+        self.assertEqual(self.get_database_dict(), self.test_dict)
+
+    def test_striped_updates(self):
+        """ Tests that updates of keys of different stripes compute their values at the same time """
+        if not isinstance(self.sync_db, SyncDataBase) or self.sync_db.durability != "sync":
+            self.skipTest("queued updates are computed by the committer one after the other")
+        self.assertIsNot(self.sync_db.stripe(1), self.sync_db.stripe(2))
+        both = threading.Barrier(2, timeout=10)
+
+        def add_together(val):
+            both.wait()                                     # breaks if the other update can't run meanwhile
+            return val + 1
+        threads = [threading.Thread(target=self.sync_db.update, name=f"thread_{key}", args=(key, add_together))
+                   for key in (1, 2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertFalse(both.broken)
+        self.test_dict[1] += 1
+        self.test_dict[2] += 1
+        self.assertEqual(self.get_database_dict(), self.test_dict)
+
+    def test_update_unequal_value(self):
+        """ Tests that updating a value that isn't equal to itself ends when the file changed meanwhile """
+        if not isinstance(self.sync_db, SyncDataBase) or self.sync_db.durability != "sync":
+            self.skipTest("queued updates are computed under the write lock")
+        self.assertTrue(self.sync_db.set_value("k", float("nan")))
+        calls = []
+
+        def change_other(val):
+            calls.append(val)
+            self.sync_db.set_value(99, len(calls))              # the file changes while the value is computed
+            return 1
+        self.assertEqual(self.sync_db.update("k", change_other), 1)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.sync_db.get_many(["k", 99]), [1, 1])
+
+    def scan_sorted(self, keys):
+        """ Test scan method gives every key that isn't written in order """
+        for _ in range(TestThreadDB.reps // 50):
+            scanned = [key for key, _ in self.sync_db.scan(1, 51)]
+            self.assertEqual(scanned, sorted(scanned))
+            self.assertTrue(set(keys) <= set(scanned))
+
+    def test_scan(self):
+        """ Tests of 3 threads scanning a page at a time while 3 threads write keys in the range """
+        with mock.patch.object(DataBase, "SCAN_PAGE", 8):
+            threads = [threading.Thread(target=self.scan_sorted, name=f"thread_{i}", args=(range(1, 41),))
+                       for i in range(1, 4)]
+            threads += [threading.Thread(target=self.sync_db.set_many, name=f"thread_{i}",
+                                         args=({n + 0.5: n for n in range(37 + i, 51, 3)},)) for i in range(4, 7)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual([key for key, _ in self.sync_db.scan(41, 42)], [41, 41.5])
+            self.assertEqual(len(list(self.sync_db.scan())), 60)
+
+    def test_transaction_rollback(self):
+        """ Tests that nothing of a transaction that raises is written """
+        with self.assertRaises(KeyError):
+            with self.sync_db.transaction() as db:
+                db.set_value(1, 0)
+                db.delete_value(2)
+                raise KeyError
+        self.assertEqual(self.sync_db.get_value(1), 100)
+        self.assertEqual(self.get_database_dict(), self.test_dict)
+
     def tearDown(self):
         """
         Deletes the testing file
@@ -99,6 +246,514 @@ class TestThreadDB(unittest.TestCase):
         os.remove("testfile.bin")
 
 
+class TestThreadSnapshotDB(TestThreadDB):
+    """ Class to test synchronized database in threading mode with lock-free snapshot reads """
+    def setUp(self):
+        """
+        sets up the testing file with a specific dictionary and creates an instance of the database
+        """
+        self.test_dict = {n: n * 100 for n in range(1, 51)}
+        with open(TestThreadDB.test_fname, "wb") as f:
+            pickle.dump(self.test_dict, f)
+        self.sync_db = SyncDataBase(1, TestThreadDB.test_fname, snapshot_reads=True)
+
+    def test_read_while_writing(self):
+        """ Tests that readers get the previous version while a writer keeps the write lock """
+        in_transaction = threading.Event()
+        finish = threading.Event()
+        other_db = SyncDataBase(1, TestThreadDB.test_fname, snapshot_reads=True)
+
+        def write():
+            with self.sync_db.transaction() as db:
+                db.set_value(40, 0)
+                in_transaction.set()
+                finish.wait(10)
+
+        thread = threading.Thread(target=write, name="thread_w")
+        thread.start()
+        in_transaction.wait(10)
+        self.assertEqual(self.sync_db.get_value(40), 4000)
+        self.assertEqual(other_db.get_value(40), 4000)
+        finish.set()
+        thread.join()
+        self.assertEqual(self.sync_db.get_value(40), 0)
+
+    def test_lazy_publish(self):
+        """ Tests that saves don't copy the dictionary and the first lock-free read copies it without reading file """
+        self.assertTrue(self.sync_db.set_value(1, 5))
+        self.assertIsNone(self.sync_db.published)
+        with mock.patch.object(self.sync_db.storage, "read_all", wraps=self.sync_db.storage.read_all) as read_all:
+            self.assertEqual(self.sync_db.get_many([1, 2]), [5, 200])
+            self.assertEqual(self.sync_db.get_value(1), 5)
+        read_all.assert_not_called()
+        self.assertEqual(self.sync_db.published[1][1], 5)
+
+    def test_stats(self):
+        """ Tests that lock waits and file writes are counted and that instances share one log handler """
+        other_db = SyncDataBase(1, TestThreadDB.test_fname)
+        waits = self.sync_db.stats()["histograms"]["lock_write_wait"]["count"]
+        for i in range(10):
+            self.assertTrue(self.sync_db.set_value(i, i))
+            self.assertEqual(other_db.get_value(i), i)
+        stats = self.sync_db.stats()
+        self.assertEqual(stats["histograms"]["lock_write_wait"]["count"], waits + 10)
+        self.assertEqual(stats["histograms"]["file_write"]["count"], 10)
+        self.assertGreater(stats["counters"]["file_write_bytes"], 0)
+        self.assertEqual(other_db.stats()["histograms"]["lock_read_wait"]["count"], 10)
+        self.assertEqual(len(SyncDataBase.logger.handlers), 1)
+
+
+class TestThreadHashDB(TestThreadDB):
+    """ Class to test synchronized database in threading mode with the hash index engine """
+    def setUp(self):
+        """
+        sets up the testing file with a specific dictionary and creates an instance of the database
+        """
+        super().setUp()
+        self.sync_db = SyncDataBase(1, TestThreadDB.test_fname, "hash")
+
+    @staticmethod
+    def get_database_dict():
+        """
+        Gets the database dictionary
+        :return: Dictionary from the hash file
+        """
+        return dict(SyncDataBase(1, TestThreadDB.test_fname, "hash").db.items())
+
+
+class TestThreadSharedHashDB(TestThreadHashDB):
+    """ Class to test synchronized database in threading mode reading the mapping of the hash engine without locks """
+    def setUp(self):
+        """
+        sets up the testing file with a specific dictionary and creates an instance of the database
+        """
+        super().setUp()
+        self.sync_db = SyncDataBase(1, TestThreadDB.test_fname, "hash", snapshot_reads=True)
+
+    def test_reads_mapping(self):
+        """ Tests that reads don't lock nor decode the whole file and see writes of other instances """
+        other_db = SyncDataBase(1, TestThreadDB.test_fname, "hash")
+        self.assertTrue(other_db.set_value(40, 0))
+        with mock.patch.object(self.sync_db.storage, "value_at", wraps=self.sync_db.storage.value_at) as value_at, \
+                mock.patch.object(self.sync_db.rwlock, "acquire_read") as acquire_read:
+            self.assertEqual(self.sync_db.get_value(40), 0)
+            self.assertEqual(self.sync_db.get_many([1, 40, 99]), [100, 0, None])
+        self.assertEqual(value_at.call_count, 3)                # only the values read are decoded
+        acquire_read.assert_not_called()
+
+    def test_writer_died_during_save(self):
+        """ Tests that lock-free reads work again after a writer died with the generation odd """
+        storage = self.sync_db.storage
+        header = storage._header()
+        header[2] += 1                                          # as left by a save that didn't finish
+        HashStorage.HEADER.pack_into(storage.mm, 0, *header)
+        self.assertIsNone(storage.read_values([40]))
+        other_db = SyncDataBase(1, TestThreadDB.test_fname, "hash")     # opened under the write lock: repaired
+        self.assertEqual(storage.read_values([40]), [4000])
+        self.assertTrue(other_db.set_value(40, 0))
+        self.assertEqual(storage.version() % 2, 0)
+        self.assertEqual(storage.read_values([40]), [0])
+
+
+class TestThreadGroupDB(TestThreadDB):
+    """ Class to test synchronized database in threading mode with group commits """
+    def setUp(self):
+        """
+        sets up the testing file with a specific dictionary and creates an instance of the database
+        """
+        super().setUp()
+        self.sync_db = SyncDataBase(1, TestThreadDB.test_fname, durability="group")
+
+    def test_writes_grouped(self):
+        """ Tests that writes of many threads at once are written to file together """
+        storage = self.sync_db.storage
+        with mock.patch.object(storage, "save", wraps=storage.save) as save:
+            threads = [threading.Thread(target=self.set_value, name=f"thread_{i}", args=(i, i)) for i in range(8)]
+            TestThreadDB.reps, reps = 50, TestThreadDB.reps
+            try:
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            finally:
+                TestThreadDB.reps = reps
+            self.assertLess(save.call_count, 8 * 50 // 2)
+        self.test_dict.update({i: i for i in range(8)})
+        self.assertEqual(self.get_database_dict(), self.test_dict)
+
+
+class TestThreadAsyncDB(TestThreadDB):
+    """ Class to test synchronized database in threading mode with background writes """
+    def setUp(self):
+        """
+        sets up the testing file with a specific dictionary and creates an instance of the database
+        """
+        super().setUp()
+        self.sync_db = SyncDataBase(1, TestThreadDB.test_fname, durability="async")
+
+    def get_database_dict(self):
+        """
+        Gets the database dictionary once the background writes are done
+        :return: Dictionary from file
+        """
+        self.sync_db.flush()
+        return TestThreadDB.get_database_dict()
+
+    def test_reads_own_writes(self):
+        """ Tests that queued writes are seen by reads before they are written """
+        self.assertTrue(self.sync_db.set_value(60, "a"))
+        self.assertEqual(self.sync_db.delete_value(40), 4000)
+        self.assertEqual(self.sync_db.get_many([60, 40, 1]), ["a", None, 100])
+        self.test_dict[60] = "a"
+        del self.test_dict[40]
+        self.assertEqual(self.get_database_dict(), self.test_dict)
+        self.assertEqual(self.sync_db.unflushed, {})
+
+    def test_failed_write_in_batch(self):
+        """ Tests that a queued write that raises fails alone and the other writes of its batch are written """
+        self.assertTrue(self.sync_db.set_value(5, "x"))             # queued, written with the update
+        with self.assertRaises(ZeroDivisionError):
+            self.sync_db.update(6, lambda val: 1 / 0)
+        self.assertTrue(self.sync_db.set_value(7, "y"))
+        self.assertTrue(self.sync_db.set_value(8, lambda: None))    # can't be pickled: the whole commit raises
+        self.assertEqual(self.sync_db.update(9, lambda val: 1), 1)  # and is written again without it
+        self.test_dict.update({5: "x", 7: "y", 9: 1})
+        self.assertEqual(self.get_database_dict(), self.test_dict)
+
+
+class TestThreadCachedDB(TestThreadDB):
+    """ Class to test synchronized database in threading mode behind the value cache """
+    def setUp(self):
+        """
+        sets up the testing file with a specific dictionary and creates an instance of the cached database
+        """
+        self.test_dict = {n: n * 100 for n in range(1, 51)}
+        with open(TestThreadDB.test_fname, "wb") as f:
+            pickle.dump(self.test_dict, f)
+        self.sync_db = CachedDataBase(SyncDataBase(1, TestThreadDB.test_fname), size=10)
+
+    def test_invalidated_by_other_instance(self):
+        """ Tests that writes of other instance are never read from the cache """
+        other_db = SyncDataBase(1, TestThreadDB.test_fname)
+        for i in range(20):
+            self.assertEqual(self.sync_db.get_value(40), 4000 + i)
+            self.assertEqual(self.sync_db.get_value(40), 4000 + i)
+            self.assertTrue(other_db._set_value_testing(40))
+        counters = self.sync_db.stats()["counters"]
+        self.assertEqual(counters["cache_hits"], 20)
+        self.assertEqual(counters["cache_misses"], 20)
+        self.assertEqual(counters["cache_invalidations"], 19)
+
+    def test_lru_and_ttl(self):
+        """ Tests that the least recently used keys are evicted and that values expire """
+        self.assertEqual(self.sync_db.get_many(range(1, 21)), [n * 100 for n in range(1, 21)])
+        self.assertEqual(list(self.sync_db.cache), list(range(11, 21)))
+        self.sync_db.get_value(11)
+        self.sync_db.get_value(1)
+        self.assertNotIn(12, self.sync_db.cache)
+        self.assertEqual(self.sync_db.stats()["counters"]["cache_evictions"], 11)
+        self.sync_db.ttl = 0.01
+        self.sync_db.get_value(2)
+        time.sleep(0.02)
+        self.assertEqual(self.sync_db.get_value(2), 200)
+        self.assertEqual(self.sync_db.stats()["counters"]["cache_expired"], 1)
+
+
+class TestThreadShardedDB(TestThreadDB):
+    """ Class to test the sharded synchronized database in threading mode """
+    shards = 4
+
+    @staticmethod
+    def shard_names() -> list:
+        """
+        Gets the names of the shard files
+        :return: file names
+        """
+        return [f"testfile.{n}.bin" for n in range(TestThreadShardedDB.shards)]
+
+    @staticmethod
+    def get_database_dict():
+        """
+        Gets the database dictionary
+        :return: Dictionary from the shard files together
+        """
+        db = {}
+        for name in TestThreadShardedDB.shard_names():
+            with open(name, "rb") as f:
+                db.update(pickle.load(f))
+        return db
+
+    def setUp(self):
+        """
+        creates an instance of the sharded database with the testing dictionary
+        """
+        self.test_dict = {n: n * 100 for n in range(1, 51)}
+        self.sync_db = ShardedSyncDataBase(1, TestThreadDB.test_fname, TestThreadShardedDB.shards)
+        self.sync_db.set_many(self.test_dict)
+
+    def test_partitioned(self):
+        """ Tests that every shard has only its keys """
+        for shard in self.sync_db.shards:
+            with open(shard.get_name(), "rb") as f:
+                for key in pickle.load(f):
+                    self.assertIs(self.sync_db.shard(key), shard)
+
+    def test_equal_keys(self):
+        """ Tests that equal keys of different types are the same key, in the same shard """
+        for keys in ((60, 60.0), (1, 1.0, True), ((1, "a"), (1.0, "a"))):
+            self.assertEqual(len({id(self.sync_db.shard(key)) for key in keys}), 1)
+        self.assertTrue(self.sync_db.set_value(1.0, "a"))
+        self.assertTrue(self.sync_db.set_value(True, "b"))
+        self.assertEqual(self.sync_db.get_many([1, 1.0]), ["b", "b"])
+        self.test_dict[1] = "b"
+        self.assertEqual(self.get_database_dict(), self.test_dict)
+
+    def test_shards_dont_block(self):
+        """ Tests that a writer of a shard doesn't wait for a writer that has the lock of other shard """
+        locked = self.sync_db.shard(1)
+        other = next(key for key in self.test_dict if self.sync_db.shard(key) is not locked)
+        in_transaction = threading.Event()
+        finish = threading.Event()
+
+        def write():
+            with locked.transaction() as db:
+                db.set_value(1, 0)
+                in_transaction.set()
+                finish.wait(10)
+
+        thread = threading.Thread(target=write, name="thread_w")
+        thread.start()
+        in_transaction.wait(10)
+        self.assertTrue(self.sync_db.set_value(other, 0))
+        self.assertFalse(finish.is_set())
+        finish.set()
+        thread.join()
+        self.test_dict.update({1: 0, other: 0})
+        self.assertEqual(self.get_database_dict(), self.test_dict)
+
+    def tearDown(self):
+        """
+        Deletes the shard files
+        """
+        for name in TestThreadShardedDB.shard_names():
+            os.remove(name)
+
+
+class TestAsyncDB(unittest.TestCase):
+    """ Class to test the asyncio synchronized database with thousands of coroutines """
+    test_fname = "testfile.bin"
+    coroutines = 5000
+
+    def setUp(self):
+        """
+        sets up the testing file with a specific dictionary and creates an instance of the database
+        """
+        self.test_dict = {n: n * 100 for n in range(1, 51)}
+        with open(TestAsyncDB.test_fname, "wb") as f:
+            pickle.dump(self.test_dict, f)
+        self.async_db = AsyncSyncDataBase(1, TestAsyncDB.test_fname)
+
+    def test_reads_coalesced(self):
+        """ Tests that concurrent get_value of the same keys share the reads """
+        keys = [n % 50 + 1 for n in range(TestAsyncDB.coroutines)]
+        database = self.async_db.database
+        with mock.patch.object(database, "get_value", wraps=database.get_value) as get_value:
+            vals = asyncio.run(self.gather(self.async_db.get_value(key) for key in keys))
+            self.assertLess(get_value.call_count, TestAsyncDB.coroutines // 10)
+        self.assertEqual(vals, [key * 100 for key in keys])
+
+    def test_reads_and_writes(self):
+        """ Tests coroutines that increase values while others read them """
+        keys = [n % 10 + 1 for n in range(TestAsyncDB.coroutines // 2)]
+        calls = [self.async_db.update(key, lambda val: val + 1) for key in keys]
+        calls += [self.async_db.get_value(key) for key in keys]
+        vals = asyncio.run(self.gather(calls))
+        for key, val in zip(keys, vals[len(keys):]):
+            self.assertGreaterEqual(val, key * 100)
+        for key in keys:
+            self.test_dict[key] += 1
+        self.assertEqual(TestThreadDB.get_database_dict(), self.test_dict)
+
+    def test_read_after_write(self):
+        """ Tests that a read that starts after a write sees it even if older reads of the key are in flight """
+        async def write_and_read():
+            older = [asyncio.ensure_future(self.async_db.get_value(40)) for _ in range(100)]
+            await self.async_db.set_value(40, 0)
+            self.assertEqual(await self.async_db.get_value(40), 0)
+            await asyncio.gather(*older)
+        asyncio.run(write_and_read())
+
+    def test_watch(self):
+        """ Tests that changes are watched with async for """
+        async def write_and_watch():
+            async_db = AsyncSyncDataBase(1, TestAsyncDB.test_fname, feed=True)
+            seen = []
+            async for event in async_db.watch(keys=[40]):
+                seen.append((event.old, event.new))
+                if len(seen) == 3:
+                    break
+                await async_db.incr(40)
+            async_db.close()
+            return seen
+        self.assertEqual(asyncio.run(self.first_write(write_and_watch())), [(4000, 4001), (4001, 4002), (4002, 4003)])
+
+    async def first_write(self, watching):
+        """
+        Starts watching and writes the first change
+        :param watching: coroutine that watches
+        :return: what it returns
+        """
+        task = asyncio.ensure_future(watching)
+        await asyncio.sleep(0.1)
+        writer = AsyncSyncDataBase(1, TestAsyncDB.test_fname, feed=True)
+        await writer.incr(40)
+        writer.close()
+        return await task
+
+    @staticmethod
+    async def gather(calls) -> list:
+        """
+        Runs coroutines at the same time
+        :param calls: coroutines
+        :return: their results in order
+        """
+        return await asyncio.gather(*calls)
+
+    def tearDown(self):
+        """
+        Stops the threads and deletes the testing file
+        """
+        self.async_db.close()
+        os.remove(TestAsyncDB.test_fname)
+        if os.path.exists(TestAsyncDB.test_fname + ".feed"):
+            os.remove(TestAsyncDB.test_fname + ".feed")
+
+
+class TestServer(unittest.TestCase):
+    """ Class to test the key-value server and its client over loopback """
+    test_fname = "testfile.bin"
+
+    def setUp(self):
+        """
+        sets up the testing file, starts a server of it in a thread and creates a client
+        """
+        self.test_dict = {n: n * 100 for n in range(1, 51)}
+        with open(TestServer.test_fname, "wb") as f:
+            pickle.dump(self.test_dict, f)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="thread_server")
+        self.thread.start()
+        self.server = DataBaseServer(1, TestServer.test_fname)
+        host, port = asyncio.run_coroutine_threadsafe(self.server.start(port=0), self.loop).result()
+        self.client = DataBaseClient(host, port)
+
+    def stop_server(self):
+        """ Stops the server (writing its last changes) """
+        asyncio.run_coroutine_threadsafe(self.server.close(), self.loop).result()
+
+    def test_operations(self):
+        """ Tests get/set/delete and their batches """
+        self.assertEqual(self.client.get_value(40), 4000)
+        self.assertTrue(self.client.set_value("a", b"\x00"))
+        self.assertEqual(self.client.get_value("a"), b"\x00")
+        self.assertEqual(self.client.delete_value(40), 4000)
+        self.assertIsNone(self.client.get_value(40))
+        self.assertTrue(self.client.set_many({1: "x", 2: None}))
+        self.assertEqual(self.client.get_many([1, 2, 3, 60]), ["x", None, 300, None])
+        self.assertEqual(self.client.delete_many([3, 60]), [300, None])
+        with self.assertRaises(TypeError):
+            self.client.set_value(1, 1.5)                           # only str, bytes, int and None
+        with self.assertRaises(ServerError):
+            self.client.call([(0, [])])                             # unknown opcode
+        self.stop_server()
+        del self.test_dict[40], self.test_dict[3]
+        self.test_dict.update({"a": b"\x00", 1: "x", 2: None})
+        self.assertEqual(TestThreadDB.get_database_dict(), self.test_dict)
+
+    def test_pipeline(self):
+        """ Tests many requests sent before reading their answers """
+        pipeline = self.client.pipeline()
+        for i in range(1000):
+            pipeline.set_value(i % 10, i).get_value(i % 10)
+        results = pipeline.execute()
+        self.assertEqual(results[1::2], list(range(1000)))
+        self.assertEqual(self.client.get_many(range(10)), list(range(990, 1000)))
+
+    def test_pooled_threads(self):
+        """ Tests threads sharing the connections of a client """
+        def write(n):
+            for i in range(200):
+                self.client.set_value(n * 1000 + i, i)
+
+        threads = [threading.Thread(target=write, name=f"thread_{n}", args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertLessEqual(self.client.pool.qsize(), DataBaseClient.POOL_SIZE)
+        self.stop_server()
+        db = TestThreadDB.get_database_dict()
+        self.assertEqual([db[n * 1000 + 199] for n in range(8)], [199] * 8)
+
+    def tearDown(self):
+        """
+        Stops client, server and its thread and deletes the testing file
+        """
+        self.client.close()
+        self.stop_server()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        os.remove(TestServer.test_fname)
+
+
+class TestRWLock(unittest.TestCase):
+    """ Class to test the reader-writer lock of the backends """
+    def test_writer_preference(self):
+        """ Tests that a waiting writer keeps new readers out and gets the lock when readers leave """
+        for mode in (1, 0):
+            rwlock = get_backend(mode).create_rwlock(f"test_rwlock_{mode}", 3)
+            local = getattr(rwlock, "local", rwlock)        # threads of a process are ordered by a ThreadRWLock
+            self.assertEqual(rwlock.acquire_read(1000), WAIT_OBJECT_0)
+            writer = threading.Thread(target=rwlock.acquire_write, args=(10000,))
+            writer.start()
+            while not local.waiting_writers:
+                time.sleep(0.001)
+            self.assertEqual(rwlock.acquire_read(10), WAIT_TIMEOUT)
+            rwlock.release_read()
+            writer.join()
+            self.assertEqual(rwlock.acquire_read(10), WAIT_TIMEOUT)
+            rwlock.release_write()
+            self.assertEqual(rwlock.acquire_read(1000), WAIT_OBJECT_0)
+            rwlock.release_read()
+
+    @staticmethod
+    def hold_readers(name, count, held, done):
+        """ Takes the lock for reading count times and keeps it until done is set """
+        rwlock = get_backend(0).create_rwlock(name, count)
+        for _ in range(count):
+            rwlock.acquire_read(1000)
+        held.set()
+        done.wait(10)
+        for _ in range(count):
+            rwlock.release_read()
+
+    def test_readers_bound(self):
+        """ Tests that the maximum of readers counts the readers of every process """
+        rwlock = get_backend(0).create_rwlock("test_rwlock_bound", 2)
+        held, done = multiprocessing.Event(), multiprocessing.Event()
+        proc = multiprocessing.Process(target=self.hold_readers, args=("test_rwlock_bound", 2, held, done))
+        proc.start()
+        self.assertTrue(held.wait(10))
+        self.assertEqual(rwlock.acquire_read(10), WAIT_TIMEOUT)
+        done.set()
+        proc.join()
+        self.assertEqual(rwlock.acquire_read(1000), WAIT_OBJECT_0)
+        self.assertEqual(rwlock.acquire_read(1000), WAIT_OBJECT_0)
+        rwlock.release_read()
+        rwlock.release_read()
+
+
 class TestProcessDB(unittest.TestCase):
     """ Class to test synchronized database in multiprocessing mode """
     test_fname = "testfile.bin"
@@ -133,6 +788,43 @@ class TestProcessDB(unittest.TestCase):
         for _ in range(TestProcessDB.reps):
             sync_db.get_value(key)
 
+    @staticmethod
+    def set_pair(reps):
+        """ Sets keys 1 and 2 to the same value with a single write """
+        sync_db = SyncDataBase(0, TestProcessDB.test_fname, "hash")
+        for i in range(reps):
+            sync_db.set_many({1: i, 2: i})
+
+    @staticmethod
+    def set_counter(key, reps):
+        """ Sets a key from 1 to reps writing to the change feed """
+        sync_db = SyncDataBase(0, TestProcessDB.test_fname, feed=True)
+        for i in range(1, reps + 1):
+            sync_db.set_value(key, i)
+
+    @staticmethod
+    def set_and_die(key):
+        """ Sets a key with the hash engine and dies as soon as its record is in the index (save not finished) """
+        sync_db = SyncDataBase(0, TestProcessDB.test_fname, "hash")
+        put = sync_db.storage._put
+
+        def put_and_die(*args):
+            put(*args)
+            os._exit(1)
+
+        sync_db.storage._put = put_and_die
+        sync_db.set_value(key, 1)
+
+    @staticmethod
+    def get_pair(reps, errors):
+        """ Reads keys 1 and 2 without locking and counts the reads that see only one of them written """
+        sync_db = SyncDataBase(0, TestProcessDB.test_fname, "hash", snapshot_reads=True)
+        for _ in range(reps):
+            first, second = sync_db.get_many([1, 2])
+            if first != second:
+                with errors.get_lock():
+                    errors.value += 1
+
     @staticmethod
     def get_database_dict():
         """
@@ -186,11 +878,59 @@ class TestProcessDB(unittest.TestCase):
             self.test_dict[i] += TestProcessDB.reps
         self.assertEqual(self.get_database_dict(), self.test_dict)
 
+    def test_shared_reads(self):
+        """ Tests that processes reading the shared mapping of the hash engine see every write whole """
+        errors = multiprocessing.Value("i", 0)
+        SyncDataBase(0, TestProcessDB.test_fname, "hash").set_many({1: 0, 2: 0})
+        procs = [multiprocessing.Process(target=self.set_pair, name="proc_w", args=(500,))]
+        for i in range(1, 4):
+            procs.append(multiprocessing.Process(target=self.get_pair, name=f"proc_{i}", args=(2000, errors)))
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        self.assertEqual(errors.value, 0)
+        self.assertEqual(SyncDataBase(0, TestProcessDB.test_fname, "hash").get_many([1, 2]), [499, 499])
+
+    def test_writer_killed(self):
+        """ Tests that the records of a writer killed during a save of the hash engine are kept by the next saves """
+        SyncDataBase(0, TestProcessDB.test_fname, "hash")
+        proc = multiprocessing.Process(target=self.set_and_die, name="proc_k", args=("victim",))
+        proc.start()
+        proc.join()
+        self.assertEqual(proc.exitcode, 1)
+        sync_db = SyncDataBase(0, TestProcessDB.test_fname, "hash")       # opened under the write lock: repaired
+        self.assertEqual(sync_db.get_value("victim"), 1)
+        self.assertTrue(sync_db.set_value("after", 2))
+        self.assertEqual(sync_db.get_many(["victim", "after", 40]), [1, 2, 4000])
+        keys = list(sync_db.storage.keys())
+        self.assertEqual(len(keys), len(self.test_dict) + 2)                 # no record overwritten or repeated
+        self.assertEqual(set(keys), set(self.test_dict) | {"victim", "after"})
+        self.assertEqual(sync_db.storage.version() % 2, 0)
+
+    def test_watch(self):
+        """ Tests that the changes of 3 writing processes are watched once each, in order and with their old values """
+        watch = SyncDataBase(0, TestProcessDB.test_fname, feed=True).watch(keys=[60, 61, 62], since=0)
+        procs = [multiprocessing.Process(target=self.set_counter, name=f"proc_{i}", args=(60 + i, 200))
+                 for i in range(3)]
+        for p in procs:
+            p.start()
+        events = [watch.next_event(10) for _ in range(600)]
+        for p in procs:
+            p.join()
+        self.assertEqual([event.version for event in events], list(range(1, 601)))
+        for key in (60, 61, 62):
+            self.assertEqual([(event.old, event.new) for event in events if event.key == key],
+                             [(i or None, i + 1) for i in range(200)])
+        self.assertIsNone(watch.next_event(0))
+
     def tearDown(self):
         """
         Deletes the testing file
         """
         os.remove("testfile.bin")
+        if os.path.exists("testfile.bin.feed"):
+            os.remove("testfile.bin.feed")
 
     # https://stackoverflow.com/questions/25646382/python-3-4-multiprocessing-does-not-work-with-unittest
     # Dano answer to understand